@@ -1,22 +1,20 @@
 import os
-from utils import (
-    get_bus_schedule,
-    get_subway_schedule,
-    get_LIRR_schedule,
-    get_MNR_schedule,
-    color_interpolation,
-)
-from datetime import datetime
-import json
-import urllib
+from realtime_poller import current_snapshot
+from utils_streamlit import CITIBIKE_COLUMNS, SCHEDULE_COLUMNS, citibike_colors
 import dash
 import dash_bootstrap_components as dbc
 from dash import dcc, html, callback_context
 from dash.dependencies import Input, Output, State
+from flask import Response, request
 import plotly.graph_objects as go
 import pandas as pd
 import plotly.io as pio
 
+from scripts.gtfs_calendar import load_calendar, service_date, working_model
+from scripts.gtfs_prepare import load_prepared_model, prepare_feeds
+from scripts.schedule_index import build_schedule_index, format_seconds, seconds_now
+from scripts.vector_tiles import compile_tiles, map_layers, tile_response
+
 SUBFILES = [
     "bus_bronx",
     "bus_brooklyn",
@@ -29,60 +27,64 @@ SUBFILES = [
     "bus_new_jersy",
     "NJ_rail",
 ]
-dataframes = {}
+# 十个 feed 在进程池里并行准备（typed 缓存 / 模型 / 分区 / 几何，见 scripts/gtfs_prepare.py），
+# 已是最新的 feed 不会启动任何进程
+prepare_feeds(SUBFILES, gtfs_dir="GTFS")
+feed_models = {}
 for subdir in SUBFILES:
-    folder_path = os.path.join("GTFS", subdir)
-
-    routes = pd.read_csv(os.path.join(folder_path, "routes.txt"))
-    stop_times = pd.read_csv(os.path.join(folder_path, "stop_times.txt"))
-    stops = pd.read_csv(os.path.join(folder_path, "stops.txt"))
-    trips = pd.read_csv(os.path.join(folder_path, "trips.txt"))
-
-    df = trips[["route_id", "service_id", "trip_id"]]
-    df = df.merge(
-        stop_times[
-            ["trip_id", "arrival_time", "departure_time", "stop_sequence", "stop_id"]
-        ],
-        left_on="trip_id",
-        right_on="trip_id",
-        how="left",
-    )
-    df = df.merge(
-        stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]],
-        left_on="stop_id",
-        right_on="stop_id",
-        how="left",
+    # 紧凑整数编码模型（scripts/gtfs_model.py），数组直接 memory-map 预构建的文件
+    model = load_prepared_model(
+        subdir, fixed_color="#00FF00" if subdir == "bus_new_jersy" else None, gtfs_dir="GTFS"
     )
-    df = df.merge(
-        routes[["route_id", "route_long_name", "route_color"]],
-        left_on="route_id",
-        right_on="route_id",
-        how="left",
+    if model is None:
+        raise FileNotFoundError(f"GTFS tables missing under GTFS/{subdir}")
+    feed_models[subdir] = model
+
+# 服务日历（scripts/gtfs_calendar.py）：地图只用当天在跑的 trips
+calendars = {subdir: load_calendar(subdir, feed_models[subdir].trips, gtfs_dir="GTFS") for subdir in SUBFILES}
+_active_sets = {}
+
+
+def _active(subdir: str):
+    """(working model, schedule index) of today's service day; switches over after midnight."""
+    day = service_date()
+    service_day = calendars[subdir].service_day(day) if day else None
+    key = (subdir, service_day.key if service_day else None)
+    entry = _active_sets.get(key)
+    if entry is None:
+        model = working_model(feed_models[subdir], service_day)
+        entry = (model, build_schedule_index(model, service_day))
+        # 同一 feed 只留当天的工作集
+        for old in [k for k in _active_sets if k[0] == subdir]:
+            _active_sets.pop(old, None)
+        _active_sets[key] = entry
+    return entry
+
+
+def active_model(subdir: str):
+    return _active(subdir)[0]
+
+
+def scheduled_departures(subdir: str, route, stop_ids) -> pd.Series:
+    """Next scheduled departure ("HH:MM (scheduled)") per stop, the fallback when realtime has no data."""
+    secs = _active(subdir)[1].next_departures(str(route), stop_ids.astype(str).to_numpy(), seconds_now())
+    return pd.Series(
+        [f"{format_seconds(t)} (scheduled)" if t >= 0 else "N/A" for t in secs.tolist()],
+        index=stop_ids.index,
     )
 
-    route_color_mapping = (
-        df.set_index("route_id")["route_color"]
-        .fillna("000000")
-        .astype(str)
-        .apply(lambda x: "#" + x)
-        .to_dict()
-    )
-    df["color"] = df["route_id"].map(route_color_mapping)
-    dataframes[subdir] = df
-
-dataframes["bus_new_jersy"]["color"] = "#00FF00"
 BOROUGHS = ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten_Island", "New_Jersy"]
 CITIBIKE_REGIONS = ["NYC District", "JC District", "Hoboken District"]
-SUBWAY_ID = dataframes["subway"]["route_id"].unique()
-BUS_BRONX_ROUTE = dataframes["bus_bronx"]["route_id"].unique()
-BUS_BROOKLYN_ROUTE = dataframes["bus_brooklyn"]["route_id"].unique()
-BUS_MANHATTAN_ROUTE = dataframes["bus_manhattan"]["route_id"].unique()
-BUS_QUEENS_ROUTE = dataframes["bus_queens"]["route_id"].unique()
-BUS_STATEN_ISLAND_ROUTE = dataframes["bus_staten_island"]["route_id"].unique()
-BUS_NEW_JERSY_ROUTE = dataframes["bus_new_jersy"]["route_id"].unique()
-BUS_LIRR_ROUTE = dataframes["LIRR"]["route_id"].unique()
-MNR_ROUTE = dataframes["MNR"]["route_id"].unique()
-NJ_RAIL_ROUTE = dataframes["NJ_rail"]["route_id"].unique()
+SUBWAY_ID = feed_models["subway"].route_ids()
+BUS_BRONX_ROUTE = feed_models["bus_bronx"].route_ids()
+BUS_BROOKLYN_ROUTE = feed_models["bus_brooklyn"].route_ids()
+BUS_MANHATTAN_ROUTE = feed_models["bus_manhattan"].route_ids()
+BUS_QUEENS_ROUTE = feed_models["bus_queens"].route_ids()
+BUS_STATEN_ISLAND_ROUTE = feed_models["bus_staten_island"].route_ids()
+BUS_NEW_JERSY_ROUTE = feed_models["bus_new_jersy"].route_ids()
+BUS_LIRR_ROUTE = feed_models["LIRR"].route_ids()
+MNR_ROUTE = feed_models["MNR"].route_ids()
+NJ_RAIL_ROUTE = feed_models["NJ_rail"].route_ids()
 BUS_ROUTE_MAPPING = {
     "Bronx": BUS_BRONX_ROUTE,
     "Brooklyn": BUS_BROOKLYN_ROUTE,
@@ -112,6 +114,7 @@ MAP_DIR_MAPPING = {
         "assets", "bus_mapping", "bus_staten_island.html"
     ),
     "bus_new_jersy": os.path.join("assets", "bus_mapping", "bus_new_jersy.html"),
+    "bus_all": os.path.join("assets", "bus_mapping", "bus_all.html"),
     "citibike": os.path.join("assets", "citibike_mapping", "citibike.html"),
 }
 
@@ -129,6 +132,14 @@ CITIBIKE_REGIONS_COLORING_LIGHT = {
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
 server = app.server
+
+
+# 本地矢量瓦片（scripts/vector_tiles.py），地图 iframe 同源请求
+@server.route("/tiles/<path:tile_path>")
+def serve_tiles(tile_path):
+    status, headers, body = tile_response(f"/tiles/{tile_path}", request.host_url)
+    return Response(body, status=status, headers=headers)
+
 app.layout = html.Div(
     style={
         "min-height": "100vh",
@@ -257,6 +268,12 @@ app.layout = html.Div(
                                             style={"margin": "1.25%"},
                                             n_clicks=0,
                                         ),
+                                        html.Button(
+                                            "All (vector tiles)",
+                                            id="bus_all_btn",
+                                            style={"margin": "1.25%"},
+                                            n_clicks=0,
+                                        ),
                                         dcc.Store(
                                             id="button_store",
                                             data=os.path.join(
@@ -332,17 +349,28 @@ app.clientside_callback(
 
 
 def filter_feed_df(schedule_feed_df: pd.DataFrame) -> pd.DataFrame:
+    schedule_feed_df["route"] = schedule_feed_df["route"].astype(str)
+    schedule_feed_df["stop_id"] = schedule_feed_df["stop_id"].astype(str)
+    # realtime times arrive as int64 epoch seconds (0 = missing); convert to local time
+    for col in ["arrival_time", "departure_time"]:
+        if pd.api.types.is_numeric_dtype(schedule_feed_df[col]):
+            secs = schedule_feed_df[col].where(schedule_feed_df[col] > 0)
+            schedule_feed_df[col] = (
+                pd.to_datetime(secs, unit="s", utc=True)
+                .dt.tz_convert("America/New_York")
+                .dt.tz_localize(None)
+            )
     # if arrival time is invalid fill with departure time
     mask = (schedule_feed_df["arrival_time"].isna()) | (
         pd.to_datetime(schedule_feed_df["arrival_time"])
-        < datetime.now().replace(hour=0, minute=0, second=0)
+        < pd.Timestamp.now(tz="America/New_York").tz_localize(None).normalize()
     )
     schedule_feed_df.loc[mask, "arrival_time"] = schedule_feed_df.loc[
         mask, "departure_time"
     ]
     mask = (schedule_feed_df["departure_time"].isna()) | (
         pd.to_datetime(schedule_feed_df["departure_time"])
-        < datetime.now().replace(hour=0, minute=0, second=0)
+        < pd.Timestamp.now(tz="America/New_York").tz_localize(None).normalize()
     )
     # drop invalid rows
     schedule_feed_df.loc[mask, "departure_time"] = schedule_feed_df.loc[
@@ -361,24 +389,36 @@ def filter_feed_df(schedule_feed_df: pd.DataFrame) -> pd.DataFrame:
     return schedule_feed_df
 
 
+def _hover_data(df: pd.DataFrame, columns: list) -> list:
+    """customdata of a hovertemplate: one row of strings per point, missing values as "N/A"."""
+    # 时间列整列 strftime（逐个 Timestamp 转 str 很慢）
+    data = {
+        c: df[c].dt.strftime("%Y-%m-%d %H:%M:%S") if pd.api.types.is_datetime64_any_dtype(df[c]) else df[c]
+        for c in columns
+    }
+    return pd.DataFrame(data).astype(object).fillna("N/A").astype(str).to_numpy()
+
+
 def init_bus_map(schedule_feed_df: pd.DataFrame) -> dict:
     bus_trace_dict = {}
-    schedule_feed_df["stop_id"] = schedule_feed_df["stop_id"].astype("int")
+    schedule_feed_df["stop_id"] = schedule_feed_df["stop_id"].astype(str)
     for borough in BOROUGHS:
         bus_borough_traces = []
-        borough_bus_df = dataframes[f"bus_{borough.lower()}"][
-            [
-                "route_id",
-                "stop_id",
-                "stop_lat",
-                "stop_lon",
-                "stop_sequence",
-                "color",
-                "stop_name",
-            ]
-        ].drop_duplicates(subset=["route_id", "stop_id", "stop_sequence"])
-        for route in borough_bus_df["route_id"].unique():
-            route_bus_df = borough_bus_df[borough_bus_df["route_id"] == route].copy()
+        borough_model = active_model(f"bus_{borough.lower()}")
+        for route in borough_model.route_ids():
+            route_bus_df = borough_model.route_stop_frame(
+                route,
+                [
+                    "route_id",
+                    "stop_id",
+                    "stop_lat",
+                    "stop_lon",
+                    "stop_sequence",
+                    "color",
+                    "stop_name",
+                ],
+                by_sequence=True,
+            )
             # using sequence value to find the next stop position
             route_bus_df.loc[:, "next_sequence"] = route_bus_df["stop_sequence"].shift(
                 -1
@@ -397,6 +437,11 @@ def init_bus_map(schedule_feed_df: pd.DataFrame) -> dict:
                 left_on=["stop_id"],
                 right_on=["stop_id"],
             )["arrival_time"]
+            if route_bus_schedule_df.empty:
+                # 实时 feed 没有这条线路：用时刻表的下一班
+                route_bus_df["arrival_time"] = scheduled_departures(
+                    f"bus_{borough.lower()}", route, route_bus_df["stop_id"]
+                )
             route_bus_df["arrival_time"] = route_bus_df["arrival_time"].fillna("N/A")
             subroute_idx = route_bus_df[
                 (~route_bus_df["next_sequence"].isna())
@@ -422,6 +467,11 @@ def init_bus_map(schedule_feed_df: pd.DataFrame) -> dict:
             color = route_bus_df["color"].iloc[0]
             if color == "#000000":
                 color = "blue"
+            # hover 文字的格式只写一次（hovertemplate），逐点只带 customdata
+            bus_hover = (
+                f"Route: {route}<br>Stop Name: %{{customdata[0]}}"
+                "<br>Next Arrival Time: %{customdata[1]}<extra></extra>"
+            )
             bus_borough_traces.extend(
                 [
                     go.Scattermapbox(
@@ -429,12 +479,8 @@ def init_bus_map(schedule_feed_df: pd.DataFrame) -> dict:
                         lat=subroute_df["stop_lat"],
                         mode="markers+lines",
                         marker=dict(symbol="circle", color="white", size=4),
-                        text=subroute_df.apply(
-                            lambda x: f"""Route: {route} <br> Stop Name: {x['stop_name']} 
-                                        <br> Next Arrival Time: {x['arrival_time']}""",
-                            axis=1,
-                        ),
-                        hoverinfo="text",
+                        customdata=_hover_data(subroute_df, ["stop_name", "arrival_time"]),
+                        hovertemplate=bus_hover,
                         line=dict(width=3, color=color),
                         legendgroup=f"bus_{route}",
                         legendgrouptitle={"text": f"bus route: {route}"},
@@ -450,10 +496,10 @@ def init_bus_map(schedule_feed_df: pd.DataFrame) -> dict:
 
 def init_subway_map(schedule_feed_df: pd.DataFrame) -> dict:
     subway_trace_dict = {}
-    subway_df = dataframes["subway"]
-    for route in SUBWAY_ID:
-        subway_route_df = subway_df.loc[subway_df["route_id"] == route]
-        subway_route_df = subway_route_df.drop_duplicates(subset=["stop_id"])[
+    subway_model = active_model("subway")
+    for route in subway_model.route_ids():
+        subway_route_df = subway_model.route_stop_frame(
+            route,
             [
                 "route_id",
                 "stop_sequence",
@@ -463,14 +509,19 @@ def init_subway_map(schedule_feed_df: pd.DataFrame) -> dict:
                 "route_long_name",
                 "color",
                 "stop_name",
-            ]
-        ]
+            ],
+        )
         subway_route_df = subway_route_df.merge(
             schedule_feed_df,
             how="left",
             left_on=["route_id", "stop_id"],
             right_on=["route", "stop_id"],
         )
+        if subway_route_df["arrival_time"].isna().all():
+            # 实时 feed 没有这条线路：用时刻表的下一班
+            planned = scheduled_departures("subway", route, subway_route_df["stop_id"])
+            subway_route_df["arrival_time"] = planned
+            subway_route_df["departure_time"] = planned
         subway_route_df["next_stop_sequence"] = subway_route_df.shift(-1)[
             "stop_sequence"
         ]
@@ -495,19 +546,18 @@ def init_subway_map(schedule_feed_df: pd.DataFrame) -> dict:
         color = subway_route_df["color"].iloc[0]
         if color == "#000000":
             color = "blue"
+        subway_hover = (
+            f"Route: {subway_route_df['route_long_name'].iloc[0]}<br>Stop Name: %{{customdata[0]}}"
+            "<br>Next Arrival Time: %{customdata[1]}<br>Next Departure Time: %{customdata[2]}<extra></extra>"
+        )
         subway_route_traces = [
             go.Scattermapbox(
                 lon=subroute_df["stop_lon"],
                 lat=subroute_df["stop_lat"],
                 mode="markers+lines",
                 marker=dict(symbol="circle", color="white", size=4),
-                text=subroute_df.apply(
-                    lambda x: f"""Route: {x['route_long_name']} <br> Stop Name: {x['stop_name']} 
-                                <br> Next Arrival Time: {x['arrival_time']} 
-                                <br> Next Departure Time: {x['departure_time']}""",
-                    axis=1,
-                ),
-                hoverinfo="text",
+                customdata=_hover_data(subroute_df, ["stop_name", "arrival_time", "departure_time"]),
+                hovertemplate=subway_hover,
                 line=dict(width=3, color=color),
                 legendgroup=f"subway_{route}",
                 legendgrouptitle={"text": f"subway route: {route}"},
@@ -522,11 +572,11 @@ def init_subway_map(schedule_feed_df: pd.DataFrame) -> dict:
 
 def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
     LIRR_trace_dict = {}
-    LIRR_df = dataframes["LIRR"]
+    LIRR_model = active_model("LIRR")
 
-    # 类型统一（若不存在这些列，astype 会报错；若你确信存在可保留）
-    schedule_feed_df[["stop_id"]] = schedule_feed_df[["stop_id"]].astype("int64")
-    schedule_feed_df[["route"]]   = schedule_feed_df[["route"]].astype("int64")
+    # 类型统一：静态表的 ID 是字符串（categorical），实时侧也按字符串对齐
+    schedule_feed_df[["stop_id"]] = schedule_feed_df[["stop_id"]].astype(str)
+    schedule_feed_df[["route"]]   = schedule_feed_df[["route"]].astype(str)
 
     # 小工具：安全取颜色
     def _safe_color(df, default="#2E86DE"):
@@ -546,9 +596,9 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
             return "blue"
         return val
 
-    for route in BUS_LIRR_ROUTE:
+    for route in LIRR_model.route_ids():
         # 1) 先取该 route 的 LIRR 静态数据
-        LIRR_route_df = LIRR_df.loc[LIRR_df["route_id"] == route].copy()
+        LIRR_route_df = LIRR_model.route_frame(route)
 
         # 判空：该 route 没静态点位就跳过
         if LIRR_route_df is None or LIRR_route_df.empty:
@@ -557,7 +607,7 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
             continue
 
         # 衔接上一站/序号断裂判断
-        LIRR_route_df["last_stop_id"] = LIRR_route_df.shift(+1)["stop_id"]
+        LIRR_route_df["last_stop_id"] = LIRR_route_df["stop_id"].astype(str).shift(+1)
         LIRR_route_df["last_stop_sequence"] = LIRR_route_df.shift(+1)["stop_sequence"]
         LIRR_route_df.loc[
             (
@@ -569,10 +619,8 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
                 | pd.isna(LIRR_route_df["last_stop_sequence"])
             ),
             "last_stop_id",
-        ] = -1
-        LIRR_route_df["last_stop_id"] = (
-            LIRR_route_df["last_stop_id"].fillna(-1).astype("int64")
-        )
+        ] = "-1"
+        LIRR_route_df["last_stop_id"] = LIRR_route_df["last_stop_id"].fillna("-1")
 
         # 去重并只保留必要列（兼容 route_color 缺失）
         keep_cols = [
@@ -617,10 +665,10 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
                 for (i, j) in zip([-1] + list(LIRR_subroute_idx), LIRR_subroute_idx)
             ]
             for i, subroute in enumerate(LIRR_subroute):
-                if len(subroute) > 0 and subroute.loc[0, "last_stop_id"] != -1:
+                if len(subroute) > 0 and subroute.loc[0, "last_stop_id"] != "-1":
                     LIRR_subroute[i] = pd.concat(
                         [
-                            merged.loc[merged["stop_id"] == subroute.loc[0, "last_stop_id"]],
+                            merged.loc[merged["stop_id"].astype(str) == subroute.loc[0, "last_stop_id"]],
                             subroute,
                         ],
                         ignore_index=True,
@@ -629,6 +677,12 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
         # 颜色（安全）
         color = _safe_color(merged)
 
+        # hover：格式在 hovertemplate，逐点只带 customdata
+        LIRR_hover = (
+            f"Route: {merged['route_long_name'].iloc[0]} <br>Stop Name: %{{customdata[0]}} <br>"
+            "Next Arrival Time: %{customdata[1]} <br>Next Departure Time: %{customdata[2]}<extra></extra>"
+        )
+
         # 构造图层（仍用 Scattermapbox，先跑通）
         subway_route_traces = [
             go.Scattermapbox(
@@ -636,16 +690,8 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
                 lat=subroute_df["stop_lat"],
                 mode="markers+lines",
                 marker=dict(symbol="circle", color="white", size=4),
-                text=subroute_df.apply(
-                    lambda x: (
-                        f"Route: {x.get('route_long_name','')} <br>"
-                        f"Stop Name: {x.get('stop_name','')} <br>"
-                        f"Next Arrival Time: {x.get('arrival_time','')} <br>"
-                        f"Next Departure Time: {x.get('departure_time','')}"
-                    ),
-                    axis=1,
-                ),
-                hoverinfo="text",
+                customdata=_hover_data(subroute_df, ["stop_name", "arrival_time", "departure_time"]),
+                hovertemplate=LIRR_hover,
                 line=dict(width=3, color=color),
                 legendgroup=f"subway_{route}",
                 legendgrouptitle={"text": f"subway route: {route}"},
@@ -663,57 +709,19 @@ def init_LIRR_map(schedule_feed_df: pd.DataFrame) -> dict:
     return LIRR_trace_dict
 
 
-def citibike_station_data():
-    station_info_url = "https://gbfs.citibikenyc.com/gbfs/en/station_information.json"
-    info_response = urllib.request.urlopen(station_info_url)
-    data_info = json.load(info_response)
-
-    station_status_url = "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
-    status_response = urllib.request.urlopen(station_status_url)
-    data_status = json.load(status_response)
-
-    system_regions_url = "https://gbfs.citibikenyc.com/gbfs/en/system_regions.json"
-    regions_response = urllib.request.urlopen(system_regions_url)
-    data_regions = json.load(regions_response)
-
-    info_df = pd.DataFrame(data_info["data"]["stations"]).set_index("station_id")
-    info_df = info_df[["name", "lat", "lon", "capacity", "region_id"]]
-
-    status_df = pd.DataFrame(data_status["data"]["stations"]).set_index("station_id")
-    status_df = status_df[
-        [
-            "num_docks_available",
-            "num_bikes_disabled",
-            "num_ebikes_available",
-            "num_bikes_available",
-            "num_docks_disabled",
-            "is_renting",
-            "is_returning",
-            "last_reported",
-            "is_installed",
-        ]
-    ]
-
-    regions_df = pd.DataFrame(data_regions["data"]["regions"])
-    regions_df.rename(columns={"name": "region_name"}, inplace=True)
-
-    citibike_df = info_df.merge(status_df, left_index=True, right_index=True)
-    citibike_df = citibike_df.merge(
-        regions_df[["region_id", "region_name"]],
-        left_on="region_id",
-        right_on="region_id",
-    )
-    return citibike_df
+def citibike_station_data() -> pd.DataFrame:
+    # 后台 poller 每 120s 刷新一次 GBFS；冷启动超时 / 首轮失败时还没有数据
+    df = current_snapshot(wait_keys=("citibike",)).get("citibike")
+    return df if df is not None else pd.DataFrame(columns=CITIBIKE_COLUMNS)
 
 
 def init_citibike_map() -> dict:
     citibike_trace_dict = {}
     citibike_df = citibike_station_data()
-    assert type(citibike_df) is pd.DataFrame
     citibike_df = citibike_df.sort_values(
         by=["lat", "lon", "last_reported"], ascending=False
-    ).drop_duplicates(["lat", "lon"])[
-        [
+    ).drop_duplicates(["lat", "lon"]).reindex(
+        columns=[
             "name",
             "lat",
             "lon",
@@ -724,38 +732,45 @@ def init_citibike_map() -> dict:
             "num_ebikes_available",
             "last_reported",
         ]
-    ]
+    )
 
+    # 所有区域的颜色、hover 数据一次算完（向量化），各区域只按 mask 取
+    colors = citibike_colors(
+        citibike_df["region_name"],
+        citibike_df["num_bikes_available"],
+        CITIBIKE_REGIONS_COLORING_DARK,
+        CITIBIKE_REGIONS_COLORING_LIGHT,
+    )
+    citibike_df["last_reported"] = (
+        pd.to_datetime(citibike_df["last_reported"], unit="s", utc=True)
+        .dt.tz_convert("America/New_York")
+        .dt.tz_localize(None)
+    )
+    customdata = _hover_data(
+        citibike_df,
+        [
+            "name",
+            "num_docks_available",
+            "num_ebikes_available",
+            "num_bikes_available",
+            "last_reported",
+        ],
+    )
+    region_names = citibike_df["region_name"].to_numpy(dtype=object)
     for region in CITIBIKE_REGIONS:
-        citibike_region_df = citibike_df.loc[
-            citibike_df["region_name"] == region
-        ].copy()
-        dark_color = CITIBIKE_REGIONS_COLORING_DARK[region]
-        light_color = CITIBIKE_REGIONS_COLORING_LIGHT[region]
-        citibike_region_df["color"] = citibike_region_df.apply(
-            lambda x: f"rgba{color_interpolation(
-                dark_color,
-                light_color,
-                min(x["num_bikes_available"], 80) / 80,
-            )}",
-            axis=1,
-        )
-        citibike_region_df["last_reported"] = citibike_region_df["last_reported"].apply(
-            lambda x: datetime.fromtimestamp(int(x))
-        )
+        mask = region_names == region
         region_trace = go.Scattermapbox(
-            lon=citibike_region_df["lon"],
-            lat=citibike_region_df["lat"],
+            lon=citibike_df["lon"].to_numpy()[mask],
+            lat=citibike_df["lat"].to_numpy()[mask],
             mode="markers",
             marker=dict(
                 size=13,
-                color=citibike_region_df["color"],
+                color=colors[mask],
             ),
-            text=citibike_region_df.apply(
-                lambda x: f"""Name: {x['name']} <br> Available Docks: {x['num_docks_available']} 
-                <br> Available eBikes: {x['num_ebikes_available']} <br> Available Bikes: {x['num_bikes_available']}
-                <br> Last Reported: {x['last_reported']}""",
-                axis=1,
+            customdata=customdata[mask],
+            hovertemplate=(
+                "Name: %{customdata[0]} <br> Available Docks: %{customdata[1]} <br> Available eBikes: %{customdata[2]}"
+                " <br> Available Bikes: %{customdata[3]} <br> Last Reported: %{customdata[4]}"
             ),
             legendgroup=f"citibike_{region}",
             legendgrouptitle={"text": region},
@@ -767,9 +782,9 @@ def init_citibike_map() -> dict:
 
 def init_MNR_map(schedule_feed_df: pd.DataFrame) -> dict:
     MNR_trace_dict = {}
-    MNR_df = dataframes["MNR"]
+    MNR_model = active_model("MNR")
     # for route in MNR_ROUTE:
-    #     MNR_route_df = MNR_df.loc[MNR_df["route_id"] == route].copy()
+    #     MNR_route_df = MNR_model.route_frame(route)
     #     MNR_route_df = MNR_route_df.drop_duplicates(["stop_id"])
     #     MNR_route_df.merge(schedule_feed_df, on=["route", ""])
     
@@ -799,17 +814,65 @@ def init_default_map() -> go.Figure:
     )
 
 
+# 静态路网 HTML 上次按哪个 (dataset, 各 feed 服务日 key) 生成的
+_network_maps = {}
+
+
+def init_bus_network_map() -> None:
+    """All bus feeds as vector tiles: static network only, the browser fetches the visible tiles."""
+    subdirs = [f"bus_{b.lower()}" for b in BOROUGHS]
+    day = service_date()
+    days = {s: calendars[s].service_day(day) if day else None for s in subdirs}
+    key = tuple(days[s].key if days[s] else None for s in subdirs)
+    # 同一服务日内每次刷新都一样：不再查瓦片、不再重写 HTML
+    if _network_maps.get("bus") == key and os.path.exists(MAP_DIR_MAPPING["bus_all"]):
+        return
+    path = compile_tiles(
+        "bus",
+        subdirs,
+        gtfs_dir="GTFS",
+        days=days,
+        colors={"bus_new_jersy": {"fixed_color": "#00FF00"}},
+    )
+    fig = go.Figure()
+    fig.update_layout(
+        mapbox={
+            "center": {"lat": 40.7128, "lon": -73.95},
+            "style": "carto-darkmatter",
+            "zoom": 10,
+            "layers": map_layers(path, f"/tiles/{path.stem}.json") if path else [],
+        },
+        margin=dict(l=0, r=0, b=0, t=0),
+        showlegend=False,
+    )
+    fig.add_trace(go.Scattermapbox(lon=[], lat=[], mode="lines", hoverinfo="skip"))
+    pio.write_html(
+        fig,
+        MAP_DIR_MAPPING["bus_all"],
+        auto_open=False,
+        include_plotlyjs="cdn",
+        full_html=False,
+    )
+    _network_maps["bus"] = key
+
+
 @app.callback(Input("refresh_interval", "n_intervals"))
 def generate_gtfs_map(n) -> go.Figure:
-    subway_schedule_feed_df = filter_feed_df(pd.DataFrame(get_subway_schedule()))
-    bus_schedule_feed_df = filter_feed_df(pd.DataFrame(get_bus_schedule()))
-    LIRR_schedule_feed_df = filter_feed_df(pd.DataFrame(get_LIRR_schedule()))
-    MNR_schedule_feed_df = filter_feed_df(pd.DataFrame(get_MNR_schedule()))
+    # 实时数据来自后台 poller 的共享快照，回调里不再同步请求 MTA API
+    snap = current_snapshot(wait_keys=("next_arrivals", "citibike"))
+    # next arrival per (route, stop), maintained incrementally by the poller
+    schedules = snap.get("next_arrivals") or {}
+    subway_schedule_feed_df = filter_feed_df(pd.DataFrame(schedules.get("subway", []), columns=SCHEDULE_COLUMNS))
+    bus_schedule_feed_df = filter_feed_df(pd.DataFrame(schedules.get("bus", []), columns=SCHEDULE_COLUMNS))
+    LIRR_schedule_feed_df = filter_feed_df(pd.DataFrame(schedules.get("lirr", []), columns=SCHEDULE_COLUMNS))
+    MNR_schedule_feed_df = filter_feed_df(pd.DataFrame(schedules.get("mnr", []), columns=SCHEDULE_COLUMNS))
     bus_traces = init_bus_map(bus_schedule_feed_df)
     subway_traces = init_subway_map(subway_schedule_feed_df)
     LIRR_traces = init_LIRR_map(LIRR_schedule_feed_df)
     MNR_traces = init_MNR_map(MNR_schedule_feed_df)
     citibike_traces = init_citibike_map()
+    # 瓦片按服务日 key 复用，过了午夜才会重新切片
+    init_bus_network_map()
     for borough in bus_traces.keys():
         fig = go.Figure()
         fig.update_layout(
@@ -905,9 +968,10 @@ def generate_gtfs_map(n) -> go.Figure:
     Input("bus_queens_btn", "n_clicks"),
     Input("bus_staten_island_btn", "n_clicks"),
     Input("bus_new_jersy_btn", "n_clicks"),
+    Input("bus_all_btn", "n_clicks"),
 )
 def handle_button_clicked(
-    btn_1, btn_2, btn_3, btn_4, btn_5, btn_6, btn_7, btn_8, btn_9
+    btn_1, btn_2, btn_3, btn_4, btn_5, btn_6, btn_7, btn_8, btn_9, btn_10
 ):
     ctx = callback_context
     if not ctx.triggered:
@@ -3,28 +3,31 @@ from __future__ import annotations
 from pathlib import Path
 import os
 import streamlit as st
-import json
-import urllib.request as urlreq
 import inspect
-from datetime import datetime
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
-# ====== GTFS bootstrap（Cloud 自动下载解压；本地已有则跳过）======
-from scripts.gtfs_release import ensure_gtfs_from_github_release
+# ====== GTFS bootstrap（本地已解压的 GTFS/ 优先；否则直接读 release zip，不解压）======
+from scripts.gtfs_release import sync_gtfs_archive
+from scripts.gtfs_source import GTFSArchive
+from scripts.gtfs_versions import Dataset, DatasetManager, current_version, get_manager, version_source
 
 GTFS_ASSET_URL = "https://github.com/yh3952-pixel/gtfs-dashboard333/releases/download/GTFS/GTFS.zip"
 ROOT = Path(__file__).resolve().parent
 GTFS_DIR = ROOT / "GTFS"
+GTFS_ZIP = ROOT / "cache" / "GTFS.zip"
+LOCAL_VERSION = "local"  # 本地解压的 GTFS/ 目录不分版本
 
-def gtfs_layout_ok(p: Path) -> bool:
-    return (
-        (p / "subway").is_dir()
-        or (p / "LIRR").is_dir()
-        or (p / "MNR").is_dir()
-        or any(d.is_dir() for d in p.glob("bus_*"))
-    )
+def gtfs_layout_ok(p) -> bool:
+    if not p.exists():
+        return False
+    names = [d.name for d in p.iterdir() if d.is_dir()]
+    return any(n in ("subway", "LIRR", "MNR") or n.startswith("bus_") for n in names)
 
 # Streamlit Cloud: token 放 Secrets；本地也可以用环境变量
 github_token = None
@@ -35,36 +38,63 @@ except Exception:
 github_token = github_token or os.getenv("GITHUB_TOKEN")
 
 marker = GTFS_DIR / ".ready"
-need_bootstrap = (not marker.exists()) or (not gtfs_layout_ok(GTFS_DIR))
 
 # ---- 页面配置尽早设置 ----
 st.set_page_config(page_title="Real Time Transportation Dashboard", layout="wide")
 
-if need_bootstrap:
-    st.info("GTFS not ready. Downloading/extracting from GitHub Release...")
+
+@st.cache_resource(show_spinner="Syncing GTFS from GitHub Release...")
+def _datasets(token: str | None) -> DatasetManager:
+    """
+    版本化的数据集（scripts/gtfs_versions.py）：每个进程只对一次 release manifest，
+    数据没变时不下载；之后后台定期检查，新版本准备好后原子切换，不需要重启。
+    """
+    def sync():
+        return sync_gtfs_archive(asset_url=GTFS_ASSET_URL, cache_zip_path=str(GTFS_ZIP), token=token)
+
+    manager = get_manager()
+    res = sync()
+    if res.downloaded or current_version() is None:
+        manager.publish(res.archive.path)
+    manager.start_watcher(sync)
+    return manager
+
+
+# 静态数据源：GTFS/ 目录，或当前版本的 release zip（各 feed 首次打开时才从 zip 里解压读取）
+DATASET = Dataset(LOCAL_VERSION, GTFS_DIR)
+if not (marker.exists() and gtfs_layout_ok(GTFS_DIR)):
     try:
-        msg = ensure_gtfs_from_github_release(
-            asset_url=GTFS_ASSET_URL,
-            gtfs_dir=str(GTFS_DIR),
-            marker_file=str(marker),
-            cache_zip_path="cache/GTFS.zip",
-            token=github_token,
-            force_redownload=True,
-            clean=True,
-        )
-        st.success(msg)
+        active = _datasets(github_token).active()
+        if active is not None and gtfs_layout_ok(active.source):
+            DATASET = active
+        else:
+            st.error("GTFS Download Error: unexpected archive layout")
     except Exception as e:
         st.error(f"GTFS Download Error: {e}")
+GTFS_SOURCE = DATASET.source
+DATASET_VERSION = DATASET.version
 
 # ====== 其他 import（放在 bootstrap 之后）======
 # ====== 实时工具（你的 Streamlit 版 utils）======
 from utils_streamlit import (
-    get_bus_schedule,
-    get_subway_schedule,
-    get_LIRR_schedule,
-    get_MNR_schedule,
-    color_interpolation,
+    MODE_FEEDS,
+    CITIBIKE_COLUMNS,
+    FETCH_DEADLINE,
+    citibike_colors,
 )
+from realtime_poller import current_snapshot, get_poller
+from scripts.gtfs_cache import load_tables, load_trip_stats
+from scripts.gtfs_calendar import ServiceCalendar, ServiceDay, active_route_ids, load_calendar, service_date, working_model
+from scripts.gtfs_model import FeedModel, build_feed_model, empty_model
+from scripts.gtfs_partition import load_route_tables, route_catalog
+from scripts.gtfs_prepare import load_prepared_model, prepare_feeds
+from scripts.route_geometry import lines_at_level, load_route_lines, lod_for_zoom
+from scripts.schedule_index import ScheduleIndex, build_schedule_index, format_seconds, format_seconds_array, seconds_now
+from scripts.spatial_index import SegmentIndex, StopGrid, Viewport, build_segment_index, cull_lines, stop_grid
+from scripts.vector_tiles import compile_tiles, map_layers, start_tile_server, tilejson_url
+
+# 当前服务日（scripts/gtfs_calendar.py）：每次 rerun 重新计算，过了午夜静态缓存的 key 自动换成新的一天
+SERVICE_DATE = service_date()
 
 # ====== 注入 CSS 以减少顶部留白，实现更“全屏”的效果 ======
 st.markdown(
@@ -115,9 +145,6 @@ def st_plotly(fig: go.Figure, config: dict | None = None):
 
 
 # ====== 路径 & 常量 ======
-ROOT = Path(__file__).resolve().parent
-GTFS_DIR = ROOT / "GTFS"
-
 SUBFILES = [
     "bus_bronx",
     "bus_brooklyn",
@@ -130,6 +157,8 @@ SUBFILES = [
     "bus_new_jersy",
 ]
 BOROUGHS = ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten_Island", "New_Jersy"]
+# 全部公交线网：只用矢量瓦片画静态线网（scripts/vector_tiles.py）
+ALL_BOROUGHS = "All (vector tiles)"
 
 BOROUGHS_COORDINATE_MAPPING = {
     "Bronx": [40.837048, -73.865433],
@@ -187,264 +216,366 @@ SUBWAY_OFFICIAL_COLORS = {
 # ======================
 #   数据加载（静态）
 # ======================
-@st.cache_data(show_spinner=False)
-def load_gtfs_tables(subdir: str):
-    folder = GTFS_DIR / subdir
-    need = ["routes.txt", "stop_times.txt", "stops.txt", "trips.txt"]
-    if not (folder.exists() and all((folder / f).exists() for f in need)):
+def _feed_source(version: str, subdir: str):
+    """
+    数据集 version 的 gtfs_dir。缓存都以 version 为 key：新版本切换前旧条目继续服务（双缓冲），
+    切换后旧条目按 max_entries 淘汰。顺便记下本进程用到的 feed，新版本会先在后台准备好它们。
+    """
+    get_manager().note_used(subdir)
+    return GTFS_DIR if version == LOCAL_VERSION else version_source(version)
+
+
+def load_gtfs_tables(version: str, subdir: str, route_ids: tuple[str, ...] = ()):
+    """
+    typed 列式缓存（scripts/gtfs_cache.py）：首次使用时编译，之后直接 memory-map，
+    不再每次冷启动用 dtype=str 解析 CSV。不单独缓存：只有 get_dataset 的紧凑模型常驻。
+    给了 route_ids 时走按线路分区的存储（scripts/gtfs_partition.py），只读这些线路。
+    """
+    try:
+        if route_ids:
+            return load_route_tables(subdir, route_ids, gtfs_dir=_feed_source(version, subdir))
+        return load_tables(subdir, gtfs_dir=_feed_source(version, subdir))
+    except Exception:
+        return None
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _prepared_model(version: str, subdir: str) -> FeedModel:
+    # 整个 feed 的模型（所有 service），数组 memory-map 预构建文件
+    try:
+        model = load_prepared_model(subdir, gtfs_dir=_feed_source(version, subdir), **_feed_colors(subdir))
+    except Exception:
+        model = None
+    return model if model is not None else empty_model()
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _service_calendar(version: str, subdir: str) -> ServiceCalendar:
+    gtfs_dir = _feed_source(version, subdir)
+    trips = load_trip_stats(subdir, gtfs_dir=gtfs_dir)
+    if trips is None:
+        trips = _prepared_model(version, subdir).trips
+    return load_calendar(subdir, trips, gtfs_dir=gtfs_dir)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_service_day(version: str, subdir: str, day: date | None) -> ServiceDay | None:
+    """
+    day 这一服务日在跑的 service（scripts/gtfs_calendar.py）。调用方每次 rerun 传当天的
+    SERVICE_DATE，缓存 key 随之变化：过了午夜自动换成新一天的工作集，不需要重启。
+    """
+    if day is None:
         return None
-    read = lambda f: pd.read_csv(folder / f, dtype=str)  # 强制字符串
     try:
-        routes = read("routes.txt")
-        stop_times = read("stop_times.txt")
-        stops = read("stops.txt")
-        trips = read("trips.txt")
-        return routes, stop_times, stops, trips
+        return _service_calendar(version, subdir).service_day(day)
     except Exception:
         return None
 
 
-@st.cache_resource(show_spinner=False)
-def get_dataset(subdir: str) -> pd.DataFrame:
-    tables = load_gtfs_tables(subdir)
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_dataset(
+    version: str, subdir: str, route_ids: tuple[str, ...] = (), day: date | None = None
+) -> FeedModel:
+    """
+    紧凑的整数编码模型（scripts/gtfs_model.py）代替 trips×stop_times×stops×routes 宽表，
+    站名 / 线路名 / 颜色只在需要时 join。route_ids 非空时只包含这些线路；
+    给了 day 时只保留该服务日在跑的 trips。
+    """
+    service_day = get_service_day(version, subdir, day)
+    if not route_ids:
+        return working_model(_prepared_model(version, subdir), service_day)
+    tables = load_gtfs_tables(version, subdir, route_ids)
     if tables is None:
-        return pd.DataFrame(
-            columns=[
-                "route_id",
-                "service_id",
-                "trip_id",
-                "arrival_time",
-                "departure_time",
-                "stop_sequence",
-                "stop_id",
-                "stop_name",
-                "stop_lat",
-                "stop_lon",
-                "route_long_name",
-                "color",
-            ]
-        )
+        return empty_model()
+    return working_model(build_feed_model(tables, **_feed_colors(subdir)), service_day)
 
-    routes, stop_times, stops, trips = tables
-    df = trips[["route_id", "service_id", "trip_id"]].merge(
-        stop_times[["trip_id", "arrival_time", "departure_time", "stop_sequence", "stop_id"]],
-        on="trip_id",
-        how="left",
-    ).merge(
-        stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]],
-        on="stop_id",
-        how="left",
-    ).merge(
-        routes[["route_id", "route_long_name", "route_color"]],
-        on="route_id",
-        how="left",
-    )
 
-    route_color_mapping = (
-        df.set_index("route_id")["route_color"]
-        .fillna("000000")
-        .astype(str)
-        .apply(lambda x: "#" + x if not x.startswith("#") else x)
-        .to_dict()
+@st.cache_resource(show_spinner=False)
+def start_static_prepare() -> threading.Thread | None:
+    """
+    进程启动时在后台把所有 feed 并行准备好（scripts/gtfs_prepare.py 的进程池，
+    跑在单独的 `python -m scripts.gtfs_prepare` 子进程里，不 fork 本进程）：
+    当前图层仍按需加载，不等其他 feed；之后切换图层只需 memory-map。
+    数据源是 release zip 时不预热：只有用户打开的 feed 才解压。
+    """
+    if isinstance(GTFS_SOURCE, GTFSArchive) or not GTFS_SOURCE.is_dir():
+        return None
+    subdirs = sorted(p.name for p in GTFS_SOURCE.iterdir() if p.is_dir())
+    t = threading.Thread(
+        target=prepare_feeds, args=(subdirs,), kwargs={"gtfs_dir": GTFS_SOURCE},
+        name="gtfs-prepare", daemon=True,
     )
-    df["color"] = df["route_id"].map(route_color_mapping)
+    t.start()
+    return t
+
 
+def _feed_colors(subdir: str) -> dict:
+    """线路颜色的覆盖规则（模型和预构建几何共用）。"""
     if subdir == "subway":
-        def _subway_color(rid: str) -> str:
-            rid = str(rid)
-            if rid in SUBWAY_OFFICIAL_COLORS:
-                return "#" + SUBWAY_OFFICIAL_COLORS[rid]
-            return route_color_mapping.get(rid, "#FFFFFF")
+        return {"color_overrides": {rid: "#" + c for rid, c in SUBWAY_OFFICIAL_COLORS.items()}}
+    if subdir == "bus_new_jersy":
+        return {"fixed_color": "#00FF00"}
+    return {}
 
-        df["color"] = df["route_id"].astype(str).map(_subway_color)
 
-    if subdir == "bus_new_jersy":
-        df["color"] = "#00FF00"
+def _catalog_route_ids(version: str, subdir: str, day: date | None = None) -> list[str]:
+    # 只读 routes.txt（+ trip_stats 过滤当天没有车次的线路），不加载 stop_times
+    try:
+        gtfs_dir = _feed_source(version, subdir)
+        route_ids = route_catalog(subdir, gtfs_dir=gtfs_dir)["route_id"].tolist()
+        service_day = get_service_day(version, subdir, day)
+        trip_stats = load_trip_stats(subdir, gtfs_dir=gtfs_dir) if service_day is not None else None
+    except Exception:
+        return []
+    if trip_stats is None:
+        return route_ids
+    active = active_route_ids(trip_stats, service_day)
+    return [r for r in route_ids if r in active]
 
-    return df
 
+@st.cache_data(show_spinner=False, max_entries=2)
+def get_subway_route_ids(version: str, day: date | None = None) -> list[str]:
+    return _catalog_route_ids(version, "subway", day)
 
-@st.cache_data(show_spinner=False)
-def get_subway_route_ids() -> list[str]:
-    df = get_dataset("subway")
-    if df.empty:
-        return []
-    return sorted(df["route_id"].astype(str).dropna().unique().tolist(), key=str)
 
+@st.cache_data(show_spinner=False, max_entries=2)
+def get_lirr_route_ids(version: str, day: date | None = None) -> list[str]:
+    return _catalog_route_ids(version, "LIRR", day)
 
-@st.cache_data(show_spinner=False)
-def get_lirr_route_ids() -> list[str]:
-    df = get_dataset("LIRR")
-    if df.empty:
-        return []
-    return sorted(df["route_id"].astype(str).dropna().unique().tolist(), key=str)
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_bus_route_ids(version: str, borough: str, day: date | None = None) -> list[str]:
+    return _catalog_route_ids(version, f"bus_{borough.lower()}", day)
 
-@st.cache_data(show_spinner=False)
-def get_bus_route_ids(borough: str) -> list[str]:
-    key = f"bus_{borough.lower()}"
-    df = get_dataset(key)
-    if df.empty:
-        return []
-    return sorted(df["route_id"].astype(str).dropna().unique().tolist(), key=str)
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_schedule_index(version: str, subdir: str, day: date | None = None) -> ScheduleIndex:
+    """
+    当天时刻表的 (route, stop) -> 有序发车时间索引（scripts/schedule_index.py）：
+    实时 feed 不可用或不含某条线路时，hover 退回到下一班计划发车时间。
+    """
+    return build_schedule_index(get_dataset(version, subdir, (), day), get_service_day(version, subdir, day))
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_stop_grid(version: str, subdir: str, day: date | None = None) -> StopGrid:
+    # 只索引当天有班次的站（scripts/spatial_index.py），返回 stop_idx
+    served = get_schedule_index(version, subdir, day).served_stops()
+    return stop_grid(get_dataset(version, subdir, (), day).stops, served)
+
+
+def stops_near(subdir: str, lat: float, lon: float, k: int, realtime: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    离 (lat, lon) 最近的 k 个站，以及经过每个站的线路的下一班：
+    实时 feed 有就用实时到站，否则用时刻表。
+    """
+    stop_idx, dist = get_stop_grid(DATASET_VERSION, subdir, SERVICE_DATE).nearest(lat, lon, k)
+    stops = get_dataset(DATASET_VERSION, subdir, (), SERVICE_DATE).stops
+    nxt = get_schedule_index(DATASET_VERSION, subdir, SERVICE_DATE).next_at_stops(stop_idx, seconds_now())
+    near = pd.DataFrame(
+        {
+            "stop_id": stops["stop_id"].to_numpy()[stop_idx],
+            "Stop": stops["stop_name"].to_numpy()[stop_idx],
+            "Distance (m)": np.round(dist).astype(int),
+        }
+    )
+    out = near.merge(nxt, on="stop_id", how="left")
+    out["Next"] = [format_seconds(t) + " (scheduled)" if t >= 0 else "N/A" for t in out["next"].fillna(-1).astype(int)]
+    if realtime is not None and not realtime.empty:
+        rt = realtime_labels(realtime)
+        live = [rt.get((str(r), str(s))) for r, s in zip(out["route_id"], out["stop_id"])]
+        out["Next"] = [l if l is not None else n for l, n in zip(live, out["Next"])]
+    out = out.rename(columns={"route_id": "Route"})
+    return out[["Stop", "Distance (m)", "Route", "Next"]]
 
 
 # =========================
 #   实时 feed（核心修复：强制 UTC->NY 转换）
 # =========================
+def _epoch_seconds(col: pd.Series) -> np.ndarray:
+    """int64 epoch 秒；缺失 / 无法解析为 0。"""
+    if pd.api.types.is_numeric_dtype(col):
+        return col.fillna(0).to_numpy(dtype=np.int64)
+    ts = pd.to_datetime(col, utc=True, errors="coerce")
+    secs = (ts - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    return secs.fillna(0).to_numpy(dtype=np.int64)
+
+
 def filter_feed_df(df: pd.DataFrame) -> pd.DataFrame:
     """
     稳健过滤：仅保留“现在之后”的最近一班。
-    【重要修复】使用 utc=True 统一接管时区解析，确保 UTC 时间正确转换为 America/New_York。
+    全程在 int64 epoch 秒上比较 / 排序；只有最终每个 (route, stop) 的那一行
+    才转换成 America/New_York 的 naive datetime 用于显示。
     """
     if df is None or df.empty:
         return pd.DataFrame(columns=["route", "stop_id", "arrival_time", "departure_time"])
 
-    df = df.copy()
-    df["route"] = df["route"].astype(str)
-    df["stop_id"] = df["stop_id"].astype(str)
-    
-    # 目标时区
-    target_tz = "America/New_York"
-
-    for col in ["arrival_time", "departure_time"]:
-        # 1. 强制解析为 UTC (utc=True)。
-        #    - 如果输入是 Unix Timestamp (数字)，结合 unit='s' 会被正确解析为 UTC 时间。
-        #    - 如果输入是 Naive 字符串 (20:00)，会被视为 UTC (20:00+00:00)。
-        if pd.api.types.is_numeric_dtype(df[col]):
-            df[col] = pd.to_datetime(df[col], unit='s', utc=True, errors="coerce")
-        else:
-            df[col] = pd.to_datetime(df[col], utc=True, errors="coerce")
-            
-        # 2. 转换到 New York 时间 (此时会自动减去 5 或 4 小时)
-        df[col] = df[col].dt.tz_convert(target_tz)
-        
-        # 3. 移除时区信息 (变成 Naive Local Time) 以便于显示和对齐
-        df[col] = df[col].dt.tz_localize(None)
-
-    # 获取当前 NY 时间 (Naive)
-    now = pd.Timestamp.now(tz=target_tz).tz_localize(None)
-    
-    df["when"] = df["arrival_time"].fillna(df["departure_time"])
-    df = df.dropna(subset=["when"])
-    
-    # 过滤掉过去的班次
-    df = df[df["when"] >= now]
-
-    if df.empty:
+    arr = _epoch_seconds(df["arrival_time"])
+    dep = _epoch_seconds(df["departure_time"])
+    when = np.where(arr > 0, arr, dep)
+
+    # 过滤掉过去的班次（以及两个时间都缺失的行）
+    now = int(pd.Timestamp.now(tz="UTC").timestamp())
+    keep = np.flatnonzero(when >= now)
+    if len(keep) == 0:
         return pd.DataFrame(columns=["route", "stop_id", "arrival_time", "departure_time"])
 
-    df = (
-        df.sort_values("when")
-        .groupby(["route", "stop_id"], as_index=False)
-        .first()[["route", "stop_id", "arrival_time", "departure_time"]]
+    keep = keep[np.argsort(when[keep], kind="stable")]
+    head = pd.DataFrame(
+        {
+            "route": df["route"].to_numpy()[keep],
+            "stop_id": df["stop_id"].to_numpy()[keep],
+            "row": keep,
+        }
+    ).drop_duplicates(["route", "stop_id"])
+    rows = head["row"].to_numpy()
+
+    # 目标时区：UTC epoch -> America/New_York -> 去掉时区信息（naive local time）
+    def _to_local(secs: np.ndarray) -> pd.Series:
+        ts = pd.to_datetime(pd.Series(np.where(secs > 0, secs, np.nan)), unit="s", utc=True)
+        return ts.dt.tz_convert("America/New_York").dt.tz_localize(None)
+
+    return pd.DataFrame(
+        {
+            "route": head["route"].astype(str).to_numpy(),
+            "stop_id": head["stop_id"].astype(str).to_numpy(),
+            "arrival_time": _to_local(arr[rows]),
+            "departure_time": _to_local(dep[rows]),
+        }
     )
-    return df
 
 
-@st.cache_data(ttl=30, show_spinner=False)
+def realtime_labels(df: pd.DataFrame) -> dict[tuple[str, str], str]:
+    """
+    (route, stop_id) -> 实时时间文字（整列 strftime）：到站时间缺失时用离站时间，
+    两个都缺失的行不算有实时数据。
+    """
+    def _text(col: str) -> pd.Series:
+        return pd.to_datetime(df[col], errors="coerce").dt.strftime("%Y-%m-%d %H:%M:%S")
+
+    text = _text("arrival_time").fillna(_text("departure_time"))
+    ok = text.notna().to_numpy()
+    keys = zip(df["route"].astype(str).to_numpy()[ok], df["stop_id"].astype(str).to_numpy()[ok])
+    return dict(zip(keys, text.to_numpy()[ok]))
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _filtered_feeds(version: int, _schedules) -> dict[str, pd.DataFrame]:
+    # 按快照版本缓存：同一版本只过滤一次，所有 session 共用。
+    # poller 已经按 (route, stop) 归并成下一班，这里只剔除发布后又过点的行并转时区。
+    return {mode: filter_feed_df(pd.DataFrame(rows)) for mode, rows in _schedules.items()}
+
+
+def fetch_realtime_feeds() -> tuple[dict[str, pd.DataFrame], dict[str, str]]:
+    """
+    实时数据由后台 poller（realtime_poller.py）统一刷新，这里只读当前快照，
+    渲染不再等待 MTA API。返回 ({mode: 过滤后的 df}, {feed: ok/stale/failed})。
+    """
+    snap = current_snapshot(wait_keys=("next_arrivals",))
+    next_arrivals = snap.get("next_arrivals")
+    if next_arrivals is None:
+        empty = filter_feed_df(None)
+        return {mode: empty for mode in MODE_FEEDS}, dict(snap.status)
+    return _filtered_feeds(snap.version, next_arrivals), dict(snap.status)
+
+
 def fetch_subway_feed():
-    return filter_feed_df(pd.DataFrame(get_subway_schedule()))
+    return fetch_realtime_feeds()[0]["subway"]
 
 
-@st.cache_data(ttl=30, show_spinner=False)
 def fetch_bus_feed():
-    return filter_feed_df(pd.DataFrame(get_bus_schedule()))
+    return fetch_realtime_feeds()[0]["bus"]
 
 
-@st.cache_data(ttl=30, show_spinner=False)
 def fetch_lirr_feed():
-    return filter_feed_df(pd.DataFrame(get_LIRR_schedule()))
+    return fetch_realtime_feeds()[0]["lirr"]
 
 
-@st.cache_data(ttl=30, show_spinner=False)
 def fetch_mnr_feed():
-    return filter_feed_df(pd.DataFrame(get_MNR_schedule()))
+    return fetch_realtime_feeds()[0]["mnr"]
+
+
+def show_feed_status(mode: str) -> None:
+    """提示该交通方式下过期 / 失败的子 feed。"""
+    status = fetch_realtime_feeds()[1]
+    names = MODE_FEEDS.get(mode, [])
+    stale = [n for n in names if status.get(n) == "stale"]
+    failed = [n for n in names if status.get(n) == "failed"]
+    if stale:
+        st.caption(f"Stale real-time feeds (showing last good data): {', '.join(stale)}")
+    if failed:
+        st.caption(f"Unavailable real-time feeds: {', '.join(failed)}")
 
 
 # =========================
-#   预计算静态“线路几何”
+#   静态“线路几何”（预构建）
 # =========================
-def precompute_route_lines_df(df: pd.DataFrame) -> dict[str, list[pd.DataFrame]]:
-    if df is None or df.empty:
-        return {}
-    
-    required_cols = ["route_id", "trip_id", "stop_sequence", "stop_id", "stop_lat", "stop_lon"]
-    if not all(col in df.columns for col in required_cols):
+def load_route_lines_df(
+    version: str, subdir: str, route_ids: tuple[str, ...] = (), day: date | None = None
+) -> dict[str, list[pd.DataFrame]]:
+    """
+    预构建的线路几何（scripts/route_geometry.py，离线 `python -m scripts.route_geometry`
+    或首次使用时生成）：只 memory-map 一个小 Arrow 文件，不加载 stop_times；
+    选了线路时只读这些线路的分区。给了 day 时用该服务日的几何（只含当天在跑的 trips）。
+    """
+    try:
+        return load_route_lines(
+            subdir,
+            list(route_ids) or None,
+            gtfs_dir=_feed_source(version, subdir),
+            day=get_service_day(version, subdir, day),
+            **_feed_colors(subdir),
+        )
+    except Exception:
         return {}
 
-    base = df[
-        required_cols + ["route_long_name", "color", "stop_name"]
-    ].dropna(subset=["route_id", "trip_id", "stop_id", "stop_sequence"]).copy()
-
-    for col in ["route_id", "trip_id", "stop_id"]:
-        base[col] = base[col].astype(str)
 
-    counts = base.groupby(["route_id", "trip_id"])["stop_id"].nunique().reset_index(name="n_stops")
-    idx = (
-        counts.sort_values(["route_id", "n_stops"], ascending=[True, False])
-        .groupby("route_id")
-        .head(1)
-    )
-    rep = base.merge(idx[["route_id", "trip_id"]], on=["route_id", "trip_id"], how="inner")
+# max_entries=2：当前版本 / 服务日 + 切换前的上一个
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_subway_lines(version: str, day: date | None = None) -> dict[str, list[pd.DataFrame]]:
+    return load_route_lines_df(version, "subway", day=day)
 
-    res: dict[str, list[pd.DataFrame]] = {}
-    for (rid, _tid), g in rep.groupby(["route_id", "trip_id"], sort=False):
-        g = g.copy()
-        g["stop_sequence"] = pd.to_numeric(g["stop_sequence"], errors="coerce")
-        g = g.dropna(subset=["stop_sequence"]).sort_values("stop_sequence").reset_index(drop=True)
 
-        g["stop_lat"] = pd.to_numeric(g["stop_lat"], errors="coerce")
-        g["stop_lon"] = pd.to_numeric(g["stop_lon"], errors="coerce")
-        g = g.dropna(subset=["stop_lat", "stop_lon"])
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_lirr_lines(version: str, day: date | None = None) -> dict[str, list[pd.DataFrame]]:
+    return load_route_lines_df(version, "LIRR", day=day)
 
-        cut = g["stop_sequence"].diff().fillna(1) != 1
-        seg_id = cut.cumsum()
 
-        subs: list[pd.DataFrame] = []
-        for _, seg in g.groupby(seg_id, sort=False):
-            # 去重坐标
-            seg = seg.loc[~(seg["stop_lat"].diff().fillna(0).eq(0) & seg["stop_lon"].diff().fillna(0).eq(0))]
-            if len(seg) <= 2:
-                continue
-            subs.append(seg)
-
-        res[str(rid)] = subs
-
-    return res
-
-
-@st.cache_resource(show_spinner=False)
-def get_subway_lines() -> dict[str, list[pd.DataFrame]]:
-    return precompute_route_lines_df(get_dataset("subway"))
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_bus_lines(
+    version: str, borough: str, route_ids: tuple[str, ...] = (), day: date | None = None
+) -> dict[str, list[pd.DataFrame]]:
+    return load_route_lines_df(version, f"bus_{borough.lower()}", route_ids, day)
 
 
 @st.cache_resource(show_spinner=False)
-def get_lirr_lines() -> dict[str, list[pd.DataFrame]]:
-    return precompute_route_lines_df(get_dataset("LIRR"))
+def _tile_server():
+    # 每个进程一个本地瓦片服务；端口已被占用时说明另一个进程在服务同一个缓存目录
+    return start_tile_server()
 
 
-@st.cache_resource(show_spinner=False)
-def get_bus_lines(borough: str) -> dict[str, list[pd.DataFrame]]:
-    return precompute_route_lines_df(get_dataset(f"bus_{borough.lower()}"))
+@st.cache_resource(show_spinner="Building vector tiles...", max_entries=2)
+def get_bus_tileset(version: str, day: date | None = None):
+    """
+    全部公交 feed 的 MBTiles（首次使用时切片，之后按内容 key 复用）。
+    浏览器只按视野请求瓦片，画整个线网的代价和线网大小无关。
+    """
+    subdirs = [f"bus_{b.lower()}" for b in BOROUGHS]
+    try:
+        return compile_tiles(
+            "bus",
+            subdirs,
+            gtfs_dir=_feed_source(version, subdirs[0]),
+            days={s: get_service_day(version, s, day) for s in subdirs},
+            colors={s: _feed_colors(s) for s in subdirs},
+        )
+    except Exception:
+        return None
 
 
 # =========================
 #   Plotly MapLibre（Scattermap）绘图工具
 # =========================
-def _default_hover(sub_df: pd.DataFrame) -> list[str]:
-    return [f"Stop: {name}" for name in sub_df["stop_name"].astype(str).tolist()]
-
-
-def _with_arrival_hover(sub_df: pd.DataFrame, schedule_map: dict[tuple[str, str], str], route_id: str) -> list[str]:
-    texts = []
-    for _, row in sub_df[["stop_id", "stop_name"]].iterrows():
-        sid = str(row["stop_id"])
-        arr = schedule_map.get((str(route_id), sid), "N/A")
-        texts.append(f"Stop: {row['stop_name']}<br>Next arrival: {arr}")
-    return texts
-
-
 def _pick_color_from_subs(subs: list[pd.DataFrame]) -> str:
     for s in subs:
         try:
@@ -456,6 +587,45 @@ def _pick_color_from_subs(subs: list[pd.DataFrame]) -> str:
     return "blue"
 
 
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _segment_index(key: tuple, _lines: dict[str, list[pd.DataFrame]]) -> SegmentIndex:
+    # key 与几何缓存的参数一致，_lines 不参与 hash
+    return build_segment_index(_lines)
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _lod_lines(key: tuple, level: int, _lines: dict[str, list[pd.DataFrame]]) -> dict[str, list[pd.DataFrame]]:
+    return lines_at_level(_lines, level)
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _culled_lines(
+    key: tuple, level: int | None, bbox: tuple | None, _lines: dict[str, list[pd.DataFrame]]
+) -> dict[str, list[pd.DataFrame]]:
+    lines = _lines if level is None else _lod_lines(key, level, _lines)
+    if bbox is None:
+        return lines
+    # 分段下标在各 LOD 层之间一致，bbox 用完整几何的
+    return cull_lines(lines, _segment_index(key, _lines), bbox)
+
+
+def _visible_lines(
+    key: tuple,
+    lines: dict[str, list[pd.DataFrame]],
+    viewport: Viewport | None,
+    zoom: float | None = None,
+):
+    """
+    按缩放级别选 LOD（scripts/route_geometry.py 预计算的 Douglas–Peucker 金字塔，
+    zoom=None 为完整精度），再按侧栏手动设定的区域（viewport，不跟随地图平移 / 缩放）裁剪：
+    只保留与该范围相交的分段并裁掉范围外的部分。
+    返回 (lines, 几何 key)，几何 key 唯一标识结果，供图模板缓存使用。
+    """
+    level = None if zoom is None else lod_for_zoom(zoom)
+    bbox = None if viewport is None else viewport.bbox
+    return _culled_lines(key, level, bbox, lines), key + (level, bbox)
+
+
 def _base_fig(center=(40.8, -74), zoom=10) -> go.Figure:
     fig = go.Figure()
     fig.update_layout(
@@ -475,285 +645,394 @@ def _base_fig(center=(40.8, -74), zoom=10) -> go.Figure:
     return fig
 
 
-def _add_lines_to_fig(
-    fig: go.Figure,
-    subs: list[pd.DataFrame],
-    color: str,
-    show_markers: bool,
-    hover_text_builder,
-    route_id: str,
-    route_label: str | None = None,
-    valid_stops_set: set[str] | None = None,
-):
+# 路线数超过这个值（例如“全部线路”的公交图层）时，整层按线路颜色打包成少数几条 trace
+PACK_LAYER_MIN_ROUTES = 40
+
+
+@dataclass
+class FigureTemplate:
     """
-    valid_stops_set:
-      - None：不做过滤（显示完整静态线）
-      - set(...)：只显示该集合内站点（实时过滤）
+    一个图层的静态部分（几何、颜色、图例），按 (几何 key, 线路选择, marker 设置) 缓存：
+    figure 是不带实时信息的 plotly JSON，其余是所有 trace 拼在一起的逐点数组（不含断开用的空点）。
+    每次 rerun 只按实时数据补 customdata（hover 由 hovertemplate 渲染）、过滤站点，不再重建几何。
     """
-    if not subs:
-        return
-
-    line_color = color if (isinstance(color, str) and color and color != "#000000") else "blue"
-    route_label = route_label or f"route {route_id}"
 
-    first = True
-    for s in subs:
-        plot_df = s.copy()
-        if valid_stops_set is not None:
-            plot_df = plot_df[plot_df["stop_id"].astype(str).isin(valid_stops_set)]
+    figure: dict
+    traces: list  # (color, name, legendgroup)
+    show_stops: bool
+    label: str
+    packed: bool  # 同色线路打包：hover 里要带上线路名
+    trace_bounds: np.ndarray  # trace i 的点是 [trace_bounds[i], trace_bounds[i + 1])
+    lat: np.ndarray
+    lon: np.ndarray
+    seg: np.ndarray  # 分段编号（段与段之间断开）
+    route_code: np.ndarray  # route_ids 的下标
+    key_code: np.ndarray  # keys 的下标
+    stop_name: np.ndarray
+    route_ids: pd.Index
+    keys: pd.Index  # 唯一的 "route\x1fstop"
+    key_route: np.ndarray  # keys 里每个 key 的线路下标
+    key_stop: np.ndarray  # keys 里每个 key 的 stop_id
+
+
+def _gapped(values: np.ndarray, seg: np.ndarray, fill) -> np.ndarray:
+    """values (rows) with fill between consecutive segments (connectgaps=False breaks the line there)."""
+    brk = np.zeros(len(values), dtype=np.int64)
+    brk[1:] = seg[1:] != seg[:-1]
+    out = np.empty((len(values) + int(brk.sum()),) + values.shape[1:], dtype=values.dtype)
+    out[:] = fill
+    out[np.arange(len(values)) + np.cumsum(brk)] = values
+    return out
+
+
+def _line_trace(lat, lon, customdata, hovertemplate: str, color: str, show_markers: bool, name: str, group: str) -> dict:
+    return dict(
+        type="scattermap",
+        lon=lon,
+        lat=lat,
+        mode="lines+markers" if show_markers else "lines",
+        line=dict(width=3, color=color),
+        marker=dict(symbol="circle", size=4, color="white"),
+        customdata=customdata,
+        hovertemplate=hovertemplate,
+        connectgaps=False,
+        legendgroup=group,
+        showlegend=True,
+        name=name,
+    )
 
-        # 注意：画线至少要 2 个点，否则跳过
-        if len(plot_df) < 2:
-            continue
 
-        fig.add_trace(
-            go.Scattermap(
-                lon=plot_df["stop_lon"],
-                lat=plot_df["stop_lat"],
-                mode="lines",
-                line=dict(width=3, color=line_color),
-                hoverinfo="text",
-                text=hover_text_builder(plot_df),
-                legendgroup=f"route-{route_id}",
-                showlegend=first,
-                name=route_label,
-            )
-        )
-        first = False
-
-        if show_markers:
-            fig.add_trace(
-                go.Scattermap(
-                    lon=plot_df["stop_lon"],
-                    lat=plot_df["stop_lat"],
-                    mode="markers",
-                    marker=dict(symbol="circle", size=4, color="white"),
-                    hoverinfo="skip",
-                    legendgroup=f"route-{route_id}",
-                    showlegend=False,
-                    name=route_label,
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _figure_template(
+    key: tuple,
+    _lines: dict[str, list[pd.DataFrame]],
+    routes: tuple[str, ...],
+    show_stops: bool,
+    label: str,
+    center: tuple[float, float],
+) -> FigureTemplate:
+    """
+    每条线路一个 trace（分段之间断开，站点 marker 画在同一个 trace 上）；线路多于
+    PACK_LAYER_MIN_ROUTES 时同色线路打包成一个 trace（Scattermap 的线只能单色），
+    hover 逐点带上线路名，图例按颜色分组切换。key 标识 _lines（_lines 不参与 hash）。
+    hover 只放 customdata（站名、线路、到站时间），文字格式在每个 trace 的 hovertemplate 里。
+    """
+    packed = len(routes) > PACK_LAYER_MIN_ROUTES
+    groups: dict[str, list] = {}
+    for rid in routes:
+        subs = [s for s in _lines.get(rid, []) if len(s) >= 2]
+        if subs:
+            color = _pick_color_from_subs(subs)
+            groups.setdefault(color if packed else rid, []).append((rid, color, subs))
+
+    frames, traces = [], []
+    n_seg = 0
+    for items in groups.values():
+        color = items[0][1]
+        for rid, _c, subs in items:
+            for s in subs:
+                frames.append(
+                    pd.DataFrame(
+                        {
+                            "route_id": rid,
+                            "stop_id": s["stop_id"].astype(str).to_numpy(),
+                            "stop_name": s["stop_name"].astype(str).to_numpy(),
+                            "lat": pd.to_numeric(s["stop_lat"], errors="coerce").to_numpy(dtype=np.float64),
+                            "lon": pd.to_numeric(s["stop_lon"], errors="coerce").to_numpy(dtype=np.float64),
+                            "seg": n_seg,
+                            "trace": len(traces),
+                        }
+                    )
                 )
-            )
+                n_seg += 1
+        if packed:
+            name = f"{label} {items[0][0]}" if len(items) == 1 else f"{len(items)} routes ({color})"
+            traces.append((color, name, f"color-{color}"))
+        else:
+            traces.append((color, f"{label} {items[0][0]}", f"route-{items[0][0]}"))
+
+    columns = ["route_id", "stop_id", "stop_name", "lat", "lon", "seg", "trace"]
+    pts = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    route_code, route_ids = pd.factorize(pts["route_id"])
+    key_code, keys = pd.factorize(pts["route_id"] + "\x1f" + pts["stop_id"])
+    first = np.unique(key_code, return_index=True)[1]
+    tpl = FigureTemplate(
+        figure={"data": [], "layout": _base_fig(center=center, zoom=10).layout.to_plotly_json()},
+        traces=traces,
+        show_stops=show_stops,
+        label=label,
+        packed=packed,
+        trace_bounds=np.searchsorted(pts["trace"].to_numpy(dtype=np.int64), np.arange(len(traces) + 1)),
+        lat=pts["lat"].to_numpy(dtype=np.float64),
+        lon=pts["lon"].to_numpy(dtype=np.float64),
+        seg=pts["seg"].to_numpy(dtype=np.int64),
+        route_code=route_code,
+        key_code=key_code,
+        stop_name=pts["stop_name"].to_numpy(dtype=object),
+        route_ids=pd.Index(route_ids),
+        keys=pd.Index(keys),
+        key_route=route_code[first],
+        key_stop=pts["stop_id"].to_numpy(dtype=object)[first],
+    )
+    tpl.figure["data"] = _template_traces(tpl, np.ones(len(pts), dtype=bool))
+    return tpl
 
 
-# =========================
-#   各图层构图（关键：实时过滤只在“该线路存在实时数据时”启用）
-# =========================
-def build_subway_figure(selected_routes: list[str], show_arrival: bool, show_stops: bool) -> go.Figure:
-    fig = _base_fig(center=(40.78, -73.97), zoom=10)
-    lines = get_subway_lines()
-    routes = selected_routes or list(lines.keys())
+_NEXT_LABELS = np.asarray(["Next departure", "Next arrival"], dtype=object)
 
-    schedule_map: dict[tuple[str, str], str] = {}
-    valid_stops_by_route: dict[str, set[str]] = {}
 
-    if show_arrival:
-        sched = fetch_subway_feed()
-        if sched.empty:
-            st.warning("Real-time subway feed is empty (or filtered out). Showing static routes with N/A arrivals.")
+def _template_traces(
+    tpl: FigureTemplate,
+    keep: np.ndarray,
+    value: np.ndarray | None = None,
+    arrival: np.ndarray | None = None,
+) -> list:
+    """
+    keep 里的点画成 trace。customdata 每点一行：[站名, 时间, 线路, 标签]，
+    后两列只有打包的 trace 才带（单线路 trace 的线路名和标签直接写进 hovertemplate）。
+    value 是“下一班”的时间文字，arrival 为 True 的点显示 Next arrival，否则 Next departure。
+    """
+    # 画线至少要 2 个点：过滤后不足 2 个点的分段整段去掉
+    counts = np.bincount(tpl.seg[keep], minlength=int(tpl.seg.max()) + 1 if len(tpl.seg) else 0)
+    keep = keep & (counts[tpl.seg] >= 2)
+    columns = [tpl.stop_name]
+    if value is not None:
+        columns.append(value)
+    if tpl.packed:
+        columns.append(tpl.route_ids.to_numpy(dtype=object)[tpl.route_code])
+        if value is not None:
+            columns.append(_NEXT_LABELS[arrival.astype(np.int64)])
+    custom = np.column_stack(columns).astype(object)
+
+    out = []
+    for i, (color, name, group) in enumerate(tpl.traces):
+        a, b = tpl.trace_bounds[i], tpl.trace_bounds[i + 1]
+        k = keep[a:b]
+        if not k.any():
+            continue
+        seg = tpl.seg[a:b][k]
+        if tpl.packed:
+            head = f"{tpl.label} %{{customdata[{2 if value is not None else 1}]}}<br>"
+            next_label = "%{customdata[3]}"
         else:
-            sched = sched[sched["route"].astype(str).isin([str(r) for r in routes])]
-            if sched.empty:
-                st.warning("No real-time arrivals for selected routes. Showing static routes with N/A arrivals.")
-            else:
-                sched["stop_id"] = sched["stop_id"].astype(str)
-                sched["route"] = sched["route"].astype(str)
-
-                schedule_map = {(r, s): str(a) for r, s, a in zip(sched["route"], sched["stop_id"], sched["arrival_time"])}
-                valid_stops_by_route = sched.groupby("route")["stop_id"].apply(set).to_dict()
-
-    for rid in routes:
-        rid_str = str(rid)
-        subs = lines.get(rid_str, [])
-        color = _pick_color_from_subs(subs)
-
-        hover_builder = (
-            (lambda s, _rid=rid_str: _with_arrival_hover(s, schedule_map, _rid))
-            if show_arrival
-            else _default_hover
+            head = ""
+            next_label = _NEXT_LABELS[int(arrival[a:b][k][0])] if value is not None else ""
+        template = head + "Stop: %{customdata[0]}"
+        if value is not None:
+            template += f"<br>{next_label}: %{{customdata[1]}}"
+        out.append(
+            _line_trace(
+                _gapped(tpl.lat[a:b][k], seg, np.nan),
+                _gapped(tpl.lon[a:b][k], seg, np.nan),
+                _gapped(custom[a:b][k], seg, None),
+                template + "<extra></extra>",
+                color,
+                tpl.show_stops,
+                name,
+                group,
+            )
         )
+    return out
 
-        # 关键修复：只有当该线路在实时 feed 中出现过，才开启过滤
-        current_valid_stops = None
-        if show_arrival:
-            if rid_str in valid_stops_by_route:
-                current_valid_stops = valid_stops_by_route[rid_str]
-            else:
-                current_valid_stops = None  # 不过滤，防止整图无 trace
-
-        _add_lines_to_fig(
-            fig,
-            subs,
-            color,
-            show_stops,
-            hover_builder,
-            route_id=rid_str,
-            route_label=f"Subway {rid}",
-            valid_stops_set=current_valid_stops,
-        )
 
-    return fig
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _template_schedule_keys(
+    key: tuple, index_key: tuple, _tpl: FigureTemplate, _schedule: ScheduleIndex
+) -> np.ndarray:
+    """
+    模板的 (route, stop) key 在时刻表索引里的位置。单独缓存，按 (模板 key, 索引 key)：
+    模板是所有会话共享的缓存对象，不能在上面改状态。
+    """
+    return _schedule.lookup_keys(_tpl.route_ids.to_numpy()[_tpl.key_route], _tpl.key_stop)
 
 
-def build_bus_borough_figure(borough: str, selected_routes: list[str], show_arrival: bool, show_stops: bool) -> go.Figure:
-    center = BOROUGHS_COORDINATE_MAPPING[borough]
-    fig = _base_fig(center=(center[0], center[1]), zoom=10)
-    lines_dict = get_bus_lines(borough)
-    routes = selected_routes or list(lines_dict.keys())
+def _template_figure(
+    tpl: FigureTemplate,
+    schedule_map: dict[tuple[str, str], str] | None = None,
+    schedule: ScheduleIndex | None = None,
+    schedule_keys: np.ndarray | None = None,
+) -> go.Figure:
+    """
+    模板 -> go.Figure（不再逐属性校验）。schedule_map 为 None 时直接用静态 hover；
+    否则补丁实时部分：实时 feed 里有的线路只保留有到站数据的站并显示实时到站，
+    其余线路显示时刻表的下一班（没有索引时显示 N/A）。
+    schedule_keys 是 _template_schedule_keys(tpl, schedule) 的结果。
+    """
+    if schedule_map is None:
+        return go.Figure({"data": tpl.figure["data"], "layout": tpl.figure["layout"]}, _validate=False)
+
+    # 实时数据先落到模板的唯一 (route, stop) key 上：这一步只和实时行数成正比
+    rt_pos = tpl.keys.get_indexer([f"{r}\x1f{s}" for r, s in schedule_map])
+    hit = rt_pos >= 0
+    has_arrival = np.zeros(len(tpl.keys), dtype=bool)
+    has_arrival[rt_pos[hit]] = True
+    arrival = np.full(len(tpl.keys), "N/A", dtype=object)
+    arrival[rt_pos[hit]] = np.asarray(list(schedule_map.values()), dtype=object)[hit]
+    route_pos = tpl.route_ids.get_indexer(list({r for r, _ in schedule_map}))
+    live_route = np.zeros(len(tpl.route_ids), dtype=bool)
+    live_route[route_pos[route_pos >= 0]] = True
+
+    # 其余都是按点的数组运算
+    live = live_route[tpl.route_code]
+    keep = ~live | has_arrival[tpl.key_code]
+    if schedule is None:
+        value = arrival[tpl.key_code]
+        is_arrival = np.ones(len(live), dtype=bool)
+    else:
+        secs = schedule.next_for_keys(schedule_keys, seconds_now())[tpl.key_code]
+        planned = format_seconds_array(secs) + np.where(secs >= 0, " (scheduled)", "").astype(object)
+        value = np.where(live, arrival[tpl.key_code], planned)
+        is_arrival = live
+    data = _template_traces(tpl, keep, value, is_arrival)
+    return go.Figure({"data": data, "layout": tpl.figure["layout"]}, _validate=False)
 
-    schedule_map: dict[tuple[str, str], str] = {}
-    valid_stops_by_route: dict[str, set[str]] = {}
 
-    if show_arrival:
-        sched = fetch_bus_feed()
+# =========================
+#   各图层构图（关键：实时过滤只在“该线路存在实时数据时”启用）
+# =========================
+def _routes_figure(
+    key: tuple,
+    lines: dict[str, list[pd.DataFrame]],
+    selected_routes: list[str],
+    show_arrival: bool,
+    show_stops: bool,
+    viewport: Viewport | None,
+    simplify: bool,
+    subdir: str,
+    label: str,
+    center: tuple[float, float],
+    fetch_feed,
+    status_mode: str,
+) -> go.Figure:
+    """
+    静态部分来自 _figure_template（缓存），每次 rerun 只补实时部分。
+    实时过滤只在“该线路存在实时数据时”启用，否则显示时刻表的下一班。
+    """
+    # 站点标记要每个站都在，画站点时不简化
+    zoom = (viewport.zoom if viewport else 10) if simplify and not show_stops else None
+    lines, geometry_key = _visible_lines(key, lines, viewport, zoom)
+    routes = tuple(str(r) for r in (selected_routes or lines.keys()))
+    tpl = _figure_template(geometry_key, lines, routes, show_stops, label, center)
+    if not show_arrival:
+        return _template_figure(tpl)
+
+    index_key = (DATASET_VERSION, subdir, SERVICE_DATE)
+    schedule = get_schedule_index(*index_key)
+    tpl_key = (geometry_key, routes, show_stops, label, center)  # 与 _figure_template 的缓存参数一致
+    schedule_keys = _template_schedule_keys(tpl_key, index_key, tpl, schedule)
+    schedule_map: dict[tuple[str, str], str] = {}
+    sched = fetch_feed()
+    show_feed_status(status_mode)
+    if sched.empty:
+        feed_name = "LIRR" if status_mode == "lirr" else status_mode
+        st.warning(f"Real-time {feed_name} feed is empty (or filtered out). Showing scheduled departures instead.")
+    else:
+        sched = sched[sched["route"].astype(str).isin(routes)]
         if sched.empty:
-            st.warning("Real-time bus feed is empty (or filtered out). Showing static routes with N/A arrivals.")
+            st.warning("No real-time arrivals for selected routes. Showing scheduled departures instead.")
         else:
-            sched = sched[sched["route"].astype(str).isin([str(r) for r in routes])]
-            if sched.empty:
-                st.warning("No real-time arrivals for selected routes. Showing static routes with N/A arrivals.")
-            else:
-                sched["stop_id"] = sched["stop_id"].astype(str)
-                sched["route"] = sched["route"].astype(str)
-                schedule_map = {(r, s): str(a) for r, s, a in zip(sched["route"], sched["stop_id"], sched["arrival_time"])}
-                valid_stops_by_route = sched.groupby("route")["stop_id"].apply(set).to_dict()
-
-    for rid in routes:
-        rid_str = str(rid)
-        subs = lines_dict.get(rid_str, [])
-        color = _pick_color_from_subs(subs)
-
-        hover_builder = (
-            (lambda s, _rid=rid_str: _with_arrival_hover(s, schedule_map, _rid))
-            if show_arrival
-            else _default_hover
-        )
-
-        current_valid_stops = None
-        if show_arrival:
-            if rid_str in valid_stops_by_route:
-                current_valid_stops = valid_stops_by_route[rid_str]
-            else:
-                current_valid_stops = None
-
-        _add_lines_to_fig(
-            fig,
-            subs,
-            color,
-            show_stops,
-            hover_builder,
-            route_id=rid_str,
-            route_label=f"Bus {rid}",
-            valid_stops_set=current_valid_stops,
-        )
-
-    return fig
-
+            schedule_map = realtime_labels(sched)
+    return _template_figure(tpl, schedule_map, schedule, schedule_keys)
+
+
+def build_subway_figure(
+    selected_routes: list[str],
+    show_arrival: bool,
+    show_stops: bool,
+    viewport: Viewport | None = None,
+    simplify: bool = True,
+) -> go.Figure:
+    return _routes_figure(
+        ("subway", DATASET_VERSION, SERVICE_DATE),
+        get_subway_lines(DATASET_VERSION, SERVICE_DATE),
+        selected_routes,
+        show_arrival,
+        show_stops,
+        viewport,
+        simplify,
+        subdir="subway",
+        label="Subway",
+        center=(40.78, -73.97),
+        fetch_feed=fetch_subway_feed,
+        status_mode="subway",
+    )
 
-def build_lirr_figure(selected_routes: list[str], show_arrival: bool, show_stops: bool) -> go.Figure:
-    fig = _base_fig(center=(40.8, -74), zoom=10)
-    lines = get_lirr_lines()
-    routes = selected_routes or list(lines.keys())
 
-    schedule_map: dict[tuple[str, str], str] = {}
-    valid_stops_by_route: dict[str, set[str]] = {}
+def build_bus_borough_figure(
+    borough: str,
+    selected_routes: list[str],
+    show_arrival: bool,
+    show_stops: bool,
+    viewport: Viewport | None = None,
+    simplify: bool = True,
+) -> go.Figure:
+    # 只选了几条线路时只读这几条线路的分区
+    route_key = tuple(sorted(str(r) for r in selected_routes))
+    center = BOROUGHS_COORDINATE_MAPPING[borough]
+    return _routes_figure(
+        ("bus", DATASET_VERSION, borough, route_key, SERVICE_DATE),
+        get_bus_lines(DATASET_VERSION, borough, route_key, SERVICE_DATE),
+        selected_routes,
+        show_arrival,
+        show_stops,
+        viewport,
+        simplify,
+        subdir=f"bus_{borough.lower()}",
+        label="Bus",
+        center=(center[0], center[1]),
+        fetch_feed=fetch_bus_feed,
+        status_mode="bus",
+    )
 
-    if show_arrival:
-        sched = fetch_lirr_feed()
-        if sched.empty:
-            st.warning("Real-time LIRR feed is empty (or filtered out). Showing static routes with N/A arrivals.")
-        else:
-            sched = sched[sched["route"].astype(str).isin([str(r) for r in routes])]
-            if sched.empty:
-                st.warning("No real-time arrivals for selected routes. Showing static routes with N/A arrivals.")
-            else:
-                sched["stop_id"] = sched["stop_id"].astype(str)
-                sched["route"] = sched["route"].astype(str)
-                schedule_map = {(r, s): str(a) for r, s, a in zip(sched["route"], sched["stop_id"], sched["arrival_time"])}
-                valid_stops_by_route = sched.groupby("route")["stop_id"].apply(set).to_dict()
 
-    for rid in routes:
-        rid_str = str(rid)
-        subs = lines.get(rid_str, [])
-        color = _pick_color_from_subs(subs)
-
-        hover_builder = (
-            (lambda s, _rid=rid_str: _with_arrival_hover(s, schedule_map, _rid))
-            if show_arrival
-            else _default_hover
-        )
+def build_bus_network_figure() -> go.Figure:
+    fig = _base_fig(center=(40.7128, -73.95), zoom=10)
+    _tile_server()
+    path = get_bus_tileset(DATASET_VERSION, SERVICE_DATE)
+    if path is None:
+        st.warning("Bus vector tiles unavailable.")
+        return fig
+    fig.update_layout(map={"layers": map_layers(path, tilejson_url(path))}, showlegend=False)
+    # 地图子图至少要有一个 trace 才会渲染
+    fig.add_trace(go.Scattermap(lat=[], lon=[], mode="lines", hoverinfo="skip"))
+    return fig
 
-        current_valid_stops = None
-        if show_arrival:
-            if rid_str in valid_stops_by_route:
-                current_valid_stops = valid_stops_by_route[rid_str]
-            else:
-                current_valid_stops = None
-
-        _add_lines_to_fig(
-            fig,
-            subs,
-            color,
-            show_stops,
-            hover_builder,
-            route_id=rid_str,
-            route_label=f"LIRR {rid}",
-            valid_stops_set=current_valid_stops,
-        )
 
-    return fig
+def build_lirr_figure(
+    selected_routes: list[str],
+    show_arrival: bool,
+    show_stops: bool,
+    viewport: Viewport | None = None,
+    simplify: bool = True,
+) -> go.Figure:
+    return _routes_figure(
+        ("LIRR", DATASET_VERSION, SERVICE_DATE),
+        get_lirr_lines(DATASET_VERSION, SERVICE_DATE),
+        selected_routes,
+        show_arrival,
+        show_stops,
+        viewport,
+        simplify,
+        subdir="LIRR",
+        label="LIRR",
+        center=(40.8, -74),
+        fetch_feed=fetch_lirr_feed,
+        status_mode="lirr",
+    )
 
 
 # =========== Citibike ===========
-@st.cache_data(ttl=120, show_spinner=False)
 def citibike_station_data() -> pd.DataFrame:
-    try:
-        info = json.load(urlreq.urlopen("https://gbfs.citibikenyc.com/gbfs/en/station_information.json"))
-        status = json.load(urlreq.urlopen("https://gbfs.citibikenyc.com/gbfs/en/station_status.json"))
-        regions = json.load(urlreq.urlopen("https://gbfs.citibikenyc.com/gbfs/en/system_regions.json"))
-    except Exception:
-        return pd.DataFrame(
-            columns=[
-                "name",
-                "lat",
-                "lon",
-                "capacity",
-                "region_id",
-                "region_name",
-                "num_docks_available",
-                "num_ebikes_available",
-                "num_bikes_available",
-                "last_reported",
-            ]
-        )
-
-    info_df = pd.DataFrame(info["data"]["stations"]).set_index("station_id")[["name", "lat", "lon", "capacity", "region_id"]]
-    status_df = pd.DataFrame(status["data"]["stations"]).set_index("station_id")[
-        [
-            "num_docks_available",
-            "num_bikes_disabled",
-            "num_ebikes_available",
-            "num_bikes_available",
-            "num_docks_disabled",
-            "is_renting",
-            "is_returning",
-            "last_reported",
-            "is_installed",
-        ]
-    ]
-    regions_df = pd.DataFrame(regions["data"]["regions"]).rename(columns={"name": "region_name"})
-    return info_df.merge(status_df, left_index=True, right_index=True).merge(
-        regions_df[["region_id", "region_name"]],
-        left_on="region_id",
-        right_on="region_id",
-    )
+    snap = current_snapshot(wait_keys=("citibike",))
+    df = snap.get("citibike")
+    return df if df is not None else pd.DataFrame(columns=CITIBIKE_COLUMNS)
 
 
-def _citibike_row_to_color(row: pd.Series) -> str:
-    dark = CITIBIKE_REGIONS_COLORING_DARK[row["region_name"]]
-    light = CITIBIKE_REGIONS_COLORING_LIGHT[row["region_name"]]
-    ratio = min(int(row["num_bikes_available"]), 80) / 80
-    return f"rgba{color_interpolation(dark, light, ratio)}"
+# 站点 hover：格式只写一次，逐点只带 customdata
+CITIBIKE_HOVER = (
+    "Name: %{customdata[0]}<br>Docks: %{customdata[1]}<br>eBikes: %{customdata[2]}"
+    "<br>Bikes: %{customdata[3]}<br>Last: %{customdata[4]}<extra></extra>"
+)
 
 
 def build_citibike_figure(selected_regions: list[str]) -> go.Figure:
@@ -764,36 +1043,42 @@ def build_citibike_figure(selected_regions: list[str]) -> go.Figure:
         return fig
 
     cb = cb.sort_values(by=["lat", "lon", "last_reported"], ascending=False).drop_duplicates(["lat", "lon"])
-    cb["color"] = cb.apply(_citibike_row_to_color, axis=1)
-    
+    # 所有区域的颜色和 hover 数据一次算完，各区域只按 mask 取
+    colors = citibike_colors(
+        cb["region_name"], cb["num_bikes_available"], CITIBIKE_REGIONS_COLORING_DARK, CITIBIKE_REGIONS_COLORING_LIGHT
+    )
+
     # ====== Citibike 时区修复 ======
-    # 1. 转为 UTC 时间对象 (explicitly handling Unix timestamp)
-    # 2. 转为 NY 时间
-    cb["last_reported_dt"] = pd.to_datetime(cb["last_reported"], unit='s', utc=True).dt.tz_convert('America/New_York')
-    # 3. 格式化为字符串用于显示
-    cb["last_reported_str"] = cb["last_reported_dt"].dt.strftime('%Y-%m-%d %H:%M:%S')
+    # last_reported 是 Unix 时间戳：按 UTC 解析后转为 NY 时间，整列格式化用于显示
+    last_reported = (
+        pd.to_datetime(cb["last_reported"], unit="s", utc=True)
+        .dt.tz_convert("America/New_York")
+        .dt.strftime("%Y-%m-%d %H:%M:%S")
+    )
+    customdata = np.column_stack(
+        [
+            cb["name"].to_numpy(dtype=object),
+            cb["num_docks_available"].to_numpy(dtype=object),
+            cb["num_ebikes_available"].to_numpy(dtype=object),
+            cb["num_bikes_available"].to_numpy(dtype=object),
+            last_reported.to_numpy(dtype=object),
+        ]
+    )
+    region = cb["region_name"].to_numpy(dtype=object)
+    lat, lon = cb["lat"].to_numpy(), cb["lon"].to_numpy()
 
     for rg in selected_regions:
-        sub = cb[cb["region_name"] == rg]
-        if sub.empty:
+        mask = region == rg
+        if not mask.any():
             continue
         fig.add_trace(
             go.Scattermap(
-                lon=sub["lon"],
-                lat=sub["lat"],
+                lon=lon[mask],
+                lat=lat[mask],
                 mode="markers",
-                marker=dict(size=10, color=sub["color"]),
-                text=sub.apply(
-                    lambda x: (
-                        f"Name: {x['name']}<br>"
-                        f"Docks: {x['num_docks_available']}<br>"
-                        f"eBikes: {x['num_ebikes_available']}<br>"
-                        f"Bikes: {x['num_bikes_available']}<br>"
-                        f"Last: {x['last_reported_str']}"  # 使用修复后的时间
-                    ),
-                    axis=1,
-                ),
-                hoverinfo="text",
+                marker=dict(size=10, color=colors[mask]),
+                customdata=customdata[mask],
+                hovertemplate=CITIBIKE_HOVER,
                 legendgroup=f"citibike-{rg}",
                 showlegend=True,
                 name=f"Citibike {rg}",
@@ -805,6 +1090,8 @@ def build_citibike_figure(selected_regions: list[str]) -> go.Figure:
 # =========================
 #           UI
 # =========================
+start_static_prepare()
+
 st.title("Real Time Transportation Dashboard")
 
 with st.sidebar:
@@ -813,12 +1100,36 @@ with st.sidebar:
 
     bus_borough = None
     if map_choice == "bus":
-        bus_borough = st.selectbox("Bus borough", BOROUGHS, index=2)
+        bus_borough = st.selectbox("Bus borough", BOROUGHS + [ALL_BOROUGHS], index=2)
 
     st.divider()
     st.subheader("Rendering options")
     show_arrival = st.checkbox("Show next-arrival time (slower)", value=False)
     show_stops = st.checkbox("Show stop markers (slowest)", value=False)
+    simplify = st.checkbox("Simplify lines by zoom", value=True, disabled=show_stops)
+
+    # 手动设定的区域裁剪 / 附近站点（scripts/spatial_index.py），公交 / 地铁 / LIRR 图层。
+    # st.plotly_chart 不回传平移 / 缩放事件，所以这里的区域不会跟着地图视图走
+    viewport_on = False
+    near_k = 0
+    if map_choice != "citibike" and bus_borough != ALL_BOROUGHS:
+        st.divider()
+        st.subheader("Area filter")
+        _center = (
+            BOROUGHS_COORDINATE_MAPPING[bus_borough or "Manhattan"]
+            if map_choice == "bus"
+            else (40.78, -73.97) if map_choice == "subway" else (40.8, -74.0)
+        )
+        _vp_key = f"{map_choice}_{bus_borough}"
+        viewport_on = st.toggle("Only draw the area below", value=False, key=f"vp_on_{_vp_key}")
+        st.caption(
+            "A manual filter: the map is centered on this area when it is on, "
+            "but panning or zooming the map does not move it."
+        )
+        vp_lat = st.number_input("Center latitude", value=float(_center[0]), format="%.5f", key=f"vp_lat_{_vp_key}")
+        vp_lon = st.number_input("Center longitude", value=float(_center[1]), format="%.5f", key=f"vp_lon_{_vp_key}")
+        vp_zoom = st.slider("Area zoom", min_value=9, max_value=17, value=13, key=f"vp_zoom_{_vp_key}")
+        near_k = st.slider("Nearest stops to the center (0 = off)", min_value=0, max_value=20, value=0)
 
     st.divider()
     auto_refresh = st.toggle("Auto refresh maps (30s)", value=True)
@@ -832,16 +1143,19 @@ with st.sidebar:
     selected_regions: list[str] = []
 
     if map_choice == "subway":
-        subway_routes = get_subway_route_ids()
+        subway_routes = get_subway_route_ids(DATASET_VERSION, SERVICE_DATE)
         selected_subway = st.multiselect("Subway routes", subway_routes, default=[])
 
+    elif map_choice == "bus" and bus_borough == ALL_BOROUGHS:
+        st.caption("Every bus route, drawn from locally served vector tiles (no route filter or hover).")
+
     elif map_choice == "bus":
         _borough = bus_borough or "Manhattan"
-        bus_routes = get_bus_route_ids(_borough)
+        bus_routes = get_bus_route_ids(DATASET_VERSION, _borough, SERVICE_DATE)
         selected_bus = st.multiselect(f"{_borough} bus routes", bus_routes, default=[])
 
     elif map_choice == "LIRR":
-        lirr_routes = get_lirr_route_ids()
+        lirr_routes = get_lirr_route_ids(DATASET_VERSION, SERVICE_DATE)
         selected_lirr = st.multiselect("LIRR routes", lirr_routes, default=[])
 
     elif map_choice == "citibike":
@@ -854,34 +1168,45 @@ with st.sidebar:
     cols = st.columns([1, 1.4])
     with cols[0]:
         if st.button("Refresh now"):
-            fetch_subway_feed.clear()
-            fetch_bus_feed.clear()
-            fetch_lirr_feed.clear()
-            fetch_mnr_feed.clear()
-            citibike_station_data.clear()
+            get_poller().refresh_now(wait=FETCH_DEADLINE)
             st.rerun()
     with cols[1]:
         # ====== 修复：获取当前纽约时间用于“Last updated” ======
         now_ny = pd.Timestamp.now(tz="America/New_York")
         st.caption(f"Last updated: {now_ny.strftime('%H:%M:%S')} (NY)")
+    if DATASET_VERSION != LOCAL_VERSION:
+        pending = get_manager().building()
+        st.caption(f"GTFS version {DATASET_VERSION}" + (f" (preparing {pending})" if pending else ""))
+    st.caption(f"Service day: {SERVICE_DATE:%a %Y-%m-%d}" if SERVICE_DATE else "Service day: all services")
 
 safe_autorefresh(enabled=auto_refresh, interval_ms=30 * 1000)
 
 # ---------- 绘制 ----------
+viewport = Viewport(vp_lat, vp_lon, vp_zoom, height_px=map_height) if viewport_on else None
 try:
     if map_choice == "subway":
-        fig = build_subway_figure(selected_subway, show_arrival, show_stops)
+        fig = build_subway_figure(selected_subway, show_arrival, show_stops, viewport, simplify)
     elif map_choice == "LIRR":
-        fig = build_lirr_figure(selected_lirr, show_arrival, show_stops)
+        fig = build_lirr_figure(selected_lirr, show_arrival, show_stops, viewport, simplify)
+    elif map_choice == "bus" and bus_borough == ALL_BOROUGHS:
+        fig = build_bus_network_figure()
     elif map_choice == "bus":
         _borough = bus_borough or "Manhattan"
-        fig = build_bus_borough_figure(_borough, selected_bus, show_arrival, show_stops)
+        fig = build_bus_borough_figure(_borough, selected_bus, show_arrival, show_stops, viewport, simplify)
     else:
         fig = build_citibike_figure(selected_regions or CITIBIKE_REGIONS)
 
+    if viewport is not None:
+        fig.update_layout(map={"center": {"lat": viewport.center_lat, "lon": viewport.center_lon}, "zoom": viewport.zoom})
     fig.update_layout(height=map_height)
     st_plotly(fig, config={"displaylogo": False})
 
+    if near_k:
+        _subdir = f"bus_{(bus_borough or 'Manhattan').lower()}" if map_choice == "bus" else map_choice
+        _realtime = {"subway": fetch_subway_feed, "bus": fetch_bus_feed, "LIRR": fetch_lirr_feed}[map_choice]()
+        st.subheader(f"Stops near ({vp_lat:.5f}, {vp_lon:.5f})")
+        st.dataframe(stops_near(_subdir, vp_lat, vp_lon, near_k, _realtime), hide_index=True)
+
 except Exception as e:
     st.exception(e)
 
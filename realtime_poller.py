@@ -0,0 +1,203 @@
+# realtime_poller.py
+"""
+后台实时数据轮询：
+
+一个进程内只有一个 RealtimePoller。每个 job（GTFS-RT 全部子 feed、Citibike GBFS）
+在自己的线程里按各自的间隔刷新，结果发布成不可变、带版本号的 Snapshot。
+GTFS-RT 每轮的结果先作为 diff 应用到各交通方式的 RealtimeState（realtime_state.py），
+快照里发布的是每个 (route, stop) 的下一班（"next_arrivals"）。
+Streamlit 的所有 session 和 Dash 回调都只读 poller.snapshot()，不会在渲染里等 MTA API；
+N 个用户也只对应一份上游请求。
+"""
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from realtime_state import RealtimeState
+from utils_streamlit import (
+    CITIBIKE,
+    FETCH_DEADLINE,
+    MODE_FEEDS,
+    get_all_schedules,
+)
+
+REALTIME_INTERVAL = 30  # 秒，GTFS-RT
+CITIBIKE_INTERVAL = 120  # 秒，GBFS（每轮只下载 ttl 已到期的 feed，见 GbfsClient）
+
+_EMPTY: Mapping[str, Any] = MappingProxyType({})
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    不可变快照：version 每次发布 +1；data / updated_at / status 都是只读映射。
+    data 里的值（rows / DataFrame）约定只读，使用方需要改时自行 copy。
+    """
+    version: int = 0
+    data: Mapping[str, Any] = field(default_factory=lambda: _EMPTY)
+    updated_at: Mapping[str, float] = field(default_factory=lambda: _EMPTY)
+    status: Mapping[str, str] = field(default_factory=lambda: _EMPTY)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+
+@dataclass
+class _Job:
+    name: str
+    fn: Callable[[], Dict[str, Any]]  # 返回 {"data": {...}, "status": {...}}
+    interval: float
+    wake: threading.Event = field(default_factory=threading.Event)
+    thread: Optional[threading.Thread] = None
+
+
+class RealtimePoller:
+    def __init__(self) -> None:
+        self._jobs: Dict[str, _Job] = {}
+        self._snapshot = Snapshot()
+        self._lock = threading.Lock()
+        self._published = threading.Condition(self._lock)
+        self._stop = threading.Event()
+
+    # ---------- 配置 ----------
+    def register(self, name: str, fn: Callable[[], Dict[str, Any]], interval: float) -> None:
+        self._jobs[name] = _Job(name, fn, interval)
+
+    def start(self) -> "RealtimePoller":
+        for job in self._jobs.values():
+            if job.thread is None or not job.thread.is_alive():
+                job.thread = threading.Thread(
+                    target=self._run, args=(job,), name=f"poller-{job.name}", daemon=True
+                )
+                job.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        for job in self._jobs.values():
+            job.wake.set()
+
+    # ---------- 读取 ----------
+    def snapshot(self) -> Snapshot:
+        """当前快照（引用替换是原子的，不加锁、不阻塞）。"""
+        return self._snapshot
+
+    def wait_ready(self, keys, timeout: float) -> Snapshot:
+        """仅用于冷启动：最多等 timeout 秒，直到 keys 都至少发布过一次。"""
+        deadline = time.monotonic() + timeout
+        with self._published:
+            while not all(k in self._snapshot.updated_at for k in keys):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._published.wait(left)
+            return self._snapshot
+
+    def refresh_now(self, name: Optional[str] = None, wait: float = 0.0) -> Snapshot:
+        """立即触发刷新（"Refresh now" 按钮）；wait>0 时等待下一个版本发布。"""
+        version = self._snapshot.version
+        for job in self._jobs.values():
+            if name is None or job.name == name:
+                job.wake.set()
+        if wait > 0:
+            deadline = time.monotonic() + wait
+            with self._published:
+                while self._snapshot.version == version:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._published.wait(left)
+        return self._snapshot
+
+    # ---------- 内部 ----------
+    def _publish(self, data: Mapping[str, Any], status: Mapping[str, str]) -> None:
+        now = time.time()
+        with self._published:
+            old = self._snapshot
+            new_data = dict(old.data)
+            new_data.update(data)
+            updated = dict(old.updated_at)
+            updated.update({k: now for k in data})
+            new_status = dict(old.status)
+            new_status.update(status)
+            self._snapshot = Snapshot(
+                version=old.version + 1,
+                data=MappingProxyType(new_data),
+                updated_at=MappingProxyType(updated),
+                status=MappingProxyType(new_status),
+            )
+            self._published.notify_all()
+
+    def _run(self, job: _Job) -> None:
+        while not self._stop.is_set():
+            job.wake.clear()
+            try:
+                out = job.fn()
+                self._publish(out.get("data", {}), out.get("status", {}))
+            except Exception as e:
+                self._publish({}, {job.name: f"error: {e}"})
+            job.wake.wait(job.interval)
+
+
+# ---------------------------
+# 默认 job + 进程级单例
+# ---------------------------
+# 每种交通方式一份增量状态，只由 realtime job 的线程写入
+_STATES: Dict[str, RealtimeState] = {mode: RealtimeState() for mode in MODE_FEEDS}
+
+
+def _poll_realtime() -> Dict[str, Any]:
+    schedules, report = get_all_schedules()
+    now = time.time()
+    status = report.summary()
+    next_arrivals = {}
+    for mode, schedule in schedules.items():
+        state = _STATES[mode]
+        diff = state.apply(schedule, now)
+        status[f"{mode}:diff"] = f"+{diff.upserted} -{diff.removed} expired {diff.expired}"
+        next_arrivals[mode] = state.next_arrivals(now)
+    return {"data": {"next_arrivals": MappingProxyType(next_arrivals)}, "status": status}
+
+
+def realtime_state(mode: str) -> RealtimeState:
+    """某交通方式的增量实时状态（next_arrival 单点查询用）。"""
+    return _STATES[mode]
+
+
+def _poll_citibike() -> Dict[str, Any]:
+    df = CITIBIKE.station_data()
+    status = {"citibike": CITIBIKE.status, "citibike:changed": f"{len(CITIBIKE.changed)} stations"}
+    status.update({f"citibike:{name}": error for name, error in CITIBIKE.errors.items()})
+    # citibike_changed：这一轮 status 有变化的站（没有新数据时为空表）
+    return {"data": {"citibike": df, "citibike_changed": CITIBIKE.changed}, "status": status}
+
+
+_POLLER: Optional[RealtimePoller] = None
+_POLLER_LOCK = threading.Lock()
+
+
+def get_poller() -> RealtimePoller:
+    """进程内唯一的 poller（首次调用时启动）。"""
+    global _POLLER
+    with _POLLER_LOCK:
+        if _POLLER is None:
+            poller = RealtimePoller()
+            poller.register("realtime", _poll_realtime, REALTIME_INTERVAL)
+            poller.register("citibike", _poll_citibike, CITIBIKE_INTERVAL)
+            _POLLER = poller.start()
+        return _POLLER
+
+
+def current_snapshot(wait_keys=(), timeout: float = FETCH_DEADLINE) -> Snapshot:
+    """
+    读当前快照；冷启动（wait_keys 还没发布过）时最多等 timeout 秒，之后永不阻塞。
+    """
+    poller = get_poller()
+    snap = poller.snapshot()
+    if wait_keys and not all(k in snap.updated_at for k in wait_keys):
+        snap = poller.wait_ready(wait_keys, timeout)
+    return snap
@@ -0,0 +1,203 @@
+# realtime_state.py
+"""
+增量实时状态：
+
+每种交通方式一个 RealtimeState，按 (trip_id, stop_id) 保存当前已知的
+stop_time_update。每次 poller 拿到新的 FeedMessage（decode_trip_updates 的列式结果），
+只把“和上一轮不同”的部分当作 diff 应用：
+  - 新增 / 时间变化的行 -> upsert
+  - feed 里消失的行（实体被删、列车已驶过该站）-> 删除
+  - 时间已过的行 -> 过期
+
+另外为每个 (route, stop) 维护一个按到站时间排序的最小堆（惰性删除），
+查询某站下一班是 O(log n)，不再每轮 sort + groupby 整个 feed。
+"""
+from __future__ import annotations
+
+import heapq
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# 到站时间早于 now - EXPIRE_GRACE 的行视为已驶离
+EXPIRE_GRACE = 60
+
+_Key = Tuple[str, str]  # (trip_id, stop_id)
+_Pair = Tuple[str, str]  # (route, stop_id)
+
+
+@dataclass(frozen=True)
+class StateDiff:
+    upserted: int = 0
+    removed: int = 0
+    expired: int = 0
+
+    @property
+    def changed(self) -> int:
+        return self.upserted + self.removed + self.expired
+
+
+def _schedule_frame(schedule) -> pd.DataFrame:
+    """列式 schedule -> (trip_id, stop_id) 唯一的 DataFrame（when = 到站，缺失时用离站）。"""
+    if schedule is None or len(schedule.get("stop_id", ())) == 0:
+        return pd.DataFrame(
+            {
+                "trip_id": pd.Series([], dtype=object),
+                "stop_id": pd.Series([], dtype=object),
+                "route": pd.Series([], dtype=object),
+                "arrival_time": np.empty(0, dtype=np.int64),
+                "departure_time": np.empty(0, dtype=np.int64),
+                "when": np.empty(0, dtype=np.int64),
+            }
+        )
+    arr = np.asarray(schedule["arrival_time"], dtype=np.int64)
+    dep = np.asarray(schedule["departure_time"], dtype=np.int64)
+    df = pd.DataFrame(
+        {
+            "trip_id": np.asarray(schedule["trip_id"], dtype=object).astype(str),
+            "stop_id": np.asarray(schedule["stop_id"], dtype=object).astype(str),
+            "route": np.asarray(schedule["route"], dtype=object).astype(str),
+            "arrival_time": arr,
+            "departure_time": dep,
+            "when": np.where(arr > 0, arr, dep),
+        }
+    )
+    # 两个时间都缺失的行没有可排序的到站时间，不进状态
+    df = df[df["when"] > 0]
+    # 同一 trip 在同一站出现多次（环线）时以最后一条为准
+    return df.drop_duplicates(["trip_id", "stop_id"], keep="last")
+
+
+class RealtimeState:
+    def __init__(self, expire_grace: float = EXPIRE_GRACE) -> None:
+        self.expire_grace = expire_grace
+        # 上一轮应用后的完整状态（列式，用于向量化求 diff）
+        self._frame = _schedule_frame(None)
+        self._source = None  # 上一次 apply 的 schedule 对象
+        # (trip_id, stop_id) -> (route, arrival, departure, when)
+        self._rows: Dict[_Key, Tuple[str, int, int, int]] = {}
+        # (route, stop_id) -> [(when, trip_id)]，过时条目在 peek 时才丢弃
+        self._heaps: Dict[_Pair, List[Tuple[int, str]]] = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    # ---------- 写入 ----------
+    def apply(self, schedule, now: Optional[float] = None) -> StateDiff:
+        """把一轮新的列式 schedule 当作 diff 应用到状态上。"""
+        now = int(time.time() if now is None else now)
+        if schedule is not None and schedule is self._source:
+            # feed 没变（条件请求命中，复用了同一份解码结果）：过点的行由堆查询时惰性淘汰
+            return StateDiff()
+        self._source = schedule
+        cutoff = now - self.expire_grace
+        new = _schedule_frame(schedule)
+        departed = new[new["when"] < cutoff]
+        new = new[new["when"] >= cutoff]
+
+        with self._lock:
+            old = self._frame
+            # 向量化比较：只有真正变化的行才进入下面的 Python 循环
+            merged = old.merge(
+                new, on=["trip_id", "stop_id"], how="outer",
+                suffixes=("_old", ""), indicator=True,
+            )
+            gone = merged[merged["_merge"] == "left_only"]
+            both = merged["_merge"] == "both"
+            changed = merged[
+                (merged["_merge"] == "right_only")
+                | (both & (
+                    (merged["route"] != merged["route_old"])
+                    | (merged["arrival_time"] != merged["arrival_time_old"])
+                    | (merged["departure_time"] != merged["departure_time_old"])
+                ))
+            ]
+
+            # 已驶离：feed 里仍带着但时间已过，或者旧记录本身已过点
+            keys = pd.MultiIndex.from_arrays([gone["trip_id"], gone["stop_id"]])
+            is_expired = (gone["when_old"] < cutoff).to_numpy() | keys.isin(
+                pd.MultiIndex.from_arrays([departed["trip_id"], departed["stop_id"]])
+            )
+            expired = int(is_expired.sum())
+            for trip_id, stop_id in zip(gone["trip_id"], gone["stop_id"]):
+                self._rows.pop((trip_id, stop_id), None)
+
+            for trip_id, stop_id, route, a, d, w in zip(
+                changed["trip_id"], changed["stop_id"], changed["route"],
+                changed["arrival_time"].astype(np.int64), changed["departure_time"].astype(np.int64),
+                changed["when"].astype(np.int64),
+            ):
+                a, d, w = int(a), int(d), int(w)
+                self._rows[(trip_id, stop_id)] = (route, a, d, w)
+                heapq.heappush(self._heaps.setdefault((route, stop_id), []), (w, trip_id))
+
+            self._frame = new.reset_index(drop=True)
+            if len(changed) or len(gone):
+                self.version += 1
+            return StateDiff(upserted=len(changed), removed=len(gone) - expired, expired=expired)
+
+    # ---------- 查询 ----------
+    def _peek(self, pair: _Pair, now: int) -> Optional[Tuple[str, int, int]]:
+        """堆顶第一条仍然有效且未过时的记录；沿途弹出失效条目。调用方持锁。"""
+        heap = self._heaps.get(pair)
+        route, stop_id = pair
+        while heap:
+            when, trip_id = heap[0]
+            row = self._rows.get((trip_id, stop_id))
+            if row is not None and row[0] == route and row[3] == when and when >= now:
+                return row[0], row[1], row[2]
+            heapq.heappop(heap)
+        self._heaps.pop(pair, None)
+        return None
+
+    def next_arrival(self, route: str, stop_id: str, now: Optional[float] = None) -> Optional[Tuple[int, int]]:
+        """(arrival, departure) epoch 秒；没有后续班次时为 None。"""
+        now = int(time.time() if now is None else now)
+        with self._lock:
+            row = self._peek((str(route), str(stop_id)), now)
+        return None if row is None else (row[1], row[2])
+
+    def next_arrivals(self, now: Optional[float] = None) -> Dict[str, object]:
+        """
+        每个 (route, stop) 的下一班 -> 列式 {route, stop_id, arrival_time, departure_time}，
+        时间为 int64 epoch 秒（0 = 缺失），与 decode_trip_updates 的约定一致。
+        """
+        now = int(time.time() if now is None else now)
+        routes: List[str] = []
+        stops: List[str] = []
+        arr: List[int] = []
+        dep: List[int] = []
+        with self._lock:
+            for pair in list(self._heaps):
+                row = self._peek(pair, now)
+                if row is None:
+                    continue
+                routes.append(pair[0])
+                stops.append(pair[1])
+                arr.append(row[1])
+                dep.append(row[2])
+            self._compact()
+        return {
+            "route": np.asarray(routes, dtype=object),
+            "stop_id": np.asarray(stops, dtype=object),
+            "arrival_time": np.asarray(arr, dtype=np.int64),
+            "departure_time": np.asarray(dep, dtype=np.int64),
+        }
+
+    def _compact(self) -> None:
+        """惰性删除积累的失效条目超过有效行数时，整体重建堆。调用方持锁。"""
+        total = sum(len(h) for h in self._heaps.values())
+        if total <= 2 * len(self._rows) + 1024:
+            return
+        heaps: Dict[_Pair, List[Tuple[int, str]]] = {}
+        for (trip_id, stop_id), (route, _a, _d, when) in self._rows.items():
+            heaps.setdefault((route, stop_id), []).append((when, trip_id))
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        self._heaps = heaps
@@ -0,0 +1,562 @@
+"""
+Typed columnar cache for the static GTFS tables.
+
+`python -m scripts.gtfs_cache [subdir ...]` compiles every GTFS/<subdir> into
+Arrow IPC files under cache/gtfs/<subdir>/<key>/, where <key> is derived from
+the SHA-256 of the source .txt files. `load_tables` memory-maps those files
+instead of re-parsing the CSVs with dtype=str on every cold start:
+
+- IDs (route_id / trip_id / stop_id / service_id ...) -> categorical
+- stop_sequence / direction_id / route_type          -> int32 (missing = -1)
+- stop_lat / stop_lon                                 -> float64
+- arrival_time / departure_time                       -> int32 seconds since
+  midnight of the service day (values past 24:00:00 are kept; missing = -1)
+
+stop_times.txt is streamed in fixed-size chunks (sized from a configurable
+memory ceiling, GTFS_INGEST_MEMORY_MB) straight into the Arrow file, and the
+per-trip aggregates the dashboard needs (stop count, first / last time) are
+accumulated on the way, so the full table is never held in memory. Stop
+patterns are grouped on the FeedModel (FeedModel.stop_patterns), where each
+trip's stops are already in order.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_source import gtfs_root, open_binary
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    _HAS_ARROW = True
+except Exception:
+    _HAS_ARROW = False
+
+
+ROOT = Path(__file__).resolve().parent.parent
+GTFS_DIR = ROOT / "GTFS"
+CACHE_DIR = ROOT / "cache" / "gtfs"
+
+# bump when the on-disk layout / typing rules change
+CACHE_FORMAT = 2
+
+MISSING_INT = -1
+MISSING_TIME = -1
+
+# index.json 里最多记住几个 (size, mtime) 签名
+_INDEX_SIGNATURES = 4
+
+# 每个 feed 保留几份编译结果：当前 key + 上一个（数据集热切换期间旧版本仍在服务）
+CACHE_KEEP = 2
+
+REQUIRED_TABLES = ("routes.txt", "stop_times.txt", "stops.txt", "trips.txt")
+TRIP_STATS_FILE = "trip_stats.arrow"
+
+# column -> kind；未列出的列不进入缓存
+TABLE_SCHEMAS: Dict[str, Dict[str, str]] = {
+    "routes.txt": {
+        "agency_id": "id",
+        "route_id": "id",
+        "route_short_name": "str",
+        "route_long_name": "str",
+        "route_type": "int",
+        "route_color": "str",
+        "route_text_color": "str",
+    },
+    "trips.txt": {
+        "route_id": "id",
+        "service_id": "id",
+        "trip_id": "id",
+        "trip_headsign": "str",
+        "direction_id": "int",
+        "shape_id": "id",
+    },
+    "stop_times.txt": {
+        "trip_id": "id",
+        "arrival_time": "time",
+        "departure_time": "time",
+        "stop_id": "id",
+        "stop_sequence": "int",
+    },
+    "stops.txt": {
+        "stop_id": "id",
+        "stop_name": "str",
+        "stop_lat": "float",
+        "stop_lon": "float",
+        "location_type": "int",
+        "parent_station": "id",
+    },
+    # 可选表：不进缓存，scripts/gtfs_calendar.py 直接读（都很小）
+    "calendar.txt": {
+        "service_id": "id",
+        "monday": "int",
+        "tuesday": "int",
+        "wednesday": "int",
+        "thursday": "int",
+        "friday": "int",
+        "saturday": "int",
+        "sunday": "int",
+        "start_date": "int",
+        "end_date": "int",
+    },
+    "calendar_dates.txt": {
+        "service_id": "id",
+        "date": "int",
+        "exception_type": "int",
+    },
+}
+
+Tables = Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]
+
+# 流式读取 stop_times 时的内存上限（近似值，决定每个 chunk 的行数）
+INGEST_MEMORY_LIMIT = int(os.getenv("GTFS_INGEST_MEMORY_MB", "256")) * 1024 * 1024
+# 原始 CSV 字节 -> dtype=str chunk 加上类型转换临时对象的大致放大倍数
+_CHUNK_OVERHEAD = 8
+_MIN_CHUNK_ROWS = 10_000
+
+
+# ---------------------------
+# 类型转换
+# ---------------------------
+def gtfs_time_to_seconds(values: pd.Series) -> np.ndarray:
+    """
+    "HH:MM:SS" -> int32 seconds since service-day midnight (vectorized).
+    GTFS allows hours >= 24 for trips running past midnight; those are kept as-is.
+    """
+    parts = values.astype("string").str.extract(r"^\s*(\d+):(\d{1,2}):(\d{1,2})\s*$")
+    parts = parts.apply(pd.to_numeric, errors="coerce")
+    secs = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return secs.fillna(MISSING_TIME).to_numpy(dtype=np.int32)
+
+
+def _coerce_column(col: pd.Series, kind: str, categories: Optional[pd.Index] = None):
+    if kind == "id":
+        if categories is not None:
+            # 固定字典：每个 chunk 的编码一致，可以直接追加到同一个 Arrow 文件
+            return pd.Categorical(col, categories=categories)
+        return col.astype("category")
+    if kind == "int":
+        return pd.to_numeric(col, errors="coerce").fillna(MISSING_INT).astype(np.int32)
+    if kind == "float":
+        return pd.to_numeric(col, errors="coerce").astype(np.float64)
+    if kind == "time":
+        return gtfs_time_to_seconds(col)
+    return col
+
+
+def read_typed_csv(path: Path, table: str) -> pd.DataFrame:
+    """Parse one GTFS .txt into the typed layout described in TABLE_SCHEMAS."""
+    schema = TABLE_SCHEMAS[table]
+    with open_binary(path) as f:
+        raw = pd.read_csv(f, dtype=str, usecols=lambda c: c.strip() in schema)
+    raw.columns = [c.strip() for c in raw.columns]
+    return pd.DataFrame({c: _coerce_column(raw[c], schema[c]) for c in raw.columns})
+
+
+def chunk_rows_for(path: Path, memory_limit: int = INGEST_MEMORY_LIMIT) -> int:
+    """Rows per chunk so that one parsed chunk stays under memory_limit (approx.)."""
+    with open_binary(path) as f:
+        sample = f.read(1 << 20)
+    lines = max(sample.count(b"\n"), 1)
+    bytes_per_row = max(len(sample) / lines, 1.0)
+    return max(_MIN_CHUNK_ROWS, int(memory_limit // (bytes_per_row * _CHUNK_OVERHEAD)))
+
+
+def iter_typed_csv(
+    path: Path,
+    table: str,
+    chunk_rows: int,
+    categories: Optional[Dict[str, pd.Index]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    read_typed_csv in fixed-size chunks. Id columns listed in `categories` are
+    encoded against that fixed dictionary (unknown ids become missing), so all
+    chunks share one categorical dtype.
+    """
+    schema = TABLE_SCHEMAS[table]
+    categories = categories or {}
+    with open_binary(path) as f:
+        reader = pd.read_csv(f, dtype=str, usecols=lambda c: c.strip() in schema, chunksize=chunk_rows)
+        for raw in reader:
+            raw.columns = [c.strip() for c in raw.columns]
+            yield pd.DataFrame({c: _coerce_column(raw[c], schema[c], categories.get(c)) for c in raw.columns})
+
+
+# ---------------------------
+# stop_times 流式聚合
+# ---------------------------
+@dataclass
+class IngestStats:
+    table: str
+    rows: int = 0
+    chunks: int = 0
+    chunk_rows: int = 0
+    seconds: float = 0.0
+    # 小表里重复 id 的行数（table -> rows）；下游只用第一行
+    duplicates: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        text = (
+            f"{self.table}: {self.rows:,} rows in {self.chunks} chunks of <= {self.chunk_rows:,} "
+            f"({self.seconds:.1f}s, {self.rows_per_s:,.0f} rows/s)"
+        )
+        if self.duplicates:
+            text += "; duplicate ids dropped: " + ", ".join(f"{t} {n:,}" for t, n in self.duplicates.items())
+        return text
+
+
+# 各 feed 最近一次编译的吞吐（rows/s），main() 打印
+LAST_INGEST: Dict[str, IngestStats] = {}
+
+class TripAggregator:
+    """
+    Per-trip aggregates over streamed stop_times chunks (trip_id encoded
+    against trips.txt): stop count, first departure and last arrival. All
+    three are order-independent, so trips split across chunks add up the same.
+    """
+
+    def __init__(self, n_trips: int) -> None:
+        self.n_stops = np.zeros(n_trips, dtype=np.int64)
+        self.first = np.full(n_trips, np.iinfo(np.int32).max, dtype=np.int64)
+        self.last = np.full(n_trips, -1, dtype=np.int64)
+
+    def update(self, chunk: pd.DataFrame, trip: np.ndarray) -> None:
+        """trip: trips.txt row of every chunk row (-1 = trip not in trips.txt)."""
+        ok = trip >= 0
+        trip = trip[ok]
+        arr = chunk["arrival_time"].to_numpy()[ok].astype(np.int64)
+        dep = chunk["departure_time"].to_numpy()[ok].astype(np.int64)
+
+        self.n_stops += np.bincount(trip, minlength=len(self.n_stops))
+        t_first = np.where(dep >= 0, dep, arr)
+        t_last = np.where(arr >= 0, arr, dep)
+        has_first = t_first >= 0
+        np.minimum.at(self.first, trip[has_first], t_first[has_first])
+        np.maximum.at(self.last, trip, t_last)
+
+    def frame(self, trips: pd.DataFrame) -> pd.DataFrame:
+        first = np.where(self.first == np.iinfo(np.int32).max, MISSING_TIME, self.first)
+        return pd.DataFrame(
+            {
+                "trip_id": trips["trip_id"].values,
+                "route_id": trips["route_id"].values,
+                "service_id": trips["service_id"].values if "service_id" in trips.columns else None,
+                "n_stops": self.n_stops.astype(np.int32),
+                "first_departure": first.astype(np.int32),
+                "last_arrival": self.last.astype(np.int32),
+            }
+        )
+
+
+# ---------------------------
+# Source hash（按文件内容做 key）
+# ---------------------------
+def _sha256_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open_binary(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat_signature(folder: Path) -> str:
+    parts = []
+    for name in REQUIRED_TABLES:
+        st_ = (folder / name).stat()
+        parts.append(f"{name}:{st_.st_size}:{st_.st_mtime_ns}")
+    return "|".join(parts)
+
+
+def source_key(folder: Path, cache_root: Optional[Path] = None) -> Optional[str]:
+    """
+    Content key of a GTFS folder: sha256 over the required tables.
+    The (size, mtime) signature -> key mapping is memoized in cache_root/index.json
+    so unchanged folders are not re-hashed on every start. The last few
+    signatures are kept, so switching between dataset versions does not re-hash.
+    """
+    if not all((folder / f).is_file() for f in REQUIRED_TABLES):
+        return None
+
+    sig = _stat_signature(folder)
+    index_path = cache_root / "index.json" if cache_root is not None else None
+    keys: Dict[str, str] = {}
+    if index_path is not None and index_path.exists():
+        try:
+            index = json.loads(index_path.read_text(encoding="utf-8"))
+            if index.get("format") == CACHE_FORMAT:
+                keys = dict(index.get("keys", {}))
+        except Exception:
+            pass
+        if sig in keys:
+            return keys[sig]
+
+    h = hashlib.sha256(f"format={CACHE_FORMAT}".encode())
+    for name in REQUIRED_TABLES:
+        h.update(name.encode())
+        h.update(_sha256_file(folder / name).encode())
+    key = h.hexdigest()[:20]
+
+    if index_path is not None:
+        keys[sig] = key
+        keys = dict(list(keys.items())[-_INDEX_SIGNATURES:])
+        try:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = index_path.with_name(f".index-{os.getpid()}.json")
+            tmp.write_text(json.dumps({"format": CACHE_FORMAT, "keys": keys}), encoding="utf-8")
+            os.replace(tmp, index_path)
+        except Exception:
+            pass
+    return key
+
+
+# ---------------------------
+# Arrow IPC 读写
+# ---------------------------
+def _write_ipc(df: pd.DataFrame, path: Path) -> None:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa_ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _stream_stop_times(
+    folder: Path,
+    out_path: Path,
+    trips: pd.DataFrame,
+    stops: pd.DataFrame,
+    memory_limit: int = INGEST_MEMORY_LIMIT,
+) -> Tuple[IngestStats, pd.DataFrame]:
+    """
+    stop_times.txt -> Arrow IPC, one record batch per chunk, never holding the
+    full table. Returns the ingest stats and the per-trip aggregates.
+    """
+    path = folder / "stop_times.txt"
+    categories = {
+        "trip_id": pd.Index(trips["trip_id"].cat.categories),
+        "stop_id": pd.Index(stops["stop_id"].cat.categories),
+    }
+    stats = IngestStats("stop_times.txt", chunk_rows=chunk_rows_for(path, memory_limit))
+    agg = TripAggregator(len(trips))
+    # trip_id 字典编码 -> trips.txt 行号
+    row_of_code = np.full(max(len(categories["trip_id"]), 1), -1, dtype=np.int64)
+    trip_codes = trips["trip_id"].cat.codes.to_numpy()
+    valid = np.flatnonzero(trip_codes >= 0)[::-1]  # 倒序赋值：重复 trip_id 取第一行
+    row_of_code[trip_codes[valid]] = valid
+
+    t0 = time.monotonic()
+    writer = None
+    schema = None
+    with pa.OSFile(str(out_path), "wb") as sink:
+        try:
+            for chunk in iter_typed_csv(path, "stop_times.txt", stats.chunk_rows, categories):
+                if schema is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    writer = pa_ipc.new_file(sink, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                # 聚合按 trips.txt 的行号
+                codes = chunk["trip_id"].cat.codes.to_numpy()
+                agg.update(chunk, np.where(codes >= 0, row_of_code[np.maximum(codes, 0)], -1))
+                stats.rows += len(chunk)
+                stats.chunks += 1
+            if writer is None:
+                empty = pd.DataFrame(
+                    {c: pd.Series([], dtype=str) for c in TABLE_SCHEMAS["stop_times.txt"]}
+                )
+                writer = pa_ipc.new_file(sink, pa.Schema.from_pandas(empty, preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+    stats.seconds = time.monotonic() - t0
+    return stats, agg.frame(trips)
+
+
+def _read_ipc(path: Path) -> pd.DataFrame:
+    # memory_map：数值列直接引用页缓存，不再走 CSV 解析
+    with pa.memory_map(str(path), "r") as src:
+        table = pa_ipc.open_file(src).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def publish_dir(tmp: Path, target: Path, replace: bool = False) -> None:
+    """
+    Move a finished tmp folder onto target. If another process (parallel
+    prepare, a second app instance) published the same target first, its copy
+    is kept and tmp is discarded: both were built from the same source key.
+    With replace=True an existing target is swapped out instead: it is renamed
+    aside, tmp is moved in, then the old copy is removed, so readers never see
+    a missing or half-deleted target.
+    """
+    old = None
+    if target.exists():
+        if not replace:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        old = target.with_name(f".{target.name}-old-{os.getpid()}-{time.monotonic_ns()}")
+        try:
+            os.replace(target, old)
+        except FileNotFoundError:
+            old = None
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        if not target.is_dir():
+            raise
+        # 另一个进程抢先发布了同一个 target
+        shutil.rmtree(tmp, ignore_errors=True)
+    finally:
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def prune_stale(candidates: Iterable[Path], current: Path, keep: int = CACHE_KEEP) -> None:
+    """
+    Delete old artifacts of one feed: besides current, only the keep - 1 most
+    recently written candidates survive. Hidden (in-progress) entries are skipped.
+    """
+    others = [p for p in candidates if p != current and not p.name.startswith(".")]
+    others.sort(key=lambda p: p.stat().st_mtime_ns if p.exists() else 0, reverse=True)
+    for old in others[max(keep - 1, 0):]:
+        if old.is_dir():
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            old.unlink(missing_ok=True)
+
+
+def _table_file(name: str) -> str:
+    return name.replace(".txt", ".arrow")
+
+
+def compile_feed(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    force: bool = False,
+    memory_limit: Optional[int] = None,
+) -> Optional[Path]:
+    """
+    Compile GTFS/<subdir> into cache_dir/<subdir>/<key>/ and return that folder.
+    stop_times.txt is streamed in chunks sized for memory_limit bytes
+    (default INGEST_MEMORY_LIMIT). Returns None if the source tables are
+    missing or pyarrow is unavailable.
+    """
+    if not _HAS_ARROW:
+        return None
+    folder = gtfs_root(gtfs_dir) / subdir
+    feed_cache = Path(cache_dir) / subdir
+    key = source_key(folder, feed_cache)
+    if key is None:
+        return None
+
+    target = feed_cache / key
+    if target.is_dir() and not force:
+        return target
+
+    feed_cache.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{key}-", dir=feed_cache))
+    try:
+        small = {}
+        for name in ("routes.txt", "trips.txt", "stops.txt"):
+            small[name] = read_typed_csv(folder / name, name)
+            _write_ipc(small[name], tmp / _table_file(name))
+        stats, trip_stats = _stream_stop_times(
+            folder, tmp / _table_file("stop_times.txt"), small["trips.txt"], small["stops.txt"],
+            memory_limit or INGEST_MEMORY_LIMIT,
+        )
+        _write_ipc(trip_stats, tmp / TRIP_STATS_FILE)
+        for name, key in (("routes.txt", "route_id"), ("trips.txt", "trip_id"), ("stops.txt", "stop_id")):
+            n = int(small[name][key].duplicated().sum())
+            if n:
+                stats.duplicates[name] = n
+        LAST_INGEST[subdir] = stats
+        publish_dir(tmp, target, replace=force)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # 旧 key 只留最近的一个
+    prune_stale((p for p in feed_cache.iterdir() if p.is_dir()), target)
+    return target
+
+
+def _read_typed_tables(folder: Path) -> Tables:
+    """Without pyarrow: typed tables in memory, stop_times still parsed chunk by chunk."""
+    routes, trips, stops = (read_typed_csv(folder / n, n) for n in ("routes.txt", "trips.txt", "stops.txt"))
+    path = folder / "stop_times.txt"
+    categories = {
+        "trip_id": pd.Index(trips["trip_id"].cat.categories),
+        "stop_id": pd.Index(stops["stop_id"].cat.categories),
+    }
+    chunks = list(iter_typed_csv(path, "stop_times.txt", chunk_rows_for(path), categories))
+    stop_times = pd.concat(chunks, ignore_index=True) if chunks else read_typed_csv(path, "stop_times.txt")
+    return routes, stop_times, stops, trips
+
+
+def load_tables(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+) -> Optional[Tables]:
+    """
+    (routes, stop_times, stops, trips) for GTFS/<subdir>, typed and memory-mapped
+    from the columnar cache (compiled on first use). Falls back to typed CSV
+    parsing when pyarrow is not installed. Returns None if the feed is missing.
+    """
+    folder = gtfs_root(gtfs_dir) / subdir
+    if not all((folder / f).is_file() for f in REQUIRED_TABLES):
+        return None
+
+    target = compile_feed(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+    if target is None:
+        return _read_typed_tables(folder)
+    return tuple(_read_ipc(target / _table_file(name)) for name in REQUIRED_TABLES)  # type: ignore[return-value]
+
+
+def load_trip_stats(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+) -> Optional[pd.DataFrame]:
+    """
+    Per-trip aggregates computed during ingest (trip_id, route_id, service_id,
+    n_stops, first_departure, last_arrival). None without pyarrow
+    or if the feed is missing.
+    """
+    target = compile_feed(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+    if target is None:
+        return None
+    return _read_ipc(target / TRIP_STATS_FILE)
+
+
+def main(argv: list[str]) -> int:
+    if not _HAS_ARROW:
+        print("pyarrow is not installed; nothing to compile.")
+        return 1
+    force = "--force" in argv
+    subdirs = [a for a in argv if not a.startswith("--")]
+    subdirs = subdirs or sorted(p.name for p in GTFS_DIR.iterdir() if p.is_dir())
+    for subdir in subdirs:
+        target = compile_feed(subdir, force=force)
+        print(f"{subdir}: {target if target else 'skipped (missing tables)'}")
+        if subdir in LAST_INGEST:
+            print(f"  {LAST_INGEST[subdir]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,241 @@
+"""
+Service calendar: which trips run on a given service day.
+
+A GTFS feed lists the trips of every service (weekday, Saturday, Sunday,
+holiday specials ...), but a day only runs a fraction of them. This module
+resolves the service_ids active on a date and turns them into a trip mask,
+so the working dataset (FeedModel, route lists, geometry) is built from the
+active trips only:
+
+- calendar.txt / calendar_dates.txt when the feed has them (weekly pattern
+  in [start_date, end_date], plus added / removed exception dates)
+- otherwise the day type is inferred from service_id tokens, then from the
+  trip_ids of that service ("...-Weekday-...", "SAT", "Sunday" ...); a service
+  that says nothing about its days is treated as running every day
+
+The working set of service date D is the trips of D plus the trips of D - 1
+still running after midnight (GTFS times past 24:00:00). Service dates are
+taken in SERVICE_TZ, so callers that key their caches by
+`service_day(...).key` roll over by themselves at the day boundary.
+
+GTFS_SERVICE_DATE=YYYYMMDD pins the service date (replays / testing);
+GTFS_SERVICE_DATE=all disables the filtering.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, FrozenSet, Optional, Set
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_cache import GTFS_DIR, read_typed_csv
+from scripts.gtfs_model import FeedModel
+from scripts.gtfs_source import gtfs_root
+
+# 所有 feed 都在纽约一带
+SERVICE_TZ = ZoneInfo("America/New_York")
+SERVICE_DATE_ENV = "GTFS_SERVICE_DATE"
+
+# 超过这个时间（秒）的 stop_time 属于次日凌晨
+DAY_SECONDS = 24 * 3600
+
+_DAY_COLUMNS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+_WEEKDAYS = 0b0011111
+_SATURDAY = 0b0100000
+_SUNDAY = 0b1000000
+_EVERY_DAY = 0b1111111
+
+# service_id / trip_id 里表示日期类型的词（按非字母切分后小写比较）
+_DAY_TOKENS = {
+    "weekday": _WEEKDAYS,
+    "weekdays": _WEEKDAYS,
+    "wkd": _WEEKDAYS,
+    "wk": _WEEKDAYS,
+    "saturday": _SATURDAY,
+    "sat": _SATURDAY,
+    "sunday": _SUNDAY,
+    "sun": _SUNDAY,
+    "weekend": _SATURDAY | _SUNDAY,
+    "wkend": _SATURDAY | _SUNDAY,
+}
+
+
+def _date_int(d: date) -> int:
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def _int_date(v: int) -> date:
+    return date(v // 10000, v // 100 % 100, v % 100)
+
+
+def infer_days(text: str) -> Optional[int]:
+    """Weekday bitmask (bit 0 = Monday) named by the tokens of text, or None."""
+    mask = 0
+    for token in re.split(r"[^a-z]+", str(text).lower()):
+        mask |= _DAY_TOKENS.get(token, 0)
+    return mask or None
+
+
+# ---------------------------
+# 日历
+# ---------------------------
+@dataclass(frozen=True)
+class ServiceDay:
+    """The services of one service date, plus those of the day before (after-midnight trips)."""
+
+    date: date
+    services: FrozenSet[str]
+    carry: FrozenSet[str]
+
+    @property
+    def key(self) -> str:
+        # 同样的 service 组合 -> 同一个 key（所有工作日共用缓存 / 几何）
+        text = ",".join(sorted(self.services)) + "|" + ",".join(sorted(self.carry))
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+    def trip_mask(self, service_ids: pd.Series, last_times: np.ndarray) -> np.ndarray:
+        """
+        Active trips: service in services, or service in carry and still running
+        after midnight (last_times in seconds since the previous service day).
+        """
+        late = self.carry_mask(service_ids) & (np.asarray(last_times) >= DAY_SECONDS)
+        return self.today_mask(service_ids) | late
+
+    def today_mask(self, service_ids: pd.Series) -> np.ndarray:
+        return _isin(service_ids, self.services)
+
+    def carry_mask(self, service_ids: pd.Series) -> np.ndarray:
+        return _isin(service_ids, self.carry)
+
+
+def _isin(values: pd.Series, ids: FrozenSet[str]) -> np.ndarray:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # 只比较 categories，再按 codes 展开
+        hit = np.append(pd.Index(values.cat.categories.astype(str)).isin(ids), False)
+        return hit[values.cat.codes.to_numpy()]
+    return values.astype(str).isin(ids).to_numpy()
+
+
+@dataclass
+class ServiceCalendar:
+    # service_id -> (weekday bitmask, start_date, end_date)，日期为 YYYYMMDD 整数
+    weekly: Dict[str, tuple] = field(default_factory=dict)
+    # date -> service_ids（calendar_dates.txt exception_type 1 / 2）
+    added: Dict[int, Set[str]] = field(default_factory=dict)
+    removed: Dict[int, Set[str]] = field(default_factory=dict)
+    # 日历文件里没有的 service：从 id 推断出的 bitmask
+    inferred: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def source(self) -> str:
+        if self.weekly or self.added or self.removed:
+            return "calendar" if not self.inferred else "calendar+inferred"
+        return "inferred"
+
+    def _coverage(self) -> Optional[tuple]:
+        dates = [d for _, start, end in self.weekly.values() for d in (start, end)]
+        dates += list(self.added) + list(self.removed)
+        return (min(dates), max(dates)) if dates else None
+
+    def effective_date(self, day: date) -> date:
+        """
+        day, or the same weekday moved by whole weeks into the calendar's date
+        range when the feed does not cover day (an expired or future release).
+        """
+        coverage = self._coverage()
+        if coverage is None:
+            return day
+        first, last = (_int_date(v) for v in coverage)
+        if day > last:
+            return day - timedelta(weeks=(day - last).days // 7 + 1)
+        if day < first:
+            return day + timedelta(weeks=(first - day).days // 7 + 1)
+        return day
+
+    def active(self, day: date) -> FrozenSet[str]:
+        """service_ids running on day."""
+        d, bit = _date_int(day), 1 << day.weekday()
+        out = {sid for sid, (mask, start, end) in self.weekly.items() if mask & bit and start <= d <= end}
+        out |= {sid for sid, mask in self.inferred.items() if mask & bit}
+        out |= self.added.get(d, set())
+        out -= self.removed.get(d, set())
+        return frozenset(out)
+
+    def service_day(self, day: date) -> ServiceDay:
+        day = self.effective_date(day)
+        return ServiceDay(day, self.active(day), self.active(day - timedelta(days=1)))
+
+
+def load_calendar(subdir: str, trips: pd.DataFrame, gtfs_dir: Path = GTFS_DIR) -> ServiceCalendar:
+    """
+    ServiceCalendar of GTFS/<subdir>. trips needs service_id / trip_id (the
+    FeedModel trips or trip_stats); it supplies the services to infer when the
+    calendar files are missing or do not mention them.
+    """
+    folder = gtfs_root(gtfs_dir) / subdir
+    cal = ServiceCalendar()
+    if (folder / "calendar.txt").is_file():
+        df = read_typed_csv(folder / "calendar.txt", "calendar.txt")
+        mask = np.zeros(len(df), dtype=np.int64)
+        for i, col in enumerate(_DAY_COLUMNS):
+            if col in df.columns:
+                mask |= (df[col].to_numpy() == 1).astype(np.int64) << i
+        for sid, m, start, end in zip(df["service_id"].astype(str), mask, df["start_date"], df["end_date"]):
+            cal.weekly[sid] = (int(m), int(start), int(end))
+    if (folder / "calendar_dates.txt").is_file():
+        df = read_typed_csv(folder / "calendar_dates.txt", "calendar_dates.txt")
+        for sid, d, kind in zip(df["service_id"].astype(str), df["date"], df["exception_type"]):
+            target = cal.added if kind == 1 else cal.removed if kind == 2 else None
+            if target is not None:
+                target.setdefault(int(d), set()).add(sid)
+
+    known = set(cal.weekly).union(*cal.added.values(), *cal.removed.values())
+    ids = trips[["service_id", "trip_id"]].astype(str)
+    sample = ids.drop_duplicates("service_id")
+    for sid, trip_id in zip(sample["service_id"], sample["trip_id"]):
+        if sid not in known:
+            cal.inferred[sid] = infer_days(sid) or infer_days(trip_id) or _EVERY_DAY
+    return cal
+
+
+# ---------------------------
+# 当前服务日
+# ---------------------------
+def service_date(now: Optional[datetime] = None) -> Optional[date]:
+    """
+    Today's service date in SERVICE_TZ (or the GTFS_SERVICE_DATE override);
+    None when filtering is disabled.
+    """
+    pinned = os.getenv(SERVICE_DATE_ENV, "").strip().lower()
+    if pinned == "all":
+        return None
+    if pinned:
+        return datetime.strptime(pinned, "%Y%m%d").date()
+    now = now or datetime.now(SERVICE_TZ)
+    return now.astimezone(SERVICE_TZ).date()
+
+
+def service_day(calendar: ServiceCalendar, day: Optional[date]) -> Optional[ServiceDay]:
+    return None if day is None else calendar.service_day(day)
+
+
+def working_model(model: FeedModel, day: Optional[ServiceDay]) -> FeedModel:
+    """model restricted to the trips active on day (the whole model for day=None)."""
+    if day is None or model.empty:
+        return model
+    return model.select_trips(day.trip_mask(model.trips["service_id"], model.trip_last_times()))
+
+
+def active_route_ids(trip_stats: pd.DataFrame, day: Optional[ServiceDay]) -> Set[str]:
+    """route_ids with at least one active trip, from trip_stats (no stop_times needed)."""
+    ts = trip_stats[trip_stats["n_stops"] > 0]
+    if day is not None:
+        ts = ts[day.trip_mask(ts["service_id"], ts["last_arrival"].to_numpy())]
+    return set(ts["route_id"].astype(str))
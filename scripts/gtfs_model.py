@@ -0,0 +1,428 @@
+"""
+Compact, integer-encoded GTFS feed model.
+
+Instead of merging trips x stop_times x stops x routes into one wide frame
+(which repeats stop_name / route_long_name / color on every stop_time row),
+a feed is kept as:
+
+- routes / stops: small attribute tables indexed by dense integer ids
+- trips: route_idx per trip (+ trip_id / service_id as categoricals)
+- stop_times: flat int32 arrays in CSR layout; the stop_times of trip t are
+  rows trip_offsets[t]:trip_offsets[t + 1]
+
+Attribute lookups (stop names, coordinates, colors) are joins done on demand
+for the handful of rows a consumer actually needs.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# 模型里的 CSR 数组（scripts/gtfs_prepare.py 按这个列表逐个落盘 / memory-map）
+MODEL_ARRAYS = (
+    "trip_offsets",
+    "st_stop",
+    "st_sequence",
+    "st_arrival",
+    "st_departure",
+    "route_offsets",
+    "route_trips",
+)
+
+# get_dataset 以前的宽表列，stop_times_frame 仍按这个顺序输出
+WIDE_COLUMNS = [
+    "route_id",
+    "service_id",
+    "trip_id",
+    "arrival_time",
+    "departure_time",
+    "stop_sequence",
+    "stop_id",
+    "stop_name",
+    "stop_lat",
+    "stop_lon",
+    "route_long_name",
+    "color",
+]
+
+
+# stop_patterns 的两个多项式 hash 底数（奇数，互不相关）
+_PATTERN_HASH_BASES = (np.uint64(1_000_003), np.uint64(0x9E3779B97F4A7C15))
+
+
+def _as_str_index(values: pd.Series) -> pd.Index:
+    return pd.Index(values.astype(str).to_numpy(dtype=object))
+
+
+def _dense_codes(keys: pd.Series, universe: pd.Index) -> np.ndarray:
+    """
+    Position of every key in `universe` (-1 if absent). For categorical keys
+    only the categories are looked up, then broadcast through the codes.
+    """
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        cats = universe.get_indexer(pd.Index(keys.cat.categories.astype(str)))
+        codes = keys.cat.codes.to_numpy()
+        out = np.where(codes >= 0, cats[np.maximum(codes, 0)], -1)
+        return out.astype(np.int32)
+    return universe.get_indexer(_as_str_index(keys)).astype(np.int32)
+
+
+def _with_unknown(index: pd.Index, keys: pd.Series) -> pd.Index:
+    """Append ids referenced by `keys` but missing from `index`."""
+    seen = keys.dropna().astype(str).unique()
+    missing = pd.Index(seen).difference(index)
+    return index.append(missing) if len(missing) else index
+
+
+def _csr_offsets(group: np.ndarray, n_groups: int) -> np.ndarray:
+    counts = np.bincount(group, minlength=n_groups)
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+@dataclass
+class FeedModel:
+    # route_idx -> route_id, route_long_name, color
+    routes: pd.DataFrame
+    # stop_idx -> stop_id, stop_name, stop_lat, stop_lon
+    stops: pd.DataFrame
+    # trip_idx -> trip_id, service_id (categorical), route_idx (int32)
+    trips: pd.DataFrame
+    # CSR：trip t 的 stop_times 在 [trip_offsets[t], trip_offsets[t+1])
+    trip_offsets: np.ndarray
+    st_stop: np.ndarray
+    st_sequence: np.ndarray
+    st_arrival: np.ndarray
+    st_departure: np.ndarray
+    # CSR：route r 的 trips 在 route_trips[route_offsets[r]:route_offsets[r+1]]
+    route_offsets: np.ndarray
+    route_trips: np.ndarray
+
+    # ---------- 基本信息 ----------
+    @property
+    def empty(self) -> bool:
+        return len(self.st_stop) == 0
+
+    @property
+    def n_trips(self) -> int:
+        return len(self.trips)
+
+    def memory_usage(self) -> int:
+        """Approximate resident bytes of the model."""
+        arrays = [getattr(self, name) for name in MODEL_ARRAYS]
+        frames = (self.routes, self.stops, self.trips)
+        return int(
+            sum(a.nbytes for a in arrays)
+            + sum(f.memory_usage(deep=True).sum() for f in frames)
+        )
+
+    def with_colors(
+        self,
+        color_overrides: Optional[Dict[str, str]] = None,
+        fixed_color: Optional[str] = None,
+    ) -> "FeedModel":
+        """
+        Same model with route colors overridden (see build_feed_model). Only the
+        small routes table is copied; the stop_times arrays are shared.
+        """
+        if not color_overrides and not fixed_color:
+            return self
+        routes = self.routes.copy()
+        if color_overrides:
+            routes["color"] = routes["route_id"].map(color_overrides).fillna(routes["color"])
+        if fixed_color:
+            routes["color"] = fixed_color
+        return replace(self, routes=routes)
+
+    # ---------- route 维度 ----------
+    def route_ids(self) -> List[str]:
+        """route_ids that have at least one trip, sorted."""
+        has_trips = np.diff(self.route_offsets) > 0
+        return sorted(self.routes["route_id"].to_numpy()[has_trips].tolist(), key=str)
+
+    def route_index(self, route_id) -> int:
+        idx = self.routes.index[self.routes["route_id"] == str(route_id)]
+        return int(idx[0]) if len(idx) else -1
+
+    def trips_of_route(self, route_id) -> np.ndarray:
+        r = self.route_index(route_id)
+        if r < 0:
+            return np.empty(0, dtype=np.int32)
+        return self.route_trips[self.route_offsets[r]: self.route_offsets[r + 1]]
+
+    def trip_stop_counts(self) -> np.ndarray:
+        return np.diff(self.trip_offsets)
+
+    def trip_last_times(self) -> np.ndarray:
+        """Latest arrival / departure of every trip in seconds (-1 for trips without times)."""
+        counts = self.trip_stop_counts()
+        out = np.full(self.n_trips, -1, dtype=np.int64)
+        has = np.flatnonzero(counts > 0)
+        if len(has):
+            times = np.maximum(self.st_arrival, self.st_departure)
+            out[has] = np.maximum.reduceat(times, self.trip_offsets[:-1][has])
+        return out
+
+    def select_trips(self, keep) -> "FeedModel":
+        """
+        Model restricted to the trips where keep is True (e.g. the active service
+        day). Trip and route order are preserved; routes / stops are shared.
+        """
+        keep = np.asarray(keep, dtype=bool)
+        if keep.all():
+            return self
+        kept = np.flatnonzero(keep)
+        rows = self.rows_of_trips(kept)
+        trips = self.trips.iloc[kept].reset_index(drop=True)
+        route_idx = trips["route_idx"].to_numpy()
+        valid = np.flatnonzero(route_idx >= 0)
+        offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+        np.cumsum(self.trip_stop_counts()[kept], out=offsets[1:])
+        return replace(
+            self,
+            trips=trips,
+            trip_offsets=offsets,
+            st_stop=self.st_stop[rows],
+            st_sequence=self.st_sequence[rows],
+            st_arrival=self.st_arrival[rows],
+            st_departure=self.st_departure[rows],
+            route_offsets=_csr_offsets(route_idx[valid], len(self.routes)),
+            route_trips=valid[np.argsort(route_idx[valid], kind="stable")].astype(np.int32),
+        )
+
+    # ---------- stop pattern ----------
+    def stop_patterns(self) -> Tuple[np.ndarray, pd.DataFrame]:
+        """
+        Group trips by their exact stop sequence (ordered by stop_sequence).
+
+        Each trip's sequence is reduced to two 64-bit polynomial hashes plus its
+        length in one vectorized pass, so grouping is a single factorize over
+        n_trips keys instead of comparing sequences pairwise.
+
+        Returns (trip_pattern, patterns):
+          trip_pattern: int32 pattern id per trip (-1 for trips without stops / route)
+          patterns: pattern id -> route_idx, rep_trip (first trip), n_trips, n_stops
+        """
+        counts = self.trip_stop_counts()
+        n_rows = len(self.st_stop)
+        trip_of_row = np.repeat(np.arange(self.n_trips, dtype=np.int64), counts)
+        order = np.lexsort((self.st_sequence, trip_of_row))
+        pos = np.arange(n_rows, dtype=np.int64) - np.repeat(self.trip_offsets[:-1], counts)
+
+        max_len = int(counts.max()) if len(counts) else 0
+        stops = self.st_stop[order].astype(np.uint64) + np.uint64(1)
+        with np.errstate(over="ignore"):
+            hashes = []
+            for base in _PATTERN_HASH_BASES:
+                powers = np.cumprod(np.full(max_len, base, dtype=np.uint64))
+                hashes.append(stops * powers[pos])
+
+        route_idx = self.trips["route_idx"].to_numpy()
+        has = np.flatnonzero((counts > 0) & (route_idx >= 0))
+        starts = self.trip_offsets[:-1][has]
+        keys = pd.DataFrame(
+            {
+                "route_idx": route_idx[has],
+                "n_stops": counts[has],
+                **{f"h{i}": np.add.reduceat(h, starts) if len(has) else h[:0] for i, h in enumerate(hashes)},
+            }
+        )
+        codes = keys.groupby(list(keys.columns), sort=False).ngroup().to_numpy()
+
+        trip_pattern = np.full(self.n_trips, -1, dtype=np.int32)
+        trip_pattern[has] = codes
+        first = pd.Series(has).groupby(codes, sort=True).first().to_numpy()
+        patterns = pd.DataFrame(
+            {
+                "route_idx": route_idx[first].astype(np.int32),
+                "rep_trip": first.astype(np.int32),
+                "n_trips": np.bincount(codes, minlength=len(first)).astype(np.int32),
+                "n_stops": counts[first].astype(np.int32),
+            }
+        )
+        return trip_pattern, patterns
+
+    def ordered_rows(self, trip: int) -> np.ndarray:
+        """stop_time rows of one trip, ordered by stop_sequence."""
+        rows = np.arange(self.trip_offsets[trip], self.trip_offsets[trip + 1], dtype=np.int64)
+        return rows[np.argsort(self.st_sequence[rows], kind="stable")]
+
+    # ---------- stop_times 行选择 ----------
+    def rows_of_trips(self, trip_idx) -> np.ndarray:
+        """Flat stop_time row numbers of the given trips, in trip order."""
+        trip_idx = np.asarray(trip_idx, dtype=np.int64)
+        if len(trip_idx) == 0:
+            return np.empty(0, dtype=np.int64)
+        starts = self.trip_offsets[trip_idx]
+        lens = self.trip_offsets[trip_idx + 1] - starts
+        total = int(lens.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # 向量化展开各个 [start, start+len)
+        shift = np.repeat(starts - np.concatenate(([0], np.cumsum(lens)[:-1])), lens)
+        return np.arange(total, dtype=np.int64) + shift
+
+    def stop_times_frame(self, rows: np.ndarray, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Join attributes onto the given stop_time rows. Produces the columns of the
+        old wide get_dataset frame (or the requested subset), one row per stop_time.
+        """
+        columns = columns or WIDE_COLUMNS
+        rows = np.asarray(rows, dtype=np.int64)
+        trip_of_row = np.searchsorted(self.trip_offsets, rows, side="right") - 1
+        route_of_row = self.trips["route_idx"].to_numpy()[trip_of_row]
+        stop_of_row = self.st_stop[rows]
+
+        out: Dict[str, object] = {}
+        for col in columns:
+            if col == "arrival_time":
+                out[col] = self.st_arrival[rows]
+            elif col == "departure_time":
+                out[col] = self.st_departure[rows]
+            elif col == "stop_sequence":
+                out[col] = self.st_sequence[rows]
+            elif col in ("trip_id", "service_id"):
+                out[col] = self.trips[col].array.take(trip_of_row)
+            elif col in self.routes.columns:
+                out[col] = self.routes[col].to_numpy()[route_of_row]
+            elif col in self.stops.columns:
+                out[col] = self.stops[col].to_numpy()[stop_of_row]
+        return pd.DataFrame(out, columns=[c for c in columns if c in out])
+
+    def route_frame(self, route_id, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """All stop_times of one route (old `df[df.route_id == route]`)."""
+        return self.stop_times_frame(self.rows_of_trips(self.trips_of_route(route_id)), columns)
+
+    def route_stop_frame(
+        self,
+        route_id,
+        columns: Optional[List[str]] = None,
+        by_sequence: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Distinct stops of one route in first-seen order, de-duplicated on the
+        integer arrays before any attribute join.
+        by_sequence=False -> unique stop_id; True -> unique (stop_id, stop_sequence).
+        """
+        rows = self.rows_of_trips(self.trips_of_route(route_id))
+        keys = pd.DataFrame({"s": self.st_stop[rows]})
+        if by_sequence:
+            keys["q"] = self.st_sequence[rows]
+        rows = rows[~keys.duplicated().to_numpy()]
+        return self.stop_times_frame(rows, columns).reset_index(drop=True)
+
+
+def empty_model() -> FeedModel:
+    return build_feed_model(None)
+
+
+def build_feed_model(
+    tables,
+    color_overrides: Optional[Dict[str, str]] = None,
+    fixed_color: Optional[str] = None,
+) -> FeedModel:
+    """
+    Build the compact model from (routes, stop_times, stops, trips).
+    Route colors are "#RRGGBB" from routes.txt ("#000000" when missing);
+    color_overrides maps route_id -> color, fixed_color paints every route.
+    """
+    if tables is None:
+        routes = pd.DataFrame({"route_id": [], "route_long_name": [], "route_color": []})
+        stop_times = pd.DataFrame({"trip_id": [], "arrival_time": [], "departure_time": [], "stop_id": [], "stop_sequence": []})
+        stops = pd.DataFrame({"stop_id": [], "stop_name": [], "stop_lat": [], "stop_lon": []})
+        trips = pd.DataFrame({"route_id": [], "service_id": [], "trip_id": []})
+    else:
+        routes, stop_times, stops, trips = tables
+    # 重复 id 只保留第一行（否则下面 get_indexer 会因索引不唯一报错）
+    routes = routes.drop_duplicates("route_id")
+    stops = stops.drop_duplicates("stop_id")
+    trips = trips.drop_duplicates("trip_id")
+
+    # ---- routes ----
+    route_index = _with_unknown(_as_str_index(routes["route_id"]), trips["route_id"])
+    r_attr = pd.DataFrame({"route_id": _as_str_index(routes["route_id"])})
+    for col in ("route_long_name", "route_color"):
+        r_attr[col] = routes[col].to_numpy() if col in routes.columns else np.nan
+    r_attr = r_attr.set_index("route_id").reindex(route_index)
+    color = (
+        r_attr["route_color"]
+        .fillna("000000")
+        .astype(str)
+        .map(lambda x: "#" + x if not x.startswith("#") else x)
+    )
+    if color_overrides:
+        color = pd.Series(
+            [color_overrides.get(rid, c) for rid, c in zip(route_index, color)],
+            index=color.index,
+        )
+    if fixed_color:
+        color[:] = fixed_color
+    routes_df = pd.DataFrame(
+        {
+            "route_id": route_index.to_numpy(dtype=object),
+            "route_long_name": r_attr["route_long_name"].to_numpy(dtype=object),
+            "color": color.to_numpy(dtype=object),
+        }
+    )
+
+    # ---- stops ----
+    stop_index = _with_unknown(_as_str_index(stops["stop_id"]), stop_times["stop_id"])
+    s_attr = pd.DataFrame(
+        {
+            "stop_id": _as_str_index(stops["stop_id"]),
+            "stop_name": stops["stop_name"].to_numpy(dtype=object),
+            "stop_lat": pd.to_numeric(stops["stop_lat"], errors="coerce").to_numpy(),
+            "stop_lon": pd.to_numeric(stops["stop_lon"], errors="coerce").to_numpy(),
+        }
+    ).set_index("stop_id").reindex(stop_index)
+    stops_df = s_attr.reset_index().rename(columns={"index": "stop_id"})
+    stops_df["stop_id"] = stop_index.to_numpy(dtype=object)
+
+    # ---- trips ----
+    trip_index = _as_str_index(trips["trip_id"])
+    trips_df = pd.DataFrame(
+        {
+            "trip_id": pd.Categorical(trip_index.to_numpy(dtype=object)),
+            "service_id": trips["service_id"].astype("category").values,
+            "route_idx": _dense_codes(trips["route_id"], route_index),
+        }
+    )
+
+    # ---- stop_times（CSR，按 trips.txt 顺序分组，组内保持文件顺序）----
+    st_trip = _dense_codes(stop_times["trip_id"], trip_index)
+    keep = st_trip >= 0
+    order = np.argsort(st_trip[keep], kind="stable")
+    sel = np.flatnonzero(keep)[order]
+    st_trip = st_trip[sel]
+
+    def _int_col(name: str) -> np.ndarray:
+        if name not in stop_times.columns:
+            return np.full(len(sel), -1, dtype=np.int32)
+        col = stop_times[name]
+        if not pd.api.types.is_integer_dtype(col):
+            col = pd.to_numeric(col, errors="coerce").fillna(-1)
+        return col.to_numpy()[sel].astype(np.int32)
+
+    st_stop = _dense_codes(stop_times["stop_id"], stop_index)[sel]
+
+    # ---- route -> trips ----
+    route_idx = trips_df["route_idx"].to_numpy()
+    valid_trips = np.flatnonzero(route_idx >= 0)
+    by_route = valid_trips[np.argsort(route_idx[valid_trips], kind="stable")].astype(np.int32)
+
+    return FeedModel(
+        routes=routes_df,
+        stops=stops_df,
+        trips=trips_df,
+        trip_offsets=_csr_offsets(st_trip, len(trips_df)),
+        st_stop=st_stop.astype(np.int32),
+        st_sequence=_int_col("stop_sequence"),
+        st_arrival=_int_col("arrival_time"),
+        st_departure=_int_col("departure_time"),
+        route_offsets=_csr_offsets(route_idx[valid_trips], len(routes_df)),
+        route_trips=by_route,
+    )
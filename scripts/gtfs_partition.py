@@ -0,0 +1,244 @@
+"""
+Route-partitioned static GTFS storage.
+
+`python -m scripts.gtfs_partition [subdir ...]` rewrites trips / stop_times of
+GTFS/<subdir> grouped by route_id: every route becomes one record batch of an
+Arrow IPC file (the route_id -> batch number index lives in the schema
+metadata):
+
+    cache/partitions/<subdir>-<key>-p<format>/trips.arrow
+    cache/partitions/<subdir>-<key>-p<format>/stop_times.arrow
+    cache/partitions/<subdir>-<key>-p<format>/catalog.json   (route -> trip / stop_time counts)
+
+`load_route_tables(subdir, route_ids)` pushes the route predicate down to that
+index: only the batches of the requested routes are memory-mapped, so loading
+one bus route costs the size of that route, not of the borough.
+
+`route_catalog(subdir)` lists the routes from routes.txt alone (no trips /
+stop_times are read), which is all the route pickers need.
+"""
+from __future__ import annotations
+
+import json
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_cache import (
+    CACHE_DIR,
+    GTFS_DIR,
+    ROOT,
+    Tables,
+    _HAS_ARROW,
+    _read_ipc,
+    _table_file,
+    compile_feed,
+    load_tables,
+    prune_stale,
+    publish_dir,
+    read_typed_csv,
+    source_key,
+)
+from scripts.gtfs_source import gtfs_root
+
+if _HAS_ARROW:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+
+PARTITION_DIR = ROOT / "cache" / "partitions"
+
+# bump when the partition layout changes
+PARTITION_FORMAT = 1
+
+CATALOG_COLUMNS = ["route_id", "route_short_name", "route_long_name", "route_color"]
+
+
+# ---------------------------
+# Catalog（只读 routes.txt）
+# ---------------------------
+def route_catalog(subdir: str, gtfs_dir: Path = GTFS_DIR) -> pd.DataFrame:
+    """route_id / short / long name / color of every route in routes.txt, sorted by route_id."""
+    path = gtfs_root(gtfs_dir) / subdir / "routes.txt"
+    if not path.is_file():
+        return pd.DataFrame(columns=CATALOG_COLUMNS)
+    routes = read_typed_csv(path, "routes.txt")
+    out = pd.DataFrame({c: routes[c].astype(str).where(routes[c].notna(), "") if c in routes.columns else "" for c in CATALOG_COLUMNS})
+    out = out.drop_duplicates("route_id")
+    return out.sort_values("route_id", key=lambda s: s.astype(str), kind="stable").reset_index(drop=True)
+
+
+# ---------------------------
+# 按 key 分 batch 的 IPC 读写
+# ---------------------------
+def write_partitioned(
+    df: pd.DataFrame,
+    keys: np.ndarray,
+    path: Path,
+    metadata: Optional[Dict[str, str]] = None,
+) -> Dict[str, int]:
+    """
+    Write df as one record batch per distinct key (keys sorted, rows stable
+    within a key). The key -> batch number index is returned and also stored
+    in the schema metadata ("partitions"), next to any extra metadata given.
+    """
+    keys = np.asarray(keys).astype(str)
+    order = np.argsort(keys, kind="stable")
+    df = df.iloc[order].reset_index(drop=True)
+    keys = keys[order]
+    uniq, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    index = {str(k): i for i, k in enumerate(uniq)}
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = dict(table.schema.metadata or {})
+    meta[b"partitions"] = json.dumps(index).encode()
+    for k, v in (metadata or {}).items():
+        meta[k.encode()] = v.encode()
+    table = table.replace_schema_metadata(meta).combine_chunks()
+
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa_ipc.new_file(sink, table.schema) as writer:
+            for a, b in zip(starts, ends):
+                # 切片共享同一份 dictionary，IPC file 格式要求如此
+                for batch in table.slice(a, b - a).to_batches():
+                    writer.write_batch(batch)
+    return index
+
+
+def read_metadata(path: Path) -> Dict[str, str]:
+    """Schema metadata of an IPC file (no data pages are touched)."""
+    with pa.memory_map(str(path), "r") as src:
+        meta = pa_ipc.open_file(src).schema.metadata or {}
+    return {k.decode(): v.decode() for k, v in meta.items()}
+
+
+def read_partitions(path: Path, keys: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Memory-map path and read only the record batches of the given keys
+    (all batches when keys is None), in key order.
+    """
+    with pa.memory_map(str(path), "r") as src:
+        reader = pa_ipc.open_file(src)
+        if keys is None:
+            table = reader.read_all()
+        else:
+            index = json.loads((reader.schema.metadata or {}).get(b"partitions", b"{}"))
+            picked = [reader.get_batch(index[str(k)]) for k in keys if str(k) in index]
+            table = pa.Table.from_batches(picked, schema=reader.schema)
+    return table.to_pandas(split_blocks=True)
+
+
+# ---------------------------
+# 编译 / 读取
+# ---------------------------
+def partition_path(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    partition_dir: Path = PARTITION_DIR,
+) -> Optional[Path]:
+    key = source_key(gtfs_root(gtfs_dir) / subdir, Path(cache_dir) / subdir)
+    if key is None:
+        return None
+    return Path(partition_dir) / f"{subdir}-{key}-p{PARTITION_FORMAT}"
+
+
+def compile_partitions(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    partition_dir: Path = PARTITION_DIR,
+    force: bool = False,
+) -> Optional[Path]:
+    """Build the route-partitioned copy of GTFS/<subdir>; None if missing / no pyarrow."""
+    if not _HAS_ARROW:
+        return None
+    target = partition_path(subdir, gtfs_dir, cache_dir, partition_dir)
+    if target is None:
+        return None
+    if (target / "catalog.json").is_file() and not force:
+        return target
+
+    _routes, stop_times, _stops, trips = load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+    trip_route = pd.Series(trips["route_id"].astype(str).to_numpy(), index=trips["trip_id"].astype(str).to_numpy())
+    trip_route = trip_route[~trip_route.index.duplicated()]
+    st_route = trip_route.reindex(stop_times["trip_id"].astype(str).to_numpy()).to_numpy()
+    known = pd.notna(st_route)
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=target.parent))
+    try:
+        trip_route_ids = trips["route_id"].astype(str).to_numpy()
+        write_partitioned(trips, trip_route_ids, tmp / "trips.arrow")
+        write_partitioned(stop_times[known].reset_index(drop=True), st_route[known], tmp / "stop_times.arrow")
+        n_trips = pd.Series(trip_route_ids).value_counts()
+        n_stop_times = pd.Series(st_route[known]).value_counts()
+        catalog = {
+            rid: {"n_trips": int(n), "n_stop_times": int(n_stop_times.get(rid, 0))}
+            for rid, n in n_trips.sort_index().items()
+        }
+        (tmp / "catalog.json").write_text(json.dumps(catalog), encoding="utf-8")
+        # 走到这里要么 force，要么旧 target 没有 catalog.json（半成品）：都换掉
+        publish_dir(tmp, target, replace=True)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # 同一 feed 的旧分区只留最近的一个
+    prune_stale((p for p in target.parent.glob(f"{subdir}-*") if p.is_dir()), target)
+    return target
+
+
+def load_route_tables(
+    subdir: str,
+    route_ids: Iterable[str],
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    partition_dir: Path = PARTITION_DIR,
+) -> Optional[Tables]:
+    """
+    (routes, stop_times, stops, trips) restricted to route_ids. With pyarrow only
+    the partitions of those routes are read; without it the full typed tables
+    are loaded and filtered.
+    """
+    wanted = [str(r) for r in route_ids]
+    target = compile_partitions(subdir, gtfs_dir, cache_dir, partition_dir)
+    if target is None:
+        tables = load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        if tables is None:
+            return None
+        routes, stop_times, stops, trips = tables
+        trips = trips[trips["route_id"].astype(str).isin(wanted)]
+        stop_times = stop_times[stop_times["trip_id"].astype(str).isin(trips["trip_id"].astype(str))]
+    else:
+        trips = read_partitions(target / "trips.arrow", wanted)
+        stop_times = read_partitions(target / "stop_times.arrow", wanted)
+        # routes / stops 很小，直接读 typed 缓存
+        feed = compile_feed(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        routes = _read_ipc(feed / _table_file("routes.txt"))
+        stops = _read_ipc(feed / _table_file("stops.txt"))
+
+    routes = routes[routes["route_id"].astype(str).isin(wanted)].reset_index(drop=True)
+    return routes, stop_times.reset_index(drop=True), stops, trips.reset_index(drop=True)
+
+
+def main(argv: List[str]) -> int:
+    if not _HAS_ARROW:
+        print("pyarrow is not installed; nothing to compile.")
+        return 1
+    force = "--force" in argv
+    subdirs = [a for a in argv if not a.startswith("--")]
+    subdirs = subdirs or sorted(p.name for p in GTFS_DIR.iterdir() if p.is_dir())
+    for subdir in subdirs:
+        target = compile_partitions(subdir, force=force)
+        print(f"{subdir}: {target if target else 'skipped (missing tables)'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,388 @@
+"""
+Parallel static preparation of all GTFS feeds.
+
+`python -m scripts.gtfs_prepare [--workers N] [--gtfs DIR_OR_ZIP] [--cache DIR] [--force] [--json] [subdir ...]`
+builds, for every feed, everything the dashboards load at start-up:
+
+- the typed table cache          (scripts/gtfs_cache.py)
+- the compact FeedModel          cache/models/<subdir>-<key>-m<MODEL_FORMAT>/
+- the route partitions + catalog (scripts/gtfs_partition.py)
+- the route geometry             (scripts/route_geometry.py)
+
+Feeds are independent, so they are prepared in a process pool, one feed per
+task, largest stop_times.txt first. The pool always belongs to a CLI process
+(spawned workers): an app calling prepare_feeds starts that CLI as a child
+instead of forking its own, already multi-threaded, process. Workers never send DataFrames back: each
+one writes its artifacts to disk (Arrow IPC / .npy) and returns only their
+paths. The parent then memory-maps those files, so the numeric columns and
+the model's CSR arrays are read-only pages shared through the OS page cache
+(by every worker, the parent, and any other app process on the host) instead
+of pickled copies.
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from scripts.gtfs_cache import (
+    CACHE_DIR,
+    GTFS_DIR,
+    LAST_INGEST,
+    ROOT,
+    _HAS_ARROW,
+    _read_ipc,
+    _write_ipc,
+    compile_feed,
+    load_tables,
+    prune_stale,
+    publish_dir,
+    source_key,
+)
+from scripts.gtfs_model import MODEL_ARRAYS, FeedModel, build_feed_model
+from scripts.gtfs_partition import compile_partitions, partition_path
+from scripts.gtfs_source import GTFSArchive, gtfs_root
+from scripts.route_geometry import compile_geometry, geometry_path
+
+MODEL_DIR = ROOT / "cache" / "models"
+
+# bump when the model layout changes
+MODEL_FORMAT = 1
+
+_MODEL_FRAMES = ("routes", "stops", "trips")
+
+
+# ---------------------------
+# FeedModel 落盘 / memory-map
+# ---------------------------
+def model_path(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    model_dir: Path = MODEL_DIR,
+) -> Optional[Path]:
+    key = source_key(gtfs_root(gtfs_dir) / subdir, Path(cache_dir) / subdir)
+    if key is None:
+        return None
+    return Path(model_dir) / f"{subdir}-{key}-m{MODEL_FORMAT}"
+
+
+def _write_model(model: FeedModel, target: Path, replace: bool = False) -> None:
+    # 小表走 Arrow IPC，CSR 数组各存一个 .npy（np.load(mmap_mode="r") 零拷贝）
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=target.parent))
+    try:
+        for name in _MODEL_FRAMES:
+            _write_ipc(getattr(model, name), tmp / f"{name}.arrow")
+        for name in MODEL_ARRAYS:
+            np.save(tmp / f"{name}.npy", np.ascontiguousarray(getattr(model, name)))
+        publish_dir(tmp, target, replace=replace)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # 同一 feed 的旧模型只留最近的一个
+    prefix = target.name.split("-", 1)[0] + "-"
+    prune_stale((p for p in target.parent.glob(f"{prefix}*") if p.is_dir()), target)
+
+
+def read_model(path: Path) -> FeedModel:
+    """FeedModel backed by the files in path; the arrays are read-only memory maps."""
+    frames = {name: _read_ipc(path / f"{name}.arrow") for name in _MODEL_FRAMES}
+    arrays = {name: np.asarray(np.load(path / f"{name}.npy", mmap_mode="r")) for name in MODEL_ARRAYS}
+    return FeedModel(**frames, **arrays)
+
+
+def compile_model(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    model_dir: Path = MODEL_DIR,
+    force: bool = False,
+    model: Optional[FeedModel] = None,
+) -> Optional[Path]:
+    """
+    Persist the (uncolored) FeedModel of GTFS/<subdir> if missing or force and
+    return its folder. None if the feed is missing or pyarrow is unavailable.
+    """
+    if not _HAS_ARROW:
+        return None
+    target = model_path(subdir, gtfs_dir, cache_dir, model_dir)
+    if target is None:
+        return None
+    if target.is_dir() and not force:
+        return target
+    if model is None:
+        model = build_feed_model(load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir))
+    _write_model(model, target, replace=force)
+    return target
+
+
+def load_prepared_model(
+    subdir: str,
+    color_overrides: Optional[Dict[str, str]] = None,
+    fixed_color: Optional[str] = None,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    model_dir: Path = MODEL_DIR,
+) -> Optional[FeedModel]:
+    """
+    FeedModel of GTFS/<subdir> memory-mapped from its prepared folder (compiled
+    on first use), with colors applied as in build_feed_model. Without pyarrow
+    the model is built in memory. Returns None if the feed is missing.
+    """
+    path = compile_model(subdir, gtfs_dir, cache_dir, model_dir)
+    if path is None:
+        tables = load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        if tables is None:
+            return None
+        return build_feed_model(tables, color_overrides, fixed_color)
+    return read_model(path).with_colors(color_overrides, fixed_color)
+
+
+# ---------------------------
+# 单个 feed（在 worker 进程里跑）
+# ---------------------------
+@dataclass(frozen=True)
+class PreparedFeed:
+    """What a worker hands back: artifact paths and timings only, no data."""
+    subdir: str
+    tables: Optional[Path] = None
+    model: Optional[Path] = None
+    partitions: Optional[Path] = None
+    geometry: Optional[Path] = None
+    seconds: float = 0.0
+    ingest: str = ""
+    error: str = ""
+    cached: bool = False  # 已是最新，没有重建
+
+    @property
+    def ok(self) -> bool:
+        return not self.error and self.tables is not None
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.subdir}: failed ({self.error})"
+        if self.tables is None:
+            return f"{self.subdir}: skipped (missing tables)"
+        if self.cached:
+            return f"{self.subdir}: up to date"
+        return f"{self.subdir}: {self.seconds:.1f}s" + (f" [{self.ingest}]" if self.ingest else "")
+
+
+def _current(subdir: str, gtfs_dir: Path, cache_dir: Path) -> Optional[PreparedFeed]:
+    """PreparedFeed if every artifact of subdir is already current (or the feed is missing), else None."""
+    key = source_key(gtfs_root(gtfs_dir) / subdir, Path(cache_dir) / subdir)
+    if key is None:
+        return PreparedFeed(subdir)  # 缺表的 feed 没什么可准备的
+    res = PreparedFeed(
+        subdir,
+        tables=Path(cache_dir) / subdir / key,
+        model=model_path(subdir, gtfs_dir, cache_dir),
+        partitions=partition_path(subdir, gtfs_dir, cache_dir),
+        geometry=geometry_path(subdir, gtfs_dir, cache_dir),
+        cached=True,
+    )
+    paths = (res.tables, res.model, res.partitions / "catalog.json", res.geometry)
+    return res if all(p.exists() for p in paths) else None
+
+
+def prepare_feed(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    force: bool = False,
+) -> PreparedFeed:
+    """Build every static artifact of one feed (see module docstring)."""
+    t0 = time.perf_counter()
+    try:
+        tables = compile_feed(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir, force=force)
+        if tables is None:
+            return PreparedFeed(subdir)
+        model = None
+        if force or not (
+            model_path(subdir, gtfs_dir, cache_dir).is_dir()
+            and geometry_path(subdir, gtfs_dir, cache_dir).exists()
+        ):
+            # 模型只建一次，几何直接复用
+            model = build_feed_model(load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir))
+        model_dir = compile_model(subdir, gtfs_dir, cache_dir, force=force, model=model)
+        partitions = compile_partitions(subdir, gtfs_dir, cache_dir, force=force)
+        geometry = compile_geometry(subdir, gtfs_dir, cache_dir, force=force, model=model)
+    except Exception as e:
+        return PreparedFeed(subdir, seconds=time.perf_counter() - t0, error=f"{type(e).__name__}: {e}")
+    ingest = LAST_INGEST.get(subdir)
+    return PreparedFeed(
+        subdir,
+        tables=tables,
+        model=model_dir,
+        partitions=partitions,
+        geometry=geometry,
+        seconds=time.perf_counter() - t0,
+        ingest=str(ingest) if ingest is not None else "",
+    )
+
+
+# ---------------------------
+# 进程池
+# ---------------------------
+def _feed_size(subdir: str, gtfs_dir: Path) -> int:
+    try:
+        return (gtfs_root(gtfs_dir) / subdir / "stop_times.txt").stat().st_size
+    except OSError:
+        return 0
+
+
+def _mp_context():
+    # spawn：worker 是全新解释器，不继承父进程里其他线程持有的锁（fork 在多线程进程里可能死锁）
+    return mp.get_context("spawn")
+
+
+def _is_entry_process() -> bool:
+    """True when this process was started as `python -m scripts.gtfs_prepare`."""
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    return getattr(spec, "name", None) == "scripts.gtfs_prepare"
+
+
+def _run_pool(pending: List[str], workers: int, gtfs_dir, cache_dir: Path, force: bool) -> Dict[str, PreparedFeed]:
+    done: Dict[str, PreparedFeed] = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as pool:
+        futures = {pool.submit(prepare_feed, s, gtfs_dir, cache_dir, force): s for s in pending}
+        for fut in as_completed(futures):
+            s = futures[fut]
+            try:
+                done[s] = fut.result()
+            except Exception as e:  # worker 进程异常退出
+                done[s] = PreparedFeed(s, error=f"{type(e).__name__}: {e}")
+    return done
+
+
+def _source_arg(gtfs_dir) -> str:
+    root = gtfs_root(gtfs_dir)
+    return str(root.path if isinstance(root, GTFSArchive) else Path(root).resolve())
+
+
+def _run_subprocess(pending: List[str], workers: int, gtfs_dir, cache_dir: Path, force: bool) -> Dict[str, PreparedFeed]:
+    """
+    The pool of a process that is not the CLI (app.py, the Streamlit server,
+    the dataset watcher) runs in a child `python -m scripts.gtfs_prepare`:
+    spawned workers re-import the parent's __main__, which for the apps is the
+    dashboard itself. Results come back as JSON lines.
+    """
+    cmd = [
+        sys.executable, "-m", "scripts.gtfs_prepare", "--json",
+        f"--workers={workers}", f"--gtfs={_source_arg(gtfs_dir)}", f"--cache={Path(cache_dir).resolve()}",
+    ]
+    if force:
+        cmd.append("--force")
+    proc = subprocess.run(cmd + pending, cwd=ROOT, capture_output=True, text=True)
+    done: Dict[str, PreparedFeed] = {}
+    for line in proc.stdout.splitlines():
+        try:
+            res = _from_json(json.loads(line))
+        except (ValueError, TypeError):
+            continue
+        done[res.subdir] = res
+    tail = proc.stderr.strip().splitlines()[-1:] or [f"exit code {proc.returncode}"]
+    for s in pending:
+        if s not in done:
+            done[s] = PreparedFeed(s, error=f"prepare process failed: {tail[0]}")
+    return done
+
+
+def _to_json(res: PreparedFeed) -> str:
+    return json.dumps({k: str(v) if isinstance(v, Path) else v for k, v in asdict(res).items()})
+
+
+def _from_json(d: dict) -> PreparedFeed:
+    paths = ("tables", "model", "partitions", "geometry")
+    return PreparedFeed(**{k: Path(v) if k in paths and v is not None else v for k, v in d.items()})
+
+
+def prepare_feeds(
+    subdirs: Iterable[str],
+    workers: Optional[int] = None,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    force: bool = False,
+) -> Dict[str, PreparedFeed]:
+    """
+    Prepare all subdirs, up to `workers` feeds at a time (default: CPU count),
+    and return {subdir: PreparedFeed}. Feeds whose artifacts are already
+    current are not sent to the pool; with nothing to do no process is started.
+    Outside the CLI the pool runs in a separate `python -m scripts.gtfs_prepare`
+    process, so it is safe to call from any thread of a running app.
+    Without pyarrow there is nothing to persist and {} is returned.
+    """
+    if not _HAS_ARROW:
+        return {}
+    subdirs = list(dict.fromkeys(subdirs))
+    done: Dict[str, PreparedFeed] = {}
+    if not force:
+        for s in subdirs:
+            res = _current(s, gtfs_dir, cache_dir)
+            if res is not None:
+                done[s] = res
+    # 最大的 feed 先跑，尾部不会只剩一个大 feed 拖着
+    pending = sorted((s for s in subdirs if s not in done), key=lambda s: _feed_size(s, gtfs_dir), reverse=True)
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+    if workers == 1:
+        for s in pending:
+            done[s] = prepare_feed(s, gtfs_dir, cache_dir, force)
+    elif pending:
+        run = _run_pool if _is_entry_process() else _run_subprocess
+        done.update(run(pending, workers, gtfs_dir, cache_dir, force))
+    return {s: done[s] for s in subdirs}
+
+
+def main(argv: List[str]) -> int:
+    if not _HAS_ARROW:
+        print("pyarrow is not installed; nothing to prepare.")
+        return 1
+    force = "--force" in argv
+    as_json = "--json" in argv
+    workers = None
+    source = GTFS_DIR
+    cache_dir = CACHE_DIR
+    args = []
+    it = iter(argv)
+    for a in it:
+        if a in ("--workers", "--gtfs", "--cache"):
+            a = f"{a}={next(it)}"
+        if a.startswith("--workers="):
+            workers = int(a.split("=", 1)[1])
+        elif a.startswith("--gtfs="):
+            # GTFS 目录或 release zip（直接读 zip 成员，不解压到磁盘）
+            source = gtfs_root(a.split("=", 1)[1])
+        elif a.startswith("--cache="):
+            cache_dir = Path(a.split("=", 1)[1])
+        elif not a.startswith("--"):
+            args.append(a)
+    subdirs = args or sorted(p.name for p in gtfs_root(source).iterdir() if p.is_dir())
+
+    t0 = time.perf_counter()
+    results = prepare_feeds(subdirs, workers=workers, gtfs_dir=source, cache_dir=cache_dir, force=force)
+    wall = time.perf_counter() - t0
+    for res in results.values():
+        # --json：每个 feed 一行，供 _run_subprocess 解析
+        print(_to_json(res) if as_json else res, flush=True)
+    if not as_json:
+        busy = sum(r.seconds for r in results.values())
+        print(f"total: {wall:.1f}s wall, {busy:.1f}s summed over feeds")
+    return 0 if all(not r.error for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,36 +1,158 @@
 from __future__ import annotations
 
+import hashlib
+import io
+import json
 import os
 import shutil
+import sys
 import zipfile
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
 import requests
 
+from scripts.gtfs_source import GTFSArchive, open_archive, relative_members
 
-def _download_file(
-    url: str,
-    out_path: Path,
-    token: Optional[str] = None,
-    timeout: int = 180,
-    chunk_size: int = 1024 * 1024,
-) -> None:
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+# 发布方在 GTFS.zip 旁边放一个 GTFS.manifest.json（python -m scripts.gtfs_release manifest GTFS.zip）：
+#   {"archive": {"sha256": ..., "size": ...},
+#    "files": {"subway/stops.txt": {"sha256": ..., "size": ..., "crc": ...}, ...}}
+MANIFEST_SUFFIX = ".manifest.json"
+
+DOWNLOAD_RETRIES = 3
+# 按 Range 读远端 zip 时每次至少取这么多字节（zipfile 的读都很小）
+RANGE_BLOCK = 1024 * 1024
 
+
+def _headers(token: Optional[str] = None) -> Dict[str, str]:
     headers = {
         "Accept": "application/octet-stream",
         "User-Agent": "gtfs-dashboard333",
     }
     if token:
         headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+def _sha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
 
-    with requests.get(url, stream=True, headers=headers, timeout=timeout, allow_redirects=True) as r:
-        r.raise_for_status()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
+def _content_range(r: requests.Response):
+    """(start, total) of a 206 reply's Content-Range, or None."""
+    unit, _, spec = r.headers.get("Content-Range", "").partition(" ")
+    span, _, total = spec.partition("/")
+    start = span.partition("-")[0]
+    if unit != "bytes" or not start.isdigit() or not total.isdigit():
+        return None
+    return int(start), int(total)
+
+
+def _download_file(
+    url: str,
+    out_path: Path,
+    token: Optional[str] = None,
+    timeout: int = 180,
+    chunk_size: int = 64 * 1024,
+    sha256: Optional[str] = None,
+    retries: int = DOWNLOAD_RETRIES,
+    validators: Optional[Dict[str, str]] = None,
+) -> Optional[Dict[str, str]]:
+    """
+    Download url to out_path through out_path + ".part". The reply's ETag /
+    Last-Modified and size are kept next to it (".part.json"), so an
+    interrupted download (this call or an earlier process) resumes with a
+    Range + If-Range request: if the asset changed meanwhile the server sends
+    it whole and the download restarts from zero. A .part without validators,
+    a 206 that does not continue it, or a 416 that does not confirm it is
+    complete are discarded. If sha256 is given the finished file must match
+    it; a mismatch restarts from zero within `retries`.
+
+    validators ({"etag", "last_modified"} of the copy already at out_path)
+    make a fresh download conditional (If-None-Match / If-Modified-Since): a
+    304 leaves out_path alone and returns None. Otherwise the validators of
+    the downloaded file are returned, for the next conditional request.
+    """
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    part = out_path.with_name(out_path.name + ".part")
+    meta_path = part.with_name(part.name + ".json")
+
+    def restart() -> None:
+        part.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+
+    for attempt in range(retries):
+        last = attempt == retries - 1
+        meta = (_read_manifest(meta_path) or {}) if part.exists() else {}
+        done = part.stat().st_size if part.exists() else 0
+        validator = meta.get("etag") or meta.get("last_modified")
+        if done and not (validator and meta.get("size")):
+            # 无法确认 .part 还是同一个文件：从头下
+            restart()
+            done = 0
+        headers = _headers(token)
+        if done:
+            headers["Range"] = f"bytes={done}-"
+            headers["If-Range"] = validator
+        elif validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        try:
+            with requests.get(url, stream=True, headers=headers, timeout=timeout, allow_redirects=True) as r:
+                if r.status_code == 304 and not done:
+                    return None
+                if r.status_code == 416 and done and done == meta["size"]:
+                    pass  # .part 已经完整（上次在 rename 之前中断）
+                elif r.status_code == 416 or (r.status_code == 206 and _content_range(r) != (done, meta.get("size"))):
+                    # 远端文件变了 / 续不上：丢掉 .part，下一轮从头下
+                    restart()
+                    if last:
+                        raise RuntimeError(f"Cannot resume download of {url} (HTTP {r.status_code})")
+                    continue
+                else:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        # 200：整份文件，先记下校验信息再写，断线后才能安全续传
+                        length = r.headers.get("Content-Length", "")
+                        plain = not r.headers.get("Content-Encoding")
+                        meta = {
+                            "etag": r.headers.get("ETag", ""),
+                            "last_modified": r.headers.get("Last-Modified", ""),
+                            "size": int(length) if length.isdigit() and plain else 0,
+                        }
+                        part.unlink(missing_ok=True)
+                        _write_manifest(meta_path, meta)
+                    with open(part, "ab") as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            if chunk:
+                                f.write(chunk)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            # 断线：保留 .part（最多丢掉最后一个 chunk），下一轮从断点续传
+            if last:
+                raise
+            continue
+
+        size = part.stat().st_size
+        if meta.get("size") and size != meta["size"]:
+            if last:
+                raise RuntimeError(f"Incomplete download of {url}: {size} of {meta['size']} bytes")
+            continue
+        if sha256 and _sha256(part) != sha256:
+            restart()
+            if last:
+                raise RuntimeError(f"SHA-256 mismatch for {url}")
+            continue
+        os.replace(part, out_path)
+        meta_path.unlink(missing_ok=True)
+        return {"etag": meta.get("etag", ""), "last_modified": meta.get("last_modified", "")}
+    return None
 
 
 def _safe_join(base: Path, rel: Path) -> Path:
@@ -50,38 +172,291 @@ def _unzip_strip_top_folder(zip_path: Path, out_dir: Path) -> None:
     out_dir.mkdir(parents=True, exist_ok=True)
 
     with zipfile.ZipFile(zip_path, "r") as z:
-        names = [n for n in z.namelist() if n and not n.endswith("/")]
-        if not names:
-            return
+        for rel, name in relative_members(z.namelist()).items():
+            dest = _safe_join(out_dir, Path(rel))
+            dest.parent.mkdir(parents=True, exist_ok=True)
+
+            with z.open(name) as src, open(dest, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+
+# ---------------------------
+# Manifest
+# ---------------------------
+def build_manifest(zip_path: Path) -> dict:
+    """Per-file SHA-256 / size / CRC of a GTFS zip (top folder stripped) + the archive's own SHA-256."""
+    zip_path = Path(zip_path)
+    files = {}
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for rel, name in sorted(relative_members(z.namelist()).items()):
+            if any(part.startswith(".") for part in rel.split("/")):
+                continue  # .ready 之类的标记文件不算数据
+            info = z.getinfo(name)
+            h = hashlib.sha256()
+            with z.open(info) as src:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    h.update(chunk)
+            files[rel] = {"sha256": h.hexdigest(), "size": info.file_size, "crc": info.CRC}
+    archive = {"sha256": _sha256(zip_path), "size": zip_path.stat().st_size}
+    return {"archive": archive, "files": files}
 
-        # compute top-level folder if uniform
-        first_parts = {Path(n).parts[0] for n in names if Path(n).parts}
-        strip_one = len(first_parts) == 1
-        top = next(iter(first_parts)) if strip_one else None
 
-        for member in z.infolist():
-            name = member.filename
-            if not name or name.endswith("/"):
-                continue
+def _folder_manifest(folder: Path) -> dict:
+    """build_manifest for an already extracted folder (hidden files such as .ready skipped)."""
+    files = {}
+    for path in sorted(folder.rglob("*")):
+        rel = path.relative_to(folder).as_posix()
+        if path.is_file() and not any(part.startswith(".") for part in rel.split("/")):
+            files[rel] = {"sha256": _sha256(path), "size": path.stat().st_size}
+    return {"files": files}
 
-            p = Path(name)
 
-            # strip the single top folder (commonly "GTFS")
-            if strip_one and top and p.parts and p.parts[0] == top:
-                rel = Path(*p.parts[1:])
-            else:
-                rel = p
+def manifest_url_for(asset_url: str) -> str:
+    """GTFS.zip -> GTFS.manifest.json next to it."""
+    base = asset_url[:-4] if asset_url.lower().endswith(".zip") else asset_url
+    return base + MANIFEST_SUFFIX
 
-            if not rel.parts:
-                continue
 
-            dest = _safe_join(out_dir, rel)
-            dest.parent.mkdir(parents=True, exist_ok=True)
+def fetch_manifest(url: str, token: Optional[str] = None, timeout: int = 30) -> Optional[dict]:
+    """The published manifest, or None if there is none (or it cannot be read)."""
+    headers = _headers(token)
+    headers["Accept"] = "application/octet-stream, application/json"
+    try:
+        r = requests.get(url, headers=headers, timeout=timeout, allow_redirects=True)
+        if r.status_code != 200:
+            return None
+        manifest = r.json()
+    except (requests.RequestException, ValueError):
+        return None
+    if not isinstance(manifest, dict) or "files" not in manifest:
+        return None
+    return manifest
 
-            with z.open(member) as src, open(dest, "wb") as dst:
-                shutil.copyfileobj(src, dst)
 
+def _read_manifest(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(path: Path, manifest: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.changed or self.removed)
+
+    @property
+    def fetch(self) -> List[str]:
+        """Files that have to be (re-)fetched."""
+        return self.added + self.changed
+
+    @property
+    def feeds(self) -> List[str]:
+        """Feed subdirs touched by the diff (top-level files such as the key files are not feeds)."""
+        paths = self.added + self.changed + self.removed
+        return sorted({p.split("/", 1)[0] for p in paths if "/" in p})
+
+    def __str__(self) -> str:
+        if self.empty:
+            return "no changes"
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed"
+            f" (feeds: {', '.join(self.feeds) or '-'})"
+        )
+
+
+def diff_manifests(old: Optional[dict], new: dict) -> ManifestDiff:
+    """File-level diff by SHA-256; without an old manifest every file counts as added."""
+    old_files = (old or {}).get("files", {})
+    new_files = new.get("files", {})
+    diff = ManifestDiff()
+    for rel, meta in sorted(new_files.items()):
+        if rel not in old_files:
+            diff.added.append(rel)
+        elif old_files[rel].get("sha256") != meta.get("sha256"):
+            diff.changed.append(rel)
+    diff.removed = sorted(set(old_files) - set(new_files))
+    return diff
+
+
+# ---------------------------
+# 只取远端 zip 里变了的成员（HTTP Range）
+# ---------------------------
+class _RangeUnsupported(RuntimeError):
+    pass
+
+
+class _HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable view of a remote file over HTTP Range requests, enough
+    for zipfile to read the central directory and single members without
+    downloading the whole archive. Reads are served from RANGE_BLOCK blocks.
+    """
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: int = 60) -> None:
+        super().__init__()
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._pos = 0
+        self._block_start = 0
+        self._block = b""
+        self.bytes_fetched = 0
+        self.size = self._probe_size()
+
+    def _get(self, start: int, end: int) -> requests.Response:
+        headers = _headers(self.token)
+        headers["Range"] = f"bytes={start}-{end}"
+        r = self._session.get(self.url, headers=headers, timeout=self.timeout, allow_redirects=True)
+        if r.status_code != 206:
+            r.close()
+            raise _RangeUnsupported(f"server ignored Range (HTTP {r.status_code})")
+        return r
+
+    def _probe_size(self) -> int:
+        r = self._get(0, 0)
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        if not total.isdigit():
+            raise _RangeUnsupported("no Content-Range total")
+        return int(total)
 
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self.size + offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        lo = self._pos - self._block_start
+        if lo < 0 or lo + n > len(self._block):
+            end = min(self.size, self._pos + max(n, RANGE_BLOCK)) - 1
+            self._block = self._get(self._pos, end).content
+            self._block_start = self._pos
+            self.bytes_fetched += len(self._block)
+            lo = 0
+        b[:n] = self._block[lo: lo + n]
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        self._session.close()
+        super().close()
+
+
+def _fetch_members(
+    asset_url: str,
+    files: Dict[str, dict],
+    rels: List[str],
+    out_dir: Path,
+    token: Optional[str] = None,
+) -> int:
+    """
+    Copy only `rels` out of the remote zip into out_dir (verified against the
+    manifest SHA-256). Returns the number of bytes fetched over the network.
+    Raises _RangeUnsupported if the server cannot serve byte ranges.
+    """
+    with _HTTPRangeFile(asset_url, token=token) as remote:
+        with zipfile.ZipFile(io.BufferedReader(remote, RANGE_BLOCK), "r") as z:
+            names = relative_members(z.namelist())
+            for rel in rels:
+                dest = _safe_join(out_dir, Path(rel))
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                tmp = dest.with_name(dest.name + ".part")
+                h = hashlib.sha256()
+                with z.open(names[rel]) as src, open(tmp, "wb") as dst:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                        h.update(chunk)
+                        dst.write(chunk)
+                if h.hexdigest() != files[rel]["sha256"]:
+                    tmp.unlink(missing_ok=True)
+                    raise RuntimeError(f"SHA-256 mismatch for {rel}")
+                os.replace(tmp, dest)
+        return remote.bytes_fetched
+
+
+def _copy_member(src: zipfile.ZipFile, name: str, out: zipfile.ZipFile, out_name: str) -> str:
+    """Stream one member into out (same compression and timestamp); returns its SHA-256."""
+    info = src.getinfo(name)
+    dst = zipfile.ZipInfo(out_name, date_time=info.date_time)
+    dst.compress_type = info.compress_type
+    dst.external_attr = info.external_attr
+    dst.file_size = info.file_size  # 让 zipfile 决定要不要 zip64
+    h = hashlib.sha256()
+    with src.open(info) as fin, out.open(dst, "w") as fout:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+            h.update(chunk)
+            fout.write(chunk)
+    return h.hexdigest()
+
+
+def _patch_archive(
+    asset_url: str,
+    files: Dict[str, dict],
+    rels: List[str],
+    zip_path: Path,
+    token: Optional[str] = None,
+) -> int:
+    """
+    Rebuild zip_path with the release zip's members: `rels` are read out of the
+    remote zip with Range requests (verified against the manifest SHA-256),
+    every other member is copied from the local zip, members gone from the
+    release are dropped. The new zip replaces zip_path atomically. Returns the
+    number of bytes fetched over the network. Raises _RangeUnsupported if the
+    server cannot serve byte ranges.
+    """
+    fetch = set(rels)
+    tmp = zip_path.with_name(zip_path.name + ".patch")
+    try:
+        with _HTTPRangeFile(asset_url, token=token) as raw:
+            with zipfile.ZipFile(io.BufferedReader(raw, RANGE_BLOCK), "r") as remote, zipfile.ZipFile(
+                zip_path, "r"
+            ) as local, zipfile.ZipFile(tmp, "w") as out:
+                local_names = relative_members(local.namelist())
+                for rel, name in relative_members(remote.namelist()).items():
+                    if rel in fetch or rel not in local_names:
+                        digest = _copy_member(remote, name, out, name)
+                    else:
+                        digest = _copy_member(local, local_names[rel], out, name)
+                    if rel in files and digest != files[rel]["sha256"]:
+                        raise RuntimeError(f"SHA-256 mismatch for {rel}")
+            fetched = raw.bytes_fetched
+        os.replace(tmp, zip_path)
+        return fetched
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+# ---------------------------
+# 解压到 GTFS/ 的 bootstrap
+# ---------------------------
 def ensure_gtfs_from_github_release(
     asset_url: str,
     gtfs_dir: str = "GTFS",
@@ -90,13 +465,43 @@ def ensure_gtfs_from_github_release(
     token: Optional[str] = None,
     force_redownload: bool = False,
     clean: bool = True,
+    manifest_url: Optional[str] = None,
 ) -> str:
+    """
+    Make gtfs_dir match the release. With a published manifest (default:
+    GTFS.manifest.json next to the zip) an existing folder is brought up to
+    date file by file: unchanged files are left alone (their typed caches stay
+    valid), changed / new files are read out of the remote zip with Range
+    requests, and removed files are deleted. Without a manifest, or if the
+    server cannot serve ranges, the zip is downloaded (resumably) and extracted.
+    """
     gtfs_path = Path(gtfs_dir)
     marker_path = Path(marker_file)
     zip_path = Path(cache_zip_path)
+    local_manifest_path = gtfs_path / MANIFEST_SUFFIX
+
+    remote = fetch_manifest(manifest_url or manifest_url_for(asset_url), token=token)
+    local = None
+    if marker_path.exists() and remote is not None:
+        # 旧版本解压出来的目录没有 manifest：按现有文件算一份
+        local = _read_manifest(local_manifest_path) or _folder_manifest(gtfs_path)
 
     if marker_path.exists() and not force_redownload:
-        return f"GTFS already ready (marker found at {marker_path})."
+        if remote is None:
+            return f"GTFS already ready (marker found at {marker_path})."
+        diff = diff_manifests(local, remote)
+        if local is not None and diff.empty:
+            return f"GTFS up to date ({len(remote['files'])} files match the release manifest)."
+        if local is not None:
+            try:
+                fetched = _fetch_members(asset_url, remote["files"], diff.fetch, gtfs_path, token=token)
+            except _RangeUnsupported:
+                pass  # 退回整包下载
+            else:
+                for rel in diff.removed:
+                    (gtfs_path / rel).unlink(missing_ok=True)
+                _write_manifest(local_manifest_path, remote)
+                return f"Updated GTFS in place: {diff}; fetched {fetched / 1e6:.1f} MB."
 
     # clean old contents to avoid mixing wrong layouts
     if clean and gtfs_path.exists():
@@ -107,10 +512,130 @@ def ensure_gtfs_from_github_release(
         except Exception:
             pass
 
-    _download_file(asset_url, zip_path, token=token)
+    sha = (remote or {}).get("archive", {}).get("sha256")
+    _download_file(asset_url, zip_path, token=token, sha256=sha)
     _unzip_strip_top_folder(zip_path, gtfs_path)
+    _write_manifest(local_manifest_path, remote or build_manifest(zip_path))
 
     marker_path.parent.mkdir(parents=True, exist_ok=True)
     marker_path.write_text("ok", encoding="utf-8")
 
     return f"Downloaded and extracted GTFS to '{gtfs_path}'."
+
+
+# ---------------------------
+# 直接读 zip 的 bootstrap
+# ---------------------------
+@dataclass
+class ArchiveSync:
+    archive: GTFSArchive
+    downloaded: bool = False
+    diff: ManifestDiff = field(default_factory=ManifestDiff)
+    message: str = ""
+
+
+def sync_gtfs_archive(
+    asset_url: str,
+    cache_zip_path: str = "cache/GTFS.zip",
+    token: Optional[str] = None,
+    force_redownload: bool = False,
+    manifest_url: Optional[str] = None,
+) -> ArchiveSync:
+    """
+    Bring cache_zip_path up to date with the release. If the published
+    manifest's archive SHA-256 equals the local one nothing is downloaded.
+    Otherwise the manifests are diffed per file and, when the server serves
+    byte ranges, only the added / changed members are fetched out of the
+    remote zip; the local zip is rebuilt from them plus its unchanged members
+    (_patch_archive). Without a previous manifest, or if ranges are not
+    supported or the patch fails verification, the whole zip is fetched
+    resumably and verified. Without a release manifest the asset itself is
+    requested conditionally (its ETag / Last-Modified from the last download),
+    so an unchanged release costs one 304. Feeds outside diff.feeds keep their content (and
+    zip CRCs), so their typed caches are reused rather than rebuilt.
+
+    After a patch the local zip is not byte-identical to the release zip; the
+    local manifest then records the release's archive SHA-256 for the
+    (size, mtime) of the rebuilt file, so the next sync still sees it as up to date.
+    """
+    zip_path = Path(cache_zip_path)
+    local_manifest_path = zip_path.with_name(zip_path.stem + MANIFEST_SUFFIX)
+    local = _read_manifest(local_manifest_path) if zipfile.is_zipfile(zip_path) else None
+    remote = fetch_manifest(manifest_url or manifest_url_for(asset_url), token=token)
+    validators = None
+
+    if local is not None and not force_redownload:
+        st_ = zip_path.stat()
+        # 本地 zip 的 sha 只在 (size, mtime) 变化时才重新算
+        if local.get("local") != [st_.st_size, st_.st_mtime_ns]:
+            local["archive"] = {"sha256": _sha256(zip_path), "size": st_.st_size}
+            local["local"] = [st_.st_size, st_.st_mtime_ns]
+            _write_manifest(local_manifest_path, local)
+        if remote is not None and remote.get("archive", {}).get("sha256") == local["archive"]["sha256"]:
+            return ArchiveSync(open_archive(zip_path), message="GTFS archive up to date.")
+        if remote is None:
+            # 没有 release manifest：对 asset 本身做条件请求
+            validators = local.get("asset")
+        elif local.get("files"):
+            diff = diff_manifests(local, remote)
+            try:
+                fetched = _patch_archive(asset_url, remote["files"], diff.fetch, zip_path, token=token)
+            except (_RangeUnsupported, RuntimeError, zipfile.BadZipFile, OSError, requests.RequestException):
+                pass  # 退回整包下载
+            else:
+                open_archive(zip_path).close()
+                st_ = zip_path.stat()
+                _write_manifest(local_manifest_path, {**remote, "local": [st_.st_size, st_.st_mtime_ns]})
+                return ArchiveSync(
+                    open_archive(zip_path),
+                    downloaded=True,
+                    diff=diff,
+                    message=f"Patched GTFS archive: {diff}; fetched {fetched / 1e6:.1f} MB.",
+                )
+
+    sha = (remote or {}).get("archive", {}).get("sha256")
+    asset = _download_file(asset_url, zip_path, token=token, sha256=sha, validators=validators)
+    if asset is None:
+        return ArchiveSync(open_archive(zip_path), message="GTFS archive not modified (no release manifest).")
+    if not zipfile.is_zipfile(zip_path):
+        zip_path.unlink(missing_ok=True)
+        raise RuntimeError(f"Downloaded asset is not a zip: {asset_url}")
+    # 旧的 archive 句柄指向被替换的文件，重新打开
+    open_archive(zip_path).close()
+
+    new = remote or build_manifest(zip_path)
+    diff = diff_manifests(local, new)
+    st_ = zip_path.stat()
+    _write_manifest(local_manifest_path, {**new, "local": [st_.st_size, st_.st_mtime_ns], "asset": asset})
+    return ArchiveSync(open_archive(zip_path), downloaded=True, diff=diff, message=f"Downloaded GTFS archive: {diff}.")
+
+
+def ensure_gtfs_archive(
+    asset_url: str,
+    cache_zip_path: str = "cache/GTFS.zip",
+    token: Optional[str] = None,
+    force_redownload: bool = False,
+    manifest_url: Optional[str] = None,
+) -> GTFSArchive:
+    """
+    Download the release zip (if missing, outdated or force_redownload) and
+    return it as a GTFSArchive: feeds are read from the zip in place, nothing
+    is extracted. See sync_gtfs_archive.
+    """
+    return sync_gtfs_archive(asset_url, cache_zip_path, token, force_redownload, manifest_url).archive
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) >= 2 and argv[0] == "manifest":
+        manifest = json.dumps(build_manifest(Path(argv[1])), indent=1, sort_keys=True)
+        if len(argv) >= 3:
+            Path(argv[2]).write_text(manifest, encoding="utf-8")
+        else:
+            print(manifest)
+        return 0
+    print("usage: python -m scripts.gtfs_release manifest GTFS.zip [GTFS.manifest.json]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,222 @@
+"""
+GTFS sources: an extracted GTFS/ folder or the release zip, read in place.
+
+The static pipeline only needs a small part of the pathlib API from a feed
+folder (`/`, is_file, stat, open, iterdir, name). `GTFSArchive` provides the
+same on top of a zipfile opened once: members are decompressed only when a
+reader opens them, straight into the CSV parser, and nothing is written next
+to the archive. A compiled feed (scripts/gtfs_cache.py) never touches the
+archive again, so only the feeds a user actually opens are ever decompressed.
+
+    gtfs_root("GTFS")            -> Path("GTFS")
+    gtfs_root("cache/GTFS.zip")  -> GTFSArchive (shared, one per zip path)
+
+If every member sits under one top-level folder (e.g. "GTFS/subway/..."),
+that folder is stripped, same as the extraction in scripts/gtfs_release.py.
+"""
+from __future__ import annotations
+
+import threading
+import zipfile
+from pathlib import Path, PurePosixPath
+from types import SimpleNamespace
+from typing import IO, Dict, Iterable, List, Optional, Union
+
+
+def relative_members(names: Iterable[str]) -> Dict[str, str]:
+    """
+    {relative posix path: member name} of the files in a zip, with the single
+    shared top-level folder (if any) stripped. Directory entries are skipped.
+    """
+    files = [n for n in names if n and not n.endswith("/")]
+    tops = {PurePosixPath(n).parts[0] for n in files if PurePosixPath(n).parts}
+    top = next(iter(tops)) if len(tops) == 1 else None
+    out: Dict[str, str] = {}
+    for name in files:
+        parts = PurePosixPath(name).parts
+        if top is not None and len(parts) > 1 and parts[0] == top:
+            parts = parts[1:]
+        if parts:
+            out["/".join(parts)] = name
+    return out
+
+
+class ZipEntry:
+    """One archive member, with the Path methods the GTFS readers use."""
+
+    def __init__(self, archive: "GTFSArchive", rel: str) -> None:
+        self.archive = archive
+        self.rel = rel
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.rel).name
+
+    def _info(self) -> Optional[zipfile.ZipInfo]:
+        return self.archive.info(self.rel)
+
+    def exists(self) -> bool:
+        return self._info() is not None
+
+    def is_file(self) -> bool:
+        return self.exists()
+
+    def is_dir(self) -> bool:
+        return False
+
+    def stat(self) -> SimpleNamespace:
+        info = self._info()
+        if info is None:
+            raise FileNotFoundError(str(self))
+        # zip 成员没有可靠的 mtime：用 CRC32 代替，内容一变签名就变
+        return SimpleNamespace(st_size=info.file_size, st_mtime_ns=info.CRC)
+
+    def open(self, mode: str = "rb") -> IO[bytes]:
+        if mode != "rb":
+            raise ValueError("archive members are read-only (mode='rb')")
+        return self.archive.open_member(self.rel)
+
+    def __str__(self) -> str:
+        return f"{self.archive.path}!{self.rel}"
+
+
+class ZipFolder:
+    """A folder inside the archive (a feed such as "subway")."""
+
+    def __init__(self, archive: "GTFSArchive", rel: str) -> None:
+        self.archive = archive
+        self.rel = rel.strip("/")
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.rel).name
+
+    def __truediv__(self, name: str) -> ZipEntry:
+        return ZipEntry(self.archive, f"{self.rel}/{name}")
+
+    def iterdir(self) -> List[ZipEntry]:
+        prefix = self.rel + "/"
+        return [
+            ZipEntry(self.archive, rel)
+            for rel in self.archive.members()
+            if rel.startswith(prefix) and "/" not in rel[len(prefix):]
+        ]
+
+    def exists(self) -> bool:
+        return self.is_dir()
+
+    def is_dir(self) -> bool:
+        prefix = self.rel + "/"
+        return any(rel.startswith(prefix) for rel in self.archive.members())
+
+    def is_file(self) -> bool:
+        return False
+
+    def __str__(self) -> str:
+        return f"{self.archive.path}!{self.rel}/"
+
+
+class GTFSArchive:
+    """
+    The GTFS release zip as a read-only root folder. The zipfile is opened on
+    first use and kept open; concurrent readers share it (zipfile serializes
+    the underlying seeks). Pickles as its path, so process-pool workers reopen
+    it on their side.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._zip: Optional[zipfile.ZipFile] = None
+        self._index: Dict[str, zipfile.ZipInfo] = {}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return (open_archive, (str(self.path),))
+
+    def _open(self) -> zipfile.ZipFile:
+        with self._lock:
+            if self._zip is None:
+                zf = zipfile.ZipFile(self.path, "r")
+                infos = {i.filename: i for i in zf.infolist()}
+                self._index = {rel: infos[name] for rel, name in relative_members(infos).items()}
+                self._zip = zf
+            return self._zip
+
+    def members(self) -> List[str]:
+        self._open()
+        return list(self._index)
+
+    def info(self, rel: str) -> Optional[zipfile.ZipInfo]:
+        self._open()
+        return self._index.get(rel)
+
+    def open_member(self, rel: str) -> IO[bytes]:
+        zf = self._open()
+        info = self._index.get(rel)
+        if info is None:
+            raise FileNotFoundError(f"{self.path}!{rel}")
+        return zf.open(info, "r")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+    # ---------- 根目录 ----------
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    def __truediv__(self, name: str) -> Union[ZipFolder, ZipEntry]:
+        rel = str(name).strip("/")
+        if self.info(rel) is not None:
+            return ZipEntry(self, rel)
+        return ZipFolder(self, rel)
+
+    def iterdir(self) -> List[Union[ZipFolder, ZipEntry]]:
+        tops = dict.fromkeys(rel.split("/", 1)[0] for rel in self.members())
+        return [self / t for t in tops]
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def is_dir(self) -> bool:
+        return self.exists()
+
+    def is_file(self) -> bool:
+        return False
+
+    def __str__(self) -> str:
+        return f"{self.path}!"
+
+
+_ARCHIVES: Dict[str, GTFSArchive] = {}
+_ARCHIVES_LOCK = threading.Lock()
+
+
+def open_archive(path: Union[str, Path]) -> GTFSArchive:
+    """The process-wide GTFSArchive of a zip path (opened once, then shared)."""
+    key = str(Path(path).resolve())
+    with _ARCHIVES_LOCK:
+        archive = _ARCHIVES.get(key)
+        if archive is None:
+            archive = _ARCHIVES[key] = GTFSArchive(key)
+        return archive
+
+
+def gtfs_root(gtfs_dir) -> Union[Path, GTFSArchive]:
+    """Root of a GTFS source: a GTFSArchive for archives / .zip paths, else a Path."""
+    if isinstance(gtfs_dir, GTFSArchive):
+        return gtfs_dir
+    path = Path(gtfs_dir)
+    if path.suffix.lower() == ".zip" and path.is_file():
+        return open_archive(path)
+    return path
+
+
+def open_binary(path) -> IO[bytes]:
+    """Open a file of either source for reading bytes."""
+    if isinstance(path, ZipEntry):
+        return path.open("rb")
+    return open(path, "rb")
@@ -0,0 +1,232 @@
+"""
+Versioned static GTFS datasets with an atomic "current" pointer.
+
+Every release archive is published read-only into its own folder, named by
+its content, and a one-line pointer file names the version in service:
+
+    cache/versions/<version>/GTFS.zip
+    cache/versions/CURRENT              (replaced atomically with os.replace)
+
+A new version never touches the folder of the one being served, so an update
+does not need a restart: `DatasetManager` keeps serving the active dataset,
+prepares the feeds in use for the new version in one background thread
+(scripts/gtfs_prepare.py), and only then switches `active()` over. Callers
+key their caches by `Dataset.version`, which gives double buffering for free:
+entries of the old version serve until the switch, entries of the new one
+are built from prepared artifacts, and the old ones age out.
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from scripts.gtfs_cache import ROOT, publish_dir
+from scripts.gtfs_prepare import prepare_feeds
+from scripts.gtfs_release import _sha256
+from scripts.gtfs_source import gtfs_root
+
+VERSIONS_DIR = ROOT / "cache" / "versions"
+CURRENT_FILE = "CURRENT"
+ARCHIVE_NAME = "GTFS.zip"
+
+# 保留几个版本（当前 + 上一个，其他进程可能还在用）
+KEEP_VERSIONS = 2
+# 多久检查一次 release 更新（秒）
+UPDATE_INTERVAL = 3600
+
+
+@dataclass(frozen=True)
+class Dataset:
+    version: str
+    source: Any  # Path 或 GTFSArchive，能直接当 gtfs_dir 传
+
+
+# ---------------------------
+# 版本目录 + 指针
+# ---------------------------
+def current_version(versions_dir: Path = VERSIONS_DIR) -> Optional[str]:
+    try:
+        version = (Path(versions_dir) / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    return version if version and (Path(versions_dir) / version / ARCHIVE_NAME).is_file() else None
+
+
+def set_current(version: str, versions_dir: Path = VERSIONS_DIR) -> None:
+    """Point CURRENT at version (write-then-rename, so readers see old or new, never half)."""
+    versions_dir = Path(versions_dir)
+    fd, tmp = tempfile.mkstemp(prefix=f".{CURRENT_FILE}-", dir=versions_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(tmp, versions_dir / CURRENT_FILE)
+
+
+def version_source(version: str, versions_dir: Path = VERSIONS_DIR):
+    return gtfs_root(Path(versions_dir) / version / ARCHIVE_NAME)
+
+
+def publish_archive(zip_path: Path, versions_dir: Path = VERSIONS_DIR, sha256: Optional[str] = None) -> str:
+    """
+    Publish a release zip as a read-only version folder (hard link when
+    possible) and return its version id; the pointer is not moved.
+    Publishing the same content twice is a no-op.
+    """
+    zip_path = Path(zip_path)
+    version = (sha256 or _sha256(zip_path))[:16]
+    target = Path(versions_dir) / version
+    if (target / ARCHIVE_NAME).is_file():
+        return version
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{version}-", dir=target.parent))
+    try:
+        try:
+            os.link(zip_path, tmp / ARCHIVE_NAME)
+        except OSError:
+            shutil.copy2(zip_path, tmp / ARCHIVE_NAME)
+        # target 存在却没有 archive：上次发布残留，换掉
+        publish_dir(tmp, target, replace=True)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp, ignore_errors=True)
+    return version
+
+
+def prune_versions(keep: Iterable[str], versions_dir: Path = VERSIONS_DIR, n: int = KEEP_VERSIONS) -> None:
+    """Delete version folders beyond the n most recent, never those in keep."""
+    keep = set(keep)
+    folders = [p for p in Path(versions_dir).iterdir() if p.is_dir() and not p.name.startswith(".")]
+    folders.sort(key=lambda p: p.stat().st_mtime_ns, reverse=True)
+    for old in folders[n:]:
+        if old.name not in keep:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+# ---------------------------
+# 进程内的双缓冲切换
+# ---------------------------
+class DatasetManager:
+    """
+    The dataset a process serves. active() is a plain reference read (never
+    blocks); when the CURRENT pointer names another version, the feeds this
+    process has used are prepared for it in a single background thread and
+    the reference is swapped afterwards. Concurrent callers during that time
+    keep getting the old dataset: there is one build per version, not one per
+    request.
+    """
+
+    def __init__(
+        self,
+        versions_dir: Path = VERSIONS_DIR,
+        warm: Optional[Callable[[Dataset, List[str]], None]] = None,
+    ) -> None:
+        self.versions_dir = Path(versions_dir)
+        self._warm = warm or _prepare_used
+        self._active: Optional[Dataset] = None
+        self._building: Optional[str] = None
+        self._pointer_seen: Optional[int] = None
+        self._used: Set[str] = set()
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self.last_error = ""
+
+    # ---------- 读取 ----------
+    def active(self) -> Optional[Dataset]:
+        self._check_pointer()
+        return self._active
+
+    def building(self) -> Optional[str]:
+        """Version being prepared in the background, if any."""
+        return self._building
+
+    def note_used(self, subdir: str) -> None:
+        """Remember that this process serves subdir (it gets warmed for the next version)."""
+        self._used.add(subdir)
+
+    # ---------- 切换 ----------
+    def _check_pointer(self) -> None:
+        try:
+            mtime = (self.versions_dir / CURRENT_FILE).stat().st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._pointer_seen and self._active is not None:
+            return
+        self._pointer_seen = mtime
+        version = current_version(self.versions_dir)
+        if version is None or (self._active is not None and self._active.version == version):
+            return
+        new = Dataset(version, version_source(version, self.versions_dir))
+        with self._lock:
+            if self._active is None:
+                # 冷启动：没有旧版本可以继续服务，直接用新版本
+                self._active = new
+                return
+            if self._building == version:
+                return
+            self._building = version
+        threading.Thread(target=self._build, args=(new,), name=f"dataset-{version}", daemon=True).start()
+
+    def _build(self, new: Dataset) -> None:
+        try:
+            self._warm(new, sorted(self._used))
+        except Exception as e:  # 预热失败也切换：之后按需构建
+            self.last_error = f"{type(e).__name__}: {e}"
+        with self._lock:
+            old = self._active
+            self._active = new
+            self._building = None
+        prune_versions({new.version, old.version if old else ""}, self.versions_dir)
+
+    def publish(self, zip_path: Path, sha256: Optional[str] = None) -> str:
+        """Publish zip_path as a version, move CURRENT to it and start the switch-over."""
+        version = publish_archive(zip_path, self.versions_dir, sha256)
+        if current_version(self.versions_dir) != version:
+            set_current(version, self.versions_dir)
+        self._check_pointer()
+        return version
+
+    # ---------- 定期检查 release ----------
+    def start_watcher(self, sync: Callable[[], Any], interval: float = UPDATE_INTERVAL) -> None:
+        """
+        Every interval seconds call sync() (e.g. scripts.gtfs_release.sync_gtfs_archive);
+        when it downloaded a new archive, publish it.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        def loop() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    res = sync()
+                    if res.downloaded:
+                        self.publish(res.archive.path)
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+
+        self._watcher = threading.Thread(target=loop, name="dataset-watcher", daemon=True)
+        self._watcher.start()
+
+
+def _prepare_used(dataset: Dataset, subdirs: List[str]) -> None:
+    # 只准备这个进程已经在用的 feed；其余的仍然首次打开时再解压
+    if subdirs:
+        prepare_feeds(subdirs, gtfs_dir=dataset.source)
+
+
+_MANAGERS: Dict[str, DatasetManager] = {}
+_MANAGERS_LOCK = threading.Lock()
+
+
+def get_manager(versions_dir: Path = VERSIONS_DIR) -> DatasetManager:
+    """The process-wide DatasetManager of versions_dir."""
+    key = str(Path(versions_dir).resolve())
+    with _MANAGERS_LOCK:
+        if key not in _MANAGERS:
+            _MANAGERS[key] = DatasetManager(versions_dir)
+        return _MANAGERS[key]
@@ -0,0 +1,402 @@
+"""
+Prebuilt route geometry.
+
+`python -m scripts.route_geometry [subdir ...]` groups every feed's trips into
+stop patterns, merges each route's patterns into the polylines needed to
+cover all of its branches, and stores the result as one Arrow IPC file per
+feed, one record batch per route:
+
+    cache/geometry/<subdir>-<key>-g<GEOMETRY_FORMAT>.arrow
+
+<key> is the same content key as the typed table cache (scripts/gtfs_cache.py),
+so the artifact is rebuilt only when the GTFS source changes. At runtime
+`load_route_lines` memory-maps that file (only the batches of the selected
+routes, if any) and slices it into the
+{route_id: [segment DataFrame, ...]} layout the map builders draw, without
+loading stop_times at all.
+
+With a ServiceDay (scripts/gtfs_calendar.py) the geometry covers only that
+day's active trips; those variants are kept next to the full one, keyed by
+the day's service set (every weekday shares one file):
+
+    cache/geometry/days/<subdir>-<key>-<day key>-g<GEOMETRY_FORMAT>.arrow
+
+Every point also carries a level of detail ("lod"): segments are simplified
+with Douglas–Peucker at the tolerance of LOD_PIXELS screen pixels for each
+zoom in LOD_ZOOMS, and a point's lod is the first level whose simplification
+keeps it (len(LOD_ZOOMS) = only at full detail). The levels are nested, so
+`simplify_lines(lines, zoom)` is one comparison per point.
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_cache import (
+    CACHE_DIR,
+    CACHE_KEEP,
+    GTFS_DIR,
+    ROOT,
+    _HAS_ARROW,
+    load_tables,
+    prune_stale,
+    source_key,
+)
+from scripts.gtfs_calendar import ServiceDay, working_model
+from scripts.gtfs_model import FeedModel, build_feed_model
+from scripts.gtfs_partition import load_route_tables, read_metadata, read_partitions, write_partitioned
+from scripts.gtfs_source import gtfs_root
+
+GEOMETRY_DIR = ROOT / "cache" / "geometry"
+
+# bump when the segmentation rules / file layout change
+GEOMETRY_FORMAT = 4
+
+# LOD 金字塔：每层对应一个缩放级别，容差为该级别下 LOD_PIXELS 个像素
+LOD_ZOOMS = (10, 12, 14)
+LOD_PIXELS = 1.0
+# 赤道处 zoom 0 每像素多少米（512 px 瓦片）
+_M_PER_PX_Z0 = 40_075_016.686 / 512
+
+# 每个 feed 保留几个服务日变体（工作日 / 周六 / 周日 + 一个节假日）
+DAY_GEOMETRY_KEEP = 4
+
+LINE_COLUMNS = [
+    "route_id",
+    "trip_id",
+    "stop_sequence",
+    "stop_id",
+    "stop_lat",
+    "stop_lon",
+    "route_long_name",
+    "color",
+    "stop_name",
+]
+
+RouteLines = Dict[str, List[pd.DataFrame]]
+
+
+# ---------------------------
+# 计算
+# ---------------------------
+def dp_significance(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Douglas–Peucker significance of every vertex: the largest tolerance at
+    which simplification still keeps it (endpoints: inf). Capped by the
+    parent split, so the point sets for decreasing tolerances are nested.
+    """
+    n = len(x)
+    sig = np.zeros(n)
+    if n == 0:
+        return sig
+    sig[0] = sig[-1] = np.inf
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        a, b, cap = stack.pop()
+        if b - a < 2:
+            continue
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        length2 = dx * dx + dy * dy
+        # 到线段（不是直线）的距离，环线首尾重合时也成立
+        t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0) if length2 > 0 else 0.0
+        d = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(d))
+        m = a + 1 + i
+        sig[m] = min(float(d[i]), cap)
+        stack.append((a, m, sig[m]))
+        stack.append((m, b, sig[m]))
+    return sig
+
+
+def lod_tolerances(lat: float) -> np.ndarray:
+    """Tolerance in metres of every LOD level at latitude lat (coarsest first)."""
+    m_per_px = _M_PER_PX_Z0 * math.cos(math.radians(lat))
+    return np.asarray([LOD_PIXELS * m_per_px / 2 ** z for z in LOD_ZOOMS])
+
+
+def segment_lod(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """int8 level of detail of every point of one polyline (see module docstring)."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) == 0:
+        return np.empty(0, dtype=np.int8)
+    lat0 = float(np.nanmean(lat))
+    x = lon * 111_320.0 * math.cos(math.radians(lat0))
+    y = lat * 110_540.0
+    sig = dp_significance(x, y)
+    # 容差从粗到细递减：sig 小于前几层的容差 -> 从下一层开始出现
+    return (sig[:, None] < lod_tolerances(lat0)[None, :]).sum(axis=1).astype(np.int8)
+
+
+def lod_for_zoom(zoom: float) -> int:
+    """Level to draw at zoom: the coarsest one at least as fine as a pixel there."""
+    for i, z in enumerate(LOD_ZOOMS):
+        if zoom <= z:
+            return i
+    return len(LOD_ZOOMS)
+
+
+def simplify_lines(lines: RouteLines, zoom: float) -> RouteLines:
+    """lines at the level of detail of zoom (unchanged past the finest level)."""
+    return lines_at_level(lines, lod_for_zoom(zoom))
+
+
+def lines_at_level(lines: RouteLines, level: int) -> RouteLines:
+    if level >= len(LOD_ZOOMS):
+        return lines
+    out: RouteLines = {}
+    for rid, subs in lines.items():
+        out[rid] = [s[s["lod"].to_numpy() <= level] if "lod" in s.columns else s for s in subs]
+    return out
+
+
+def _route_polylines(model: FeedModel, reps: np.ndarray, lat: np.ndarray, lon: np.ndarray):
+    """
+    Merge one route's stop patterns (most frequent first) into a minimal set of
+    polylines: every stop-to-stop edge is drawn once, so a pattern only adds the
+    runs of edges no earlier pattern covered (a branch, an extension). Reverse
+    directions and short turns add nothing.
+    Yields (row array, pattern index) per polyline.
+    """
+    covered = set()
+    for k, trip in enumerate(reps):
+        rows = model.ordered_rows(int(trip))
+        stop = model.st_stop[rows]
+        ok = ~(np.isnan(lat[stop]) | np.isnan(lon[stop]))
+        rows, stop = rows[ok], stop[ok]
+        if len(rows) < 2:
+            continue
+        # 连续坐标相同的站只留一个
+        moved = np.ones(len(rows), dtype=bool)
+        moved[1:] = (lat[stop[1:]] != lat[stop[:-1]]) | (lon[stop[1:]] != lon[stop[:-1]])
+        rows, stop = rows[moved], stop[moved]
+
+        run: List[int] = []
+        for i in range(1, len(rows)):
+            a, b = int(stop[i - 1]), int(stop[i])
+            edge = (a, b) if a < b else (b, a)
+            if edge in covered:
+                if len(run) >= 2:
+                    yield np.asarray(run, dtype=np.int64), k
+                run = []
+                continue
+            covered.add(edge)
+            if not run:
+                run = [int(rows[i - 1])]
+            run.append(int(rows[i]))
+        if len(run) >= 2:
+            yield np.asarray(run, dtype=np.int64), k
+
+
+def build_route_geometry(model: FeedModel) -> pd.DataFrame:
+    """
+    All drawable points of all routes in one frame (LINE_COLUMNS + "n_trips" +
+    "segment"), ordered by route_id, then segment, then stop order.
+
+    Trips are grouped into stop patterns (FeedModel.stop_patterns, hashed
+    sequences), and each route's patterns are merged into the fewest polylines
+    that still cover every branch. n_trips is the frequency of the pattern a
+    polyline comes from; lod is the point's level of detail.
+    """
+    columns = LINE_COLUMNS + ["n_trips", "segment", "lod"]
+    if model is None or model.empty:
+        return pd.DataFrame(columns=columns)
+
+    _trip_pattern, patterns = model.stop_patterns()
+    if patterns.empty:
+        return pd.DataFrame(columns=columns)
+    patterns = patterns.sort_values(
+        ["route_idx", "n_trips", "n_stops"], ascending=[True, False, False], kind="stable"
+    )
+    by_route = {r: g for r, g in patterns.groupby("route_idx", sort=False)}
+
+    lat = model.stops["stop_lat"].to_numpy()
+    lon = model.stops["stop_lon"].to_numpy()
+    pieces: List[np.ndarray] = []
+    freq: List[int] = []
+    for rid in model.route_ids():
+        g = by_route.get(model.route_index(rid))
+        if g is None:
+            continue
+        n_trips = g["n_trips"].to_numpy()
+        for rows, k in _route_polylines(model, g["rep_trip"].to_numpy(), lat, lon):
+            pieces.append(rows)
+            freq.append(int(n_trips[k]))
+    if not pieces:
+        return pd.DataFrame(columns=columns)
+
+    sizes = np.asarray([len(p) for p in pieces])
+    points = model.stop_times_frame(np.concatenate(pieces), LINE_COLUMNS)
+    points["n_trips"] = np.repeat(np.asarray(freq, dtype=np.int32), sizes)
+    points["segment"] = np.repeat(np.arange(len(pieces), dtype=np.int32), sizes)
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    p_lat = points["stop_lat"].to_numpy(dtype=np.float64)
+    p_lon = points["stop_lon"].to_numpy(dtype=np.float64)
+    points["lod"] = np.concatenate(
+        [segment_lod(p_lat[a:b], p_lon[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+    )
+    return points
+
+
+def split_route_lines(points: pd.DataFrame, route_ids: List[str]) -> RouteLines:
+    """{route_id: [segment frame, ...]}; routes without drawable segments map to []."""
+    res: RouteLines = {str(rid): [] for rid in route_ids}
+    if points.empty:
+        return res
+    seg = points["segment"].to_numpy()
+    bounds = np.flatnonzero(np.diff(seg)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(seg)]))
+    route_col = points["route_id"].astype(str).to_numpy()
+    frame = points.drop(columns="segment")
+    for a, b in zip(starts, ends):
+        res.setdefault(route_col[a], []).append(frame.iloc[a:b])
+    return res
+
+
+# ---------------------------
+# Artifact 读写
+# ---------------------------
+def geometry_path(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    geometry_dir: Path = GEOMETRY_DIR,
+    day: Optional[ServiceDay] = None,
+) -> Optional[Path]:
+    key = source_key(gtfs_root(gtfs_dir) / subdir, Path(cache_dir) / subdir)
+    if key is None:
+        return None
+    if day is not None:
+        return Path(geometry_dir) / "days" / f"{subdir}-{key}-{day.key}-g{GEOMETRY_FORMAT}.arrow"
+    return Path(geometry_dir) / f"{subdir}-{key}-g{GEOMETRY_FORMAT}.arrow"
+
+
+def _write_geometry(points: pd.DataFrame, route_ids: List[str], path: Path, keep: int = CACHE_KEEP) -> None:
+    # 每条线路一个 record batch，按需只读选中的线路
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.stem}-", dir=path.parent)
+    os.close(fd)
+    try:
+        write_partitioned(
+            points,
+            points["route_id"].astype(str).to_numpy(),
+            Path(tmp),
+            metadata={"route_ids": json.dumps([str(r) for r in route_ids])},
+        )
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    # 同一 feed 的旧 artifact 只留最近的 keep 个
+    prefix = path.name.split("-", 1)[0] + "-"
+    prune_stale(path.parent.glob(f"{prefix}*.arrow"), path, keep)
+
+
+def _read_geometry(path: Path, route_ids: Optional[List[str]] = None):
+    all_ids = json.loads(read_metadata(path).get("route_ids", "[]"))
+    if route_ids is None:
+        return read_partitions(path), all_ids
+    known = set(all_ids)
+    wanted = [r for r in route_ids if r in known]
+    return read_partitions(path, wanted), wanted
+
+
+def compile_geometry(
+    subdir: str,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    geometry_dir: Path = GEOMETRY_DIR,
+    force: bool = False,
+    model: Optional[FeedModel] = None,
+    day: Optional[ServiceDay] = None,
+) -> Optional[Path]:
+    """
+    Build the geometry artifact of GTFS/<subdir> (if missing or force) and return it,
+    restricted to the active trips of day if given. Returns None if the feed is
+    missing or pyarrow is unavailable.
+    """
+    if not _HAS_ARROW:
+        return None
+    path = geometry_path(subdir, gtfs_dir, cache_dir, geometry_dir, day)
+    if path is None:
+        return None
+    if path.exists() and not force:
+        return path
+
+    if model is None:
+        tables = load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        model = build_feed_model(tables)
+    model = working_model(model, day)
+    keep = CACHE_KEEP if day is None else DAY_GEOMETRY_KEEP
+    _write_geometry(build_route_geometry(model), model.route_ids(), path, keep)
+    return path
+
+
+def load_route_lines(
+    subdir: str,
+    route_ids: Optional[List[str]] = None,
+    color_overrides: Optional[Dict[str, str]] = None,
+    fixed_color: Optional[str] = None,
+    gtfs_dir: Path = GTFS_DIR,
+    cache_dir: Path = CACHE_DIR,
+    geometry_dir: Path = GEOMETRY_DIR,
+    day: Optional[ServiceDay] = None,
+) -> RouteLines:
+    """
+    {route_id: [segment frame, ...]} for GTFS/<subdir>, read from the prebuilt
+    artifact (compiled on first use). Route colors are stored as in routes.txt;
+    color_overrides / fixed_color are applied here, same as build_feed_model.
+    route_ids restricts the result to those routes; only their record batches
+    are read. day restricts it to the routes / patterns active on that service
+    day. Without pyarrow the geometry is computed in memory.
+    """
+    if route_ids is not None:
+        route_ids = [str(r) for r in route_ids]
+    path = compile_geometry(subdir, gtfs_dir, cache_dir, geometry_dir, day=day)
+    if path is not None:
+        points, route_ids = _read_geometry(path, route_ids)
+    else:
+        if route_ids is None:
+            tables = load_tables(subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        else:
+            tables = load_route_tables(subdir, route_ids, gtfs_dir=gtfs_dir, cache_dir=cache_dir)
+        if tables is None:
+            return {}
+        model = working_model(build_feed_model(tables), day)
+        points, route_ids = build_route_geometry(model), model.route_ids()
+
+    if not points.empty and (color_overrides or fixed_color):
+        rid = points["route_id"].astype(str)
+        if color_overrides:
+            points["color"] = rid.map(color_overrides).fillna(points["color"].astype(object))
+        if fixed_color:
+            points["color"] = fixed_color
+    return split_route_lines(points, route_ids)
+
+
+def main(argv: list[str]) -> int:
+    if not _HAS_ARROW:
+        print("pyarrow is not installed; nothing to compile.")
+        return 1
+    force = "--force" in argv
+    subdirs = [a for a in argv if not a.startswith("--")]
+    subdirs = subdirs or sorted(p.name for p in GTFS_DIR.iterdir() if p.is_dir())
+    for subdir in subdirs:
+        path = compile_geometry(subdir, force=force)
+        print(f"{subdir}: {path if path else 'skipped (missing tables)'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,166 @@
+"""
+Scheduled-departure index: next scheduled departure per (route, stop).
+
+Built once per service day from the working FeedModel (scripts/gtfs_calendar.py),
+so it can stand in for realtime arrivals when a feed is down or does not
+cover a route. Every stop_time becomes one packed int64
+
+    ((route_idx * n_stops + stop_idx) << TIME_BITS) | seconds
+
+with seconds counted from midnight of the service date (>24:00:00 kept as is;
+the previous day's after-midnight trips are shifted back by 24h). One sorted
+array holds the whole day, so a batch of lookups is a single np.searchsorted:
+the first entry at or after (key, now) is the next departure when it still
+carries the same key.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_calendar import DAY_SECONDS, SERVICE_TZ, ServiceDay
+from scripts.gtfs_model import FeedModel
+
+# 低位放时间：2**20 秒约 12 天，GTFS 时间最多 48h 左右
+TIME_BITS = 20
+_TIME_MASK = (1 << TIME_BITS) - 1
+
+MISSING = -1
+
+
+def seconds_now(now: Optional[datetime] = None) -> int:
+    """Seconds since local (SERVICE_TZ) midnight."""
+    now = (now or datetime.now(SERVICE_TZ)).astimezone(SERVICE_TZ)
+    return now.hour * 3600 + now.minute * 60 + now.second
+
+
+def format_seconds(secs: int) -> str:
+    """GTFS seconds -> "HH:MM" on the clock (25:10 -> 01:10)."""
+    if secs < 0:
+        return "N/A"
+    secs = int(secs) % DAY_SECONDS
+    return f"{secs // 3600:02d}:{secs % 3600 // 60:02d}"
+
+
+# 一天每分钟一个 "HH:MM"，批量格式化时查表
+_CLOCK = np.asarray([f"{m // 60:02d}:{m % 60:02d}" for m in range(DAY_SECONDS // 60)], dtype=object)
+
+
+def format_seconds_array(secs) -> np.ndarray:
+    """format_seconds over an array (object array of "HH:MM" / "N/A")."""
+    secs = np.asarray(secs, dtype=np.int64)
+    out = _CLOCK[(np.maximum(secs, 0) % DAY_SECONDS) // 60]
+    out[secs < 0] = "N/A"
+    return out
+
+
+@dataclass
+class ScheduleIndex:
+    route_index: pd.Index  # route_id -> route_idx
+    stop_index: pd.Index  # stop_id -> stop_idx
+    packed: np.ndarray  # sorted int64, see module docstring
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.stop_index)
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def _keys(self, route_ids, stop_ids) -> np.ndarray:
+        r = self.route_index.get_indexer(pd.Index(np.asarray(route_ids, dtype=object).astype(str)))
+        s = self.stop_index.get_indexer(pd.Index(np.asarray(stop_ids, dtype=object).astype(str)))
+        keys = r.astype(np.int64) * self.n_stops + s
+        return np.where((r >= 0) & (s >= 0), keys, -1)
+
+    def next_departures(self, route_ids: Iterable, stop_ids: Iterable, now: int) -> np.ndarray:
+        """
+        Next scheduled departure (seconds since service-day midnight, may exceed
+        86400) at or after now for every (route_id, stop_id) pair; -1 if none.
+        A scalar route_id is broadcast over stop_ids.
+        """
+        return self.next_for_keys(self.lookup_keys(route_ids, stop_ids), now)
+
+    def lookup_keys(self, route_ids, stop_ids: Iterable) -> np.ndarray:
+        """
+        (route, stop) keys of next_for_keys, -1 where unknown; callers that look
+        up the same pairs again and again (map figures) compute them once.
+        """
+        stop_ids = np.asarray(list(stop_ids), dtype=object)
+        if np.ndim(route_ids) == 0:
+            route_ids = np.full(len(stop_ids), route_ids, dtype=object)
+        return self._keys(route_ids, stop_ids)
+
+    def next_for_keys(self, keys: np.ndarray, now: int) -> np.ndarray:
+        """next_departures for keys from lookup_keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        out = np.full(len(keys), MISSING, dtype=np.int64)
+        if len(self.packed) == 0 or len(keys) == 0:
+            return out
+        pos = np.searchsorted(self.packed, (np.maximum(keys, 0) << TIME_BITS) | max(int(now), 0))
+        found = pos < len(self.packed)
+        hit = self.packed[np.minimum(pos, len(self.packed) - 1)]
+        found &= (keys >= 0) & ((hit >> TIME_BITS) == keys)
+        out[found] = hit[found] & _TIME_MASK
+        return out
+
+    def next_departure(self, route_id, stop_id, now: int) -> int:
+        return int(self.next_departures(route_id, [stop_id], now)[0])
+
+    def served_stops(self) -> np.ndarray:
+        """stop_idx of every stop with at least one departure (sorted)."""
+        return np.unique(self._pair_keys() % max(self.n_stops, 1))
+
+    def _pair_keys(self) -> np.ndarray:
+        # packed 已排序：相邻去重就是所有 (route, stop) key
+        keys = self.packed >> TIME_BITS
+        return keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+
+    def next_at_stops(self, stop_idx, now: int) -> pd.DataFrame:
+        """
+        Next scheduled departure of every route serving the given stops
+        (stop_idx), one row per (stop, route): stop_id, route_id, next (-1 = none left today).
+        """
+        keys = self._pair_keys()
+        stops = keys % max(self.n_stops, 1)
+        keys = keys[np.isin(stops, np.asarray(stop_idx))]
+        route_ids = self.route_index.to_numpy()[keys // max(self.n_stops, 1)]
+        stop_ids = self.stop_index.to_numpy()[keys % max(self.n_stops, 1)]
+        return pd.DataFrame(
+            {"stop_id": stop_ids, "route_id": route_ids, "next": self.next_departures(route_ids, stop_ids, now)}
+        )
+
+
+def build_schedule_index(model: FeedModel, day: Optional[ServiceDay] = None) -> ScheduleIndex:
+    """
+    Index the departures of model (normally the working model of day). With day,
+    trips of the previous service date (day.carry) also count at time - 24h
+    for their after-midnight stops.
+    """
+    route_index = pd.Index(model.routes["route_id"].astype(str).to_numpy(dtype=object))
+    stop_index = pd.Index(model.stops["stop_id"].astype(str).to_numpy(dtype=object))
+
+    counts = model.trip_stop_counts()
+    trip_of_row = np.repeat(np.arange(model.n_trips, dtype=np.int64), counts)
+    route = model.trips["route_idx"].to_numpy().astype(np.int64)[trip_of_row]
+    times = np.where(model.st_departure >= 0, model.st_departure, model.st_arrival).astype(np.int64)
+    keys = route * len(stop_index) + model.st_stop
+
+    ok = (route >= 0) & (model.st_stop >= 0) & (times >= 0)
+    parts = []
+    if day is None:
+        parts.append((keys[ok], times[ok]))
+    else:
+        service = model.trips["service_id"]
+        today = day.today_mask(service)[trip_of_row]
+        carry = day.carry_mask(service)[trip_of_row]
+        parts.append((keys[ok & today], times[ok & today]))
+        late = ok & carry & (times >= DAY_SECONDS)
+        parts.append((keys[late], times[late] - DAY_SECONDS))
+
+    packed = np.concatenate([(k.astype(np.int64) << TIME_BITS) | t for k, t in parts])
+    return ScheduleIndex(route_index, stop_index, np.unique(packed))
@@ -0,0 +1,245 @@
+"""
+Spatial indexes for viewport culling and nearest-stop queries.
+
+- `StopGrid`: stops bucketed into a uniform lat/lon grid (CSR layout: the
+  stops of cell c are order[offsets[c]:offsets[c + 1]]). A bbox query reads
+  only the cells it overlaps; k-nearest grows a square of cells until it
+  provably contains the k closest stops.
+- `SegmentIndex`: the bounding box of every drawable segment of a feed's
+  route geometry (scripts/route_geometry.py), as flat arrays, so culling a
+  whole borough against the viewport is one vectorized comparison.
+- `Viewport`: map center / zoom / size in pixels -> the visible bbox, using
+  the same Web Mercator math as the MapLibre maps.
+
+Distances are equirectangular metres, exact enough at city scale.
+"""
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# (min_lat, min_lon, max_lat, max_lon)
+BBox = Tuple[float, float, float, float]
+
+# 默认格子大小（度）：约 550 m × 420 m
+GRID_CELL_DEG = 0.005
+# 格子数上限（覆盖范围很大的 feed 自动放大格子）
+_MAX_CELLS = 1_000_000
+
+_M_PER_DEG_LAT = 110_540.0
+_M_PER_DEG_LON = 111_320.0
+# MapLibre 的瓦片是 512 px
+_TILE_PX = 512
+
+
+def distance_m(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    dx = (np.asarray(lon) - lon0) * (_M_PER_DEG_LON * math.cos(math.radians(lat0)))
+    dy = (np.asarray(lat) - lat0) * _M_PER_DEG_LAT
+    return np.hypot(dx, dy)
+
+
+# ---------------------------
+# 视口
+# ---------------------------
+@dataclass(frozen=True)
+class Viewport:
+    center_lat: float
+    center_lon: float
+    zoom: float
+    width_px: int = 1400
+    height_px: int = 800
+
+    @property
+    def bbox(self) -> BBox:
+        """Visible (min_lat, min_lon, max_lat, max_lon) in Web Mercator."""
+        world = _TILE_PX * 2 ** self.zoom
+        x = (self.center_lon + 180.0) / 360.0 * world
+        s = math.sin(math.radians(self.center_lat))
+        y = (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * world
+
+        def lat_of(py: float) -> float:
+            n = math.pi - 2 * math.pi * py / world
+            return math.degrees(math.atan(math.sinh(n)))
+
+        half_w, half_h = self.width_px / 2, self.height_px / 2
+        return (
+            lat_of(y + half_h),
+            (x - half_w) / world * 360.0 - 180.0,
+            lat_of(y - half_h),
+            (x + half_w) / world * 360.0 - 180.0,
+        )
+
+
+def _in_bbox(lat: np.ndarray, lon: np.ndarray, bbox: BBox) -> np.ndarray:
+    return (lat >= bbox[0]) & (lon >= bbox[1]) & (lat <= bbox[2]) & (lon <= bbox[3])
+
+
+# ---------------------------
+# 站点网格
+# ---------------------------
+class StopGrid:
+    """Uniform grid over points (stops); ids are returned as given (e.g. stop_idx)."""
+
+    def __init__(self, lat, lon, ids=None, cell_deg: float = GRID_CELL_DEG) -> None:
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        ok = np.isfinite(lat) & np.isfinite(lon)
+        ids = np.arange(len(lat)) if ids is None else np.asarray(ids)
+        self.lat, self.lon, self.ids = lat[ok], lon[ok], ids[ok]
+
+        if len(self.lat):
+            self.lat0, self.lon0 = float(self.lat.min()), float(self.lon.min())
+            span = max(float(self.lat.max()) - self.lat0, float(self.lon.max()) - self.lon0, cell_deg)
+        else:
+            self.lat0 = self.lon0 = 0.0
+            span = cell_deg
+        self.cell = max(cell_deg, span / math.sqrt(_MAX_CELLS))
+        self.ny = int((float(self.lat.max()) - self.lat0) // self.cell) + 1 if len(self.lat) else 1
+        self.nx = int((float(self.lon.max()) - self.lon0) // self.cell) + 1 if len(self.lon) else 1
+
+        cells = self._cell_x(self.lon) * self.ny + self._cell_y(self.lat)
+        self.order = np.argsort(cells, kind="stable")
+        self.offsets = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.nx * self.ny), out=self.offsets[1:])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _cell_x(self, lon) -> np.ndarray:
+        return np.clip(((np.asarray(lon) - self.lon0) // self.cell).astype(np.int64), 0, self.nx - 1)
+
+    def _cell_y(self, lat) -> np.ndarray:
+        return np.clip(((np.asarray(lat) - self.lat0) // self.cell).astype(np.int64), 0, self.ny - 1)
+
+    def _block(self, x0: int, x1: int, y0: int, y1: int) -> np.ndarray:
+        # 每一列格子 [x*ny+y0, x*ny+y1] 在 order 里是连续的一段
+        x0, x1 = max(x0, 0), min(x1, self.nx - 1)
+        y0, y1 = max(y0, 0), min(y1, self.ny - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+        parts = [
+            self.order[self.offsets[x * self.ny + y0]: self.offsets[x * self.ny + y1 + 1]]
+            for x in range(x0, x1 + 1)
+        ]
+        return np.concatenate(parts)
+
+    def query_bbox(self, bbox: BBox) -> np.ndarray:
+        """ids of the points inside bbox."""
+        if not len(self.ids):
+            return self.ids
+        rows = self._block(
+            int((bbox[1] - self.lon0) // self.cell),
+            int((bbox[3] - self.lon0) // self.cell),
+            int((bbox[0] - self.lat0) // self.cell),
+            int((bbox[2] - self.lat0) // self.cell),
+        )
+        rows = rows[_in_bbox(self.lat[rows], self.lon[rows], bbox)]
+        return self.ids[np.sort(rows)]
+
+    def nearest(self, lat: float, lon: float, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, distances in metres) of the k points closest to (lat, lon), nearest first."""
+        if not len(self.ids) or k <= 0:
+            return self.ids[:0], np.empty(0)
+        k = min(k, len(self.ids))
+        cx, cy = int((lon - self.lon0) // self.cell), int((lat - self.lat0) // self.cell)
+        # 一圈格子保证覆盖的距离（取经纬两个方向较短的一边）
+        ring_m = self.cell * min(_M_PER_DEG_LAT, _M_PER_DEG_LON * math.cos(math.radians(lat)))
+        # 查询点在网格外时先跳到最近的格子
+        r = max(abs(cx - min(max(cx, 0), self.nx - 1)), abs(cy - min(max(cy, 0), self.ny - 1)))
+        limit = max(self.nx, self.ny) + r
+        while True:
+            rows = self._block(cx - r, cx + r, cy - r, cy + r)
+            if len(rows) >= k:
+                dist = distance_m(self.lat[rows], self.lon[rows], lat, lon)
+                kth = np.partition(dist, k - 1)[k - 1]
+                need = int(math.ceil(kth / ring_m)) if ring_m > 0 else limit
+                if need <= r or r >= limit:
+                    top = np.argsort(dist, kind="stable")[:k]
+                    return self.ids[rows[top]], dist[top]
+                r = need
+            else:
+                r = min(r * 2 + 1, limit)
+
+
+# ---------------------------
+# 线路分段的 bbox
+# ---------------------------
+@dataclass
+class SegmentIndex:
+    route_ids: np.ndarray  # 每段所属线路
+    positions: np.ndarray  # 在该线路分段列表里的下标
+    boxes: np.ndarray  # (n, 4): min_lat, min_lon, max_lat, max_lon
+
+    def query(self, bbox: BBox) -> Dict[str, List[int]]:
+        """{route_id: [segment position, ...]} of the segments whose bbox intersects bbox."""
+        b = self.boxes
+        hit = np.flatnonzero(
+            (b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) & (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1])
+        )
+        out: Dict[str, List[int]] = {}
+        for rid, pos in zip(self.route_ids[hit].tolist(), self.positions[hit].tolist()):
+            out.setdefault(rid, []).append(pos)
+        return out
+
+
+def build_segment_index(lines: Dict[str, List[pd.DataFrame]]) -> SegmentIndex:
+    route_ids: List[str] = []
+    positions: List[int] = []
+    boxes: List[Tuple[float, float, float, float]] = []
+    for rid, subs in lines.items():
+        for i, seg in enumerate(subs):
+            lat = pd.to_numeric(seg["stop_lat"], errors="coerce").to_numpy()
+            lon = pd.to_numeric(seg["stop_lon"], errors="coerce").to_numpy()
+            if not len(lat) or np.isnan(lat).all():
+                continue
+            route_ids.append(str(rid))
+            positions.append(i)
+            boxes.append((np.nanmin(lat), np.nanmin(lon), np.nanmax(lat), np.nanmax(lon)))
+    return SegmentIndex(
+        np.asarray(route_ids, dtype=object),
+        np.asarray(positions, dtype=np.int64),
+        np.asarray(boxes, dtype=np.float64).reshape(-1, 4),
+    )
+
+
+def clip_segment(seg: pd.DataFrame, bbox: BBox) -> pd.DataFrame:
+    """The part of a segment inside bbox, plus one point on each side so the line reaches the edge."""
+    inside = np.flatnonzero(
+        _in_bbox(
+            pd.to_numeric(seg["stop_lat"], errors="coerce").to_numpy(),
+            pd.to_numeric(seg["stop_lon"], errors="coerce").to_numpy(),
+            bbox,
+        )
+    )
+    if not len(inside):
+        # 线段穿过视口但没有站点落在里面：整段保留
+        return seg
+    return seg.iloc[max(inside[0] - 1, 0): inside[-1] + 2]
+
+
+def cull_lines(
+    lines: Dict[str, List[pd.DataFrame]],
+    index: SegmentIndex,
+    bbox: BBox,
+) -> Dict[str, List[pd.DataFrame]]:
+    """lines restricted to the segments intersecting bbox, each clipped to it."""
+    return {
+        rid: [clip_segment(lines[rid][i], bbox) for i in positions]
+        for rid, positions in index.query(bbox).items()
+        if rid in lines
+    }
+
+
+def stop_grid(stops: pd.DataFrame, stop_idx: Optional[np.ndarray] = None) -> StopGrid:
+    """StopGrid over a FeedModel stops table (only stop_idx if given), returning stop_idx."""
+    if stop_idx is None:
+        stop_idx = np.arange(len(stops))
+    return StopGrid(
+        stops["stop_lat"].to_numpy(dtype=np.float64)[stop_idx],
+        stops["stop_lon"].to_numpy(dtype=np.float64)[stop_idx],
+        stop_idx,
+    )
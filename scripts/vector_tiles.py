@@ -0,0 +1,654 @@
+"""
+Mapbox Vector Tiles of the prebuilt route geometry, served locally.
+
+Plotly traces carry every coordinate in the figure JSON, so a whole network
+(every bus borough at once) is too heavy to draw as traces. Instead
+`python -m scripts.vector_tiles [--name NAME] [subdir ...]` (or
+`compile_tiles` on first use) cuts the route geometry and stops of the given
+feeds (scripts/route_geometry.py) into MVT tiles, zooms TILE_MIN_ZOOM ..
+TILE_MAX_ZOOM, stored as one MBTiles (SQLite) file per tileset:
+
+    cache/tiles/<name>-<key>-t<TILE_FORMAT>.mbtiles
+
+<key> hashes the geometry artifacts (GTFS source, service day) and the color
+rules it was cut from, so a tileset is rebuilt only when one of them changes
+and its URLs can be cached by the browser for good. Each zoom uses the matching
+level of the LOD pyramid; TILE_MAX_ZOOM has the full geometry and the map
+overzooms past it.
+
+Routes go into one MVT layer per color ("routes-<color>"); plotly map layers
+cannot style by feature property, so `map_layers` adds one line layer per
+color plus a circle layer for "stops" (from STOP_MIN_ZOOM on). The browser only
+fetches the tiles in view, so the cost of the static network per viewport does
+not grow with the network.
+
+`tile_response` answers /tiles/<tileset>.json (TileJSON) and
+/tiles/<tileset>/<z>/<x>/<y>.pbf; it backs both the stdlib `start_tile_server`
+(Streamlit, TILE_PORT) and the Dash route on the Flask server.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_cache import CACHE_DIR, GTFS_DIR, ROOT, prune_stale
+from scripts.gtfs_calendar import ServiceDay
+from scripts.gtfs_source import gtfs_root
+from scripts.route_geometry import (
+    DAY_GEOMETRY_KEEP,
+    LOD_ZOOMS,
+    RouteLines,
+    geometry_path,
+    load_route_lines,
+    lod_for_zoom,
+)
+
+TILES_DIR = ROOT / "cache" / "tiles"
+
+# bump when the tile layout / layers change
+TILE_FORMAT = 1
+
+TILE_MIN_ZOOM = 8
+TILE_MAX_ZOOM = 14
+STOP_MIN_ZOOM = 12
+EXTENT = 4096
+# 瓦片四周多带的范围（瓦片坐标单位），避免线和站点在瓦片边界被截断
+BUFFER = 64
+
+TILE_HOST = os.getenv("TILE_HOST", "127.0.0.1")
+TILE_PORT = int(os.getenv("TILE_PORT", "8765"))
+# 浏览器访问瓦片服务的地址（反向代理 / 远程访问时设置）
+TILE_PUBLIC_URL_ENV = "TILE_PUBLIC_URL"
+
+DEFAULT_COLOR = "#2E86DE"
+STOPS_LAYER = "stops"
+
+_MVT_POINT = 1
+_MVT_LINESTRING = 2
+
+
+# ---------------------------
+# MVT 编码（protobuf 手写，只用到 varint / length-delimited 两种 wire type）
+# ---------------------------
+def _varint(v: int) -> bytes:
+    if v < _SMALL_VARINTS_N:
+        return _SMALL_VARINTS[v]
+    out = bytearray()
+    while v >= 0x80:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+    return bytes(out)
+
+
+# 瓦片坐标差 / 标签下标基本都小于 2**14：查表
+_SMALL_VARINTS_N = 1 << 14
+_SMALL_VARINTS = [bytes([v]) if v < 0x80 else bytes([(v & 0x7F) | 0x80, v >> 7]) for v in range(_SMALL_VARINTS_N)]
+
+
+def _varints(values: np.ndarray) -> bytes:
+    """Concatenated varints of non-negative integers, vectorized."""
+    v = np.asarray(values, dtype=np.uint64)
+    if len(v) < 64:
+        # 短数组（标签、单点）逐个编码更快
+        return b"".join(_varint(i) for i in v.tolist())
+    nbytes = np.ones(len(v), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += v >= np.uint64(1 << (7 * k))
+    start = np.concatenate(([0], np.cumsum(nbytes)[:-1]))
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max())):
+        sel = nbytes > k
+        low = ((v[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)).astype(np.uint8)
+        out[start[sel] + k] = low | ((nbytes[sel] > k + 1).astype(np.uint8) << 7)
+    return out.tobytes()
+
+
+def _zigzag(v: np.ndarray) -> np.ndarray:
+    v = np.asarray(v, dtype=np.int64)
+    return ((v << 1) ^ (v >> 63)).astype(np.uint64)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    # wire type 2（length-delimited）
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _field_int(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def line_geometry(parts: List[np.ndarray]) -> np.ndarray:
+    """
+    MVT command integers of a (multi)linestring; parts are (n, 2) int arrays in
+    tile coordinates. Repeated points are dropped, parts with < 2 points skipped.
+    """
+    out = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for xy in parts:
+        keep = np.ones(len(xy), dtype=bool)
+        keep[1:] = np.any(xy[1:] != xy[:-1], axis=1)
+        xy = xy[keep]
+        if len(xy) < 2:
+            continue
+        deltas = np.diff(np.vstack([cursor, xy]), axis=0)
+        cursor = xy[-1]
+        zz = _zigzag(deltas.ravel())
+        out.append(np.concatenate(([9], zz[:2], [2 | (len(xy) - 1) << 3], zz[2:])).astype(np.uint64))
+    return np.concatenate(out) if out else np.empty(0, dtype=np.uint64)
+
+
+class _LayerWriter:
+    """Features of one MVT layer; keys / values are interned as the spec requires."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.keys: Dict[str, int] = {}
+        self.values: Dict[str, int] = {}
+        self.features: List[bytes] = []
+
+    def _tags(self, props: Dict[str, str]) -> bytes:
+        tags = bytearray()
+        for k, v in props.items():
+            tags += _varint(self.keys.setdefault(k, len(self.keys)))
+            tags += _varint(self.values.setdefault(str(v), len(self.values)))
+        return bytes(tags)
+
+    def add(self, geom_type: int, geometry: np.ndarray, props: Dict[str, str]) -> None:
+        if not len(geometry):
+            return
+        self._append(geom_type, _varints(geometry), props)
+
+    def add_point(self, x: int, y: int, props: Dict[str, str]) -> None:
+        # 单点：MoveTo(1) + 一对 zigzag 坐标，不经过 numpy
+        self._append(_MVT_POINT, b"\x09" + _varint((x << 1) ^ (x >> 63)) + _varint((y << 1) ^ (y >> 63)), props)
+
+    def _append(self, geom_type: int, geometry: bytes, props: Dict[str, str]) -> None:
+        self.features.append(_field(2, self._tags(props)) + _field_int(3, geom_type) + _field(4, geometry))
+
+    def encode(self) -> bytes:
+        body = [_field_int(15, 2), _field(1, self.name.encode("utf-8"))]
+        body += [_field(2, f) for f in self.features]
+        body += [_field(3, k.encode("utf-8")) for k in self.keys]
+        body += [_field(4, _field(1, v.encode("utf-8"))) for v in self.values]
+        body.append(_field_int(5, EXTENT))
+        return b"".join(body)
+
+
+def encode_tile(layers: List[_LayerWriter]) -> bytes:
+    return b"".join(_field(3, layer.encode()) for layer in layers if layer.features)
+
+
+# ---------------------------
+# 切片
+# ---------------------------
+def project(lat: np.ndarray, lon: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator position in tile-coordinate units (EXTENT per tile) at zoom."""
+    world = EXTENT * 2.0 ** zoom
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.05112878, 85.05112878)
+    s = np.sin(np.radians(lat))
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * world
+    y = (0.5 - np.log((1 + s) / (1 - s)) / (4 * math.pi)) * world
+    return x, y
+
+
+def _tile_cover(x0, y0, x1, y1, zoom: int):
+    """(item, tile x, tile y) for every tile each box [x0, x1] x [y0, y1] (plus BUFFER) touches."""
+    last = 2 ** zoom - 1
+    tx0 = np.clip(np.floor((x0 - BUFFER) / EXTENT), 0, last).astype(np.int64)
+    tx1 = np.clip(np.floor((x1 + BUFFER) / EXTENT), 0, last).astype(np.int64)
+    ty0 = np.clip(np.floor((y0 - BUFFER) / EXTENT), 0, last).astype(np.int64)
+    ty1 = np.clip(np.floor((y1 + BUFFER) / EXTENT), 0, last).astype(np.int64)
+    w = tx1 - tx0 + 1
+    counts = w * (ty1 - ty0 + 1)
+    item = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    return item, tx0[item] + local % w[item], ty0[item] + local // w[item]
+
+
+def _flatten(lines_by_feed: Dict[str, RouteLines]):
+    """All segments of all feeds as flat point arrays + a route table + a stop table."""
+    frames: List[pd.DataFrame] = []
+    route_of_seg: List[int] = []
+    routes: List[Dict[str, str]] = []
+    for feed, lines in lines_by_feed.items():
+        for rid, subs in lines.items():
+            subs = [s for s in subs if len(s)]
+            if not subs:
+                continue
+            first = subs[0]
+            color = str(first["color"].iloc[0]) if "color" in first.columns else ""
+            routes.append(
+                {
+                    "feed": feed,
+                    "route_id": str(rid),
+                    "route_name": str(first["route_long_name"].iloc[0]) if "route_long_name" in first.columns else "",
+                    "color": color if color and color not in ("nan", "None") else DEFAULT_COLOR,
+                }
+            )
+            frames += [s.assign(feed=feed) for s in subs]
+            route_of_seg += [len(routes) - 1] * len(subs)
+    if not frames:
+        return None
+
+    df = pd.concat(frames, ignore_index=True)
+    sizes = np.asarray([len(f) for f in frames])
+    points = {
+        "lat": pd.to_numeric(df["stop_lat"], errors="coerce").to_numpy(dtype=np.float64),
+        "lon": pd.to_numeric(df["stop_lon"], errors="coerce").to_numpy(dtype=np.float64),
+        "lod": df["lod"].to_numpy(dtype=np.int8) if "lod" in df.columns else np.zeros(len(df), dtype=np.int8),
+        "seg": np.repeat(np.arange(len(frames), dtype=np.int64), sizes),
+        "route": np.repeat(np.asarray(route_of_seg, dtype=np.int64), sizes),
+    }
+    ok = np.isfinite(points["lat"]) & np.isfinite(points["lon"])
+    points = {k: v[ok] for k, v in points.items()}
+    stops = df.loc[ok, ["feed", "stop_id", "stop_name", "stop_lat", "stop_lon"]]
+    stops = stops.assign(stop_id=stops["stop_id"].astype(str)).drop_duplicates(["feed", "stop_id"])
+    return points, routes, stops.reset_index(drop=True)
+
+
+def _layer_name(color: str) -> str:
+    return "routes-" + re.sub(r"[^0-9A-Za-z]+", "", color)
+
+
+def _line_tiles(points, zoom: int) -> Dict[Tuple[int, int], Dict[int, List[np.ndarray]]]:
+    """{(x, y): {route: [part (n, 2) int64, ...]}} of one zoom."""
+    level = lod_for_zoom(zoom) if zoom < TILE_MAX_ZOOM else len(LOD_ZOOMS)
+    keep = points["lod"] <= level
+    seg, route = points["seg"][keep], points["route"][keep]
+    x, y = project(points["lat"][keep], points["lon"][keep], zoom)
+
+    edges = np.flatnonzero(seg[1:] == seg[:-1])
+    if not len(edges):
+        return {}
+    a, b = edges, edges + 1
+    item, tx, ty = _tile_cover(
+        np.minimum(x[a], x[b]), np.minimum(y[a], y[b]), np.maximum(x[a], x[b]), np.maximum(y[a], y[b]), zoom
+    )
+    edge = edges[item]
+    order = np.lexsort((edge, route[edge], ty, tx))
+    edge, tx, ty = edge[order], tx[order], ty[order]
+    # 同一瓦片、同一线路里下标连续的边连成一条线
+    new_run = np.ones(len(edge), dtype=bool)
+    new_run[1:] = (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1]) | (edge[1:] != edge[:-1] + 1)
+    starts = np.flatnonzero(new_run)
+    ends = np.concatenate((starts[1:], [len(edge)]))
+
+    tiles: Dict[Tuple[int, int], Dict[int, List[np.ndarray]]] = {}
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        p0, p1 = int(edge[s]), int(edge[e - 1]) + 2
+        key = (int(tx[s]), int(ty[s]))
+        xy = np.column_stack(
+            (np.round(x[p0:p1] - key[0] * EXTENT), np.round(y[p0:p1] - key[1] * EXTENT))
+        ).astype(np.int64)
+        tiles.setdefault(key, {}).setdefault(int(route[p0]), []).append(xy)
+    return tiles
+
+
+def _stop_tiles(stops: pd.DataFrame, zoom: int) -> Dict[Tuple[int, int], np.ndarray]:
+    """{(x, y): stop rows} of one zoom (stops near a tile edge go to both tiles)."""
+    if zoom < STOP_MIN_ZOOM or stops.empty:
+        return {}
+    x, y = project(stops["stop_lat"].to_numpy(), stops["stop_lon"].to_numpy(), zoom)
+    item, tx, ty = _tile_cover(x, y, x, y, zoom)
+    order = np.lexsort((item, ty, tx))
+    item, tx, ty = item[order], tx[order], ty[order]
+    bounds = np.flatnonzero((tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1])) + 1
+    out = {}
+    for rows in np.split(np.arange(len(item)), bounds):
+        if len(rows):
+            out[(int(tx[rows[0]]), int(ty[rows[0]]))] = item[rows]
+    return out
+
+
+def build_tiles(lines_by_feed: Dict[str, RouteLines]) -> Tuple[dict, Iterator[Tuple[int, int, int, bytes]]]:
+    """
+    (metadata, tiles) for the routes / stops of {subdir: route lines}: metadata
+    has the TileJSON vector_layers (with each route layer's color) and bounds,
+    tiles yields (z, x, y, MVT bytes) zoom by zoom.
+    """
+    flat = _flatten(lines_by_feed)
+    if flat is None:
+        return {"vector_layers": []}, iter(())
+    return _metadata(*flat), _iter_tiles(*flat)
+
+
+def _iter_tiles(points, routes, stops: pd.DataFrame) -> Iterator[Tuple[int, int, int, bytes]]:
+    route_props = [{k: r[k] for k in ("feed", "route_id", "route_name")} for r in routes]
+    stop_props = [
+        {"feed": f, "stop_id": sid, "stop_name": name}
+        for f, sid, name in zip(stops["feed"], stops["stop_id"], stops["stop_name"].astype(str))
+    ]
+    for zoom in range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1):
+        lines = _line_tiles(points, zoom)
+        stop_rows = _stop_tiles(stops, zoom)
+        if stop_rows:
+            sx, sy = project(stops["stop_lat"].to_numpy(), stops["stop_lon"].to_numpy(), zoom)
+        for key in sorted(set(lines) | set(stop_rows)):
+            layers: Dict[str, _LayerWriter] = {}
+            for r, parts in lines.get(key, {}).items():
+                name = _layer_name(routes[r]["color"])
+                layer = layers.setdefault(name, _LayerWriter(name))
+                layer.add(_MVT_LINESTRING, line_geometry(parts), route_props[r])
+            if key in stop_rows:
+                layer = layers.setdefault(STOPS_LAYER, _LayerWriter(STOPS_LAYER))
+                for i in stop_rows[key].tolist():
+                    px = int(round(sx[i] - key[0] * EXTENT))
+                    py = int(round(sy[i] - key[1] * EXTENT))
+                    layer.add_point(px, py, stop_props[i])
+            yield zoom, key[0], key[1], encode_tile(list(layers.values()))
+
+
+def _metadata(points, routes, stops: pd.DataFrame) -> dict:
+    layer_colors = {_layer_name(r["color"]): r["color"] for r in routes}
+    vector_layers = [
+        {
+            "id": name,
+            "color": color,
+            "fields": {"feed": "String", "route_id": "String", "route_name": "String"},
+            "minzoom": TILE_MIN_ZOOM,
+            "maxzoom": TILE_MAX_ZOOM,
+        }
+        for name, color in sorted(layer_colors.items())
+    ]
+    if not stops.empty:
+        vector_layers.append(
+            {
+                "id": STOPS_LAYER,
+                "fields": {"feed": "String", "stop_id": "String", "stop_name": "String"},
+                "minzoom": STOP_MIN_ZOOM,
+                "maxzoom": TILE_MAX_ZOOM,
+            }
+        )
+    bounds = [
+        float(points["lon"].min()),
+        float(points["lat"].min()),
+        float(points["lon"].max()),
+        float(points["lat"].max()),
+    ]
+    return {"vector_layers": vector_layers, "bounds": bounds}
+
+
+# ---------------------------
+# MBTiles 读写
+# ---------------------------
+def tileset_path(
+    name: str,
+    subdirs: List[str],
+    gtfs_dir: Path = GTFS_DIR,
+    days: Optional[Dict[str, Optional[ServiceDay]]] = None,
+    colors: Optional[Dict[str, dict]] = None,
+    cache_dir: Path = CACHE_DIR,
+    tiles_dir: Path = TILES_DIR,
+) -> Optional[Path]:
+    days, colors = days or {}, colors or {}
+    parts = []
+    for subdir in subdirs:
+        path = geometry_path(subdir, gtfs_dir, cache_dir, day=days.get(subdir))
+        if path is not None:
+            parts.append([subdir, path.name, colors.get(subdir)])
+    if not parts:
+        return None
+    key = hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return Path(tiles_dir) / f"{name}-{key}-t{TILE_FORMAT}.mbtiles"
+
+
+def write_mbtiles(lines_by_feed: Dict[str, RouteLines], path: Path, name: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.stem}-", dir=path.parent)
+    os.close(fd)
+    try:
+        con = sqlite3.connect(tmp)
+        con.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        con.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        meta, tiles = build_tiles(lines_by_feed)
+        for z, x, y, data in tiles:
+            if data:
+                # MBTiles 用 TMS 行号（y 轴朝上）
+                con.execute(
+                    "INSERT INTO tiles VALUES (?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, gzip.compress(data, 6))
+                )
+        con.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        bounds = meta.get("bounds")
+        rows = {
+            "name": name,
+            "format": "pbf",
+            "minzoom": str(TILE_MIN_ZOOM),
+            "maxzoom": str(TILE_MAX_ZOOM),
+            "json": json.dumps({"vector_layers": meta["vector_layers"]}),
+        }
+        if bounds:
+            rows["bounds"] = ",".join(f"{v:.6f}" for v in bounds)
+            rows["center"] = f"{(bounds[0] + bounds[2]) / 2:.6f},{(bounds[1] + bounds[3]) / 2:.6f},{TILE_MIN_ZOOM + 2}"
+        con.executemany("INSERT INTO metadata VALUES (?, ?)", rows.items())
+        con.commit()
+        con.close()
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def compile_tiles(
+    name: str,
+    subdirs: List[str],
+    gtfs_dir: Path = GTFS_DIR,
+    days: Optional[Dict[str, Optional[ServiceDay]]] = None,
+    colors: Optional[Dict[str, dict]] = None,
+    cache_dir: Path = CACHE_DIR,
+    tiles_dir: Path = TILES_DIR,
+    force: bool = False,
+) -> Optional[Path]:
+    """
+    Build the tileset <name> of the given feeds (if missing or force) and return
+    its path; None if none of the feeds exists. days restricts a feed to its
+    ServiceDay; colors holds load_route_lines color arguments per feed.
+    """
+    days, colors = days or {}, colors or {}
+    path = tileset_path(name, subdirs, gtfs_dir, days, colors, cache_dir, tiles_dir)
+    if path is None:
+        return None
+    if path.exists() and not force:
+        return path
+    lines = {
+        subdir: load_route_lines(
+            subdir, gtfs_dir=gtfs_dir, cache_dir=cache_dir, day=days.get(subdir), **colors.get(subdir, {})
+        )
+        for subdir in subdirs
+    }
+    write_mbtiles(lines, path, name)
+    prune_stale(path.parent.glob(f"{name}-*.mbtiles"), path, DAY_GEOMETRY_KEEP)
+    return path
+
+
+class TileStore:
+    """Read access to one MBTiles file (shared across server threads)."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.metadata = dict(self._con.execute("SELECT name, value FROM metadata").fetchall())
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """gzip-compressed MVT of tile (z, x, y) in XYZ numbering, None if empty."""
+        with self._lock:
+            row = self._con.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2 ** z - 1 - y),
+            ).fetchone()
+        return row[0] if row else None
+
+    def vector_layers(self) -> List[dict]:
+        return json.loads(self.metadata.get("json", "{}")).get("vector_layers", [])
+
+    def tilejson(self, base_url: str) -> dict:
+        out = {
+            "tilejson": "3.0.0",
+            "name": self.metadata.get("name", self.path.stem),
+            "tiles": [f"{base_url.rstrip('/')}/tiles/{self.path.stem}/{{z}}/{{x}}/{{y}}.pbf"],
+            "minzoom": int(self.metadata.get("minzoom", TILE_MIN_ZOOM)),
+            "maxzoom": int(self.metadata.get("maxzoom", TILE_MAX_ZOOM)),
+            "vector_layers": self.vector_layers(),
+        }
+        if "bounds" in self.metadata:
+            out["bounds"] = [float(v) for v in self.metadata["bounds"].split(",")]
+        return out
+
+
+_stores: Dict[Path, TileStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_tileset(path: Path) -> TileStore:
+    path = Path(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = TileStore(path)
+        return store
+
+
+# ---------------------------
+# 瓦片服务
+# ---------------------------
+_TILE_URL = re.compile(r"^/tiles/(?P<name>[A-Za-z0-9_.-]+?)(?:\.json|/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf)$")
+
+_COMMON_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+def tile_response(url_path: str, base_url: str, tiles_dir: Path = TILES_DIR) -> Tuple[int, Dict[str, str], bytes]:
+    """(status, headers, body) for a /tiles/... request path."""
+    m = _TILE_URL.match(url_path.split("?", 1)[0])
+    path = Path(tiles_dir) / f"{m.group('name')}.mbtiles" if m else None
+    if path is None or not path.is_file():
+        return 404, dict(_COMMON_HEADERS), b""
+    store = open_tileset(path)
+    if m.group("z") is None:
+        body = json.dumps(store.tilejson(base_url)).encode("utf-8")
+        return 200, {**_COMMON_HEADERS, "Content-Type": "application/json"}, body
+    data = store.get(int(m.group("z")), int(m.group("x")), int(m.group("y")))
+    # tileset 名里带内容 key，瓦片可以一直缓存
+    headers = {**_COMMON_HEADERS, "Cache-Control": "public, max-age=31536000, immutable"}
+    if data is None:
+        return 204, headers, b""
+    headers.update({"Content-Type": "application/vnd.mapbox-vector-tile", "Content-Encoding": "gzip"})
+    return 200, headers, data
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        status, headers, body = tile_response(
+            self.path, f"http://{self.headers.get('Host', 'localhost')}", self.server.tiles_dir
+        )
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def _make_server(host: str, port: int, tiles_dir: Path) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _TileHandler)
+    server.daemon_threads = True
+    server.tiles_dir = Path(tiles_dir)
+    return server
+
+
+def start_tile_server(
+    host: str = TILE_HOST, port: int = TILE_PORT, tiles_dir: Path = TILES_DIR
+) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve tiles_dir on host:port from a daemon thread. Returns None when the
+    port is already taken (another dashboard process serving the same cache).
+    """
+    try:
+        server = _make_server(host, port, tiles_dir)
+    except OSError:
+        return None
+    threading.Thread(target=server.serve_forever, name="tile-server", daemon=True).start()
+    return server
+
+
+def tilejson_url(path: Path, base_url: Optional[str] = None) -> str:
+    base = base_url if base_url is not None else os.getenv(TILE_PUBLIC_URL_ENV) or f"http://localhost:{TILE_PORT}"
+    return f"{base.rstrip('/')}/tiles/{Path(path).stem}.json"
+
+
+def map_layers(
+    path: Path, source: str, line_width: float = 2, stop_color: str = "white", black_color: str = "blue"
+) -> List[dict]:
+    """
+    plotly map / mapbox layers drawing the tileset at path from the TileJSON url
+    source: routes first, stops on top. Black routes (no route_color) are drawn
+    in black_color, as the trace builders do.
+    """
+    lines, stops = [], []
+    for layer in open_tileset(path).vector_layers():
+        if layer["id"] == STOPS_LAYER:
+            stops.append(
+                dict(
+                    sourcetype="vector",
+                    source=source,
+                    sourcelayer=STOPS_LAYER,
+                    type="circle",
+                    color=stop_color,
+                    circle=dict(radius=2),
+                    minzoom=STOP_MIN_ZOOM,
+                )
+            )
+        else:
+            color = layer.get("color", DEFAULT_COLOR)
+            lines.append(
+                dict(
+                    sourcetype="vector",
+                    source=source,
+                    sourcelayer=layer["id"],
+                    type="line",
+                    color=black_color if color == "#000000" else color,
+                    line=dict(width=line_width),
+                )
+            )
+    return lines + stops
+
+
+def main(argv: List[str]) -> int:
+    name = "network"
+    if "--name" in argv:
+        i = argv.index("--name")
+        name = argv[i + 1]
+        argv = argv[:i] + argv[i + 2:]
+    force = "--force" in argv
+    subdirs = [a for a in argv if not a.startswith("--")]
+    subdirs = subdirs or sorted(p.name for p in gtfs_root(GTFS_DIR).iterdir() if p.is_dir())
+    path = compile_tiles(name, subdirs, force=force)
+    print(f"{name}: {path if path else 'skipped (no feeds)'}")
+    if path is not None and "--serve" in argv:
+        print(f"serving {tilejson_url(path, f'http://{TILE_HOST}:{TILE_PORT}')}")
+        _make_server(TILE_HOST, TILE_PORT, TILES_DIR).serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+@dataclass
+class Asset:
+    """One file served by the local HTTP stand-in."""
+    body: bytes
+    etag: str = '"v1"'
+    honor_range: bool = True
+    content_type: str = "application/octet-stream"
+    delay: float = 0.0  # seconds to wait before responding (slow endpoint)
+
+
+@dataclass
+class StandInServer:
+    """
+    Local stand-in for a release / feed host: serves `assets` by path, honours
+    If-None-Match and (or, per asset, ignores) Range + If-Range, and records
+    every request.
+    """
+    base_url: str
+    assets: Dict[str, Asset] = field(default_factory=dict)
+    requests: List[dict] = field(default_factory=list)
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def hits(self, path: str) -> List[dict]:
+        return [r for r in self.requests if r["path"] == path]
+
+    def bytes_sent(self, path: Optional[str] = None) -> int:
+        return sum(r["sent"] for r in self.requests if path is None or r["path"] == path)
+
+
+def _handler(server: StandInServer):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            record = {"path": self.path, "headers": dict(self.headers), "status": 404, "sent": 0}
+            server.requests.append(record)
+            asset = server.assets.get(self.path)
+            if asset is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            time.sleep(asset.delay)
+
+            if self.headers.get("If-None-Match") == asset.etag:
+                record["status"] = 304
+                self.send_response(304)
+                self.send_header("ETag", asset.etag)
+                self.end_headers()
+                return
+
+            body, status, extra = asset.body, 200, {}
+            rng = self.headers.get("Range", "")
+            if_range = self.headers.get("If-Range")
+            if asset.honor_range and rng.startswith("bytes=") and (if_range is None or if_range == asset.etag):
+                start_s, _, end_s = rng[len("bytes="):].partition("-")
+                start = int(start_s)
+                end = min(int(end_s), len(body) - 1) if end_s else len(body) - 1
+                if start >= len(body):
+                    record["status"] = 416
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(body)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+                extra["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+                body = body[start: end + 1]
+
+            record["status"] = status
+            record["sent"] = len(body)
+            self.send_response(status)
+            self.send_header("Content-Type", asset.content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", asset.etag)
+            for k, v in extra.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+@pytest.fixture
+def http_server():
+    holder = StandInServer(base_url="")
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _handler(holder))
+    holder.base_url = f"http://127.0.0.1:{srv.server_address[1]}"
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield holder
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,101 @@
+import json
+import time
+
+from conftest import Asset
+from utils_streamlit import STALE_MAX_AGE, GbfsClient
+
+INFO = {"stations": [
+    {"station_id": "s1", "name": "W 21 St", "lat": 40.74, "lon": -73.99, "capacity": 30, "region_id": "71"},
+    {"station_id": "s2", "name": "Grove St", "lat": 40.72, "lon": -74.04, "capacity": 20, "region_id": "70"},
+]}
+REGIONS = {"regions": [{"region_id": "71", "name": "NYC District"}, {"region_id": "70", "name": "JC District"}]}
+
+
+def _status(bikes):
+    return {"stations": [
+        {"station_id": sid, "num_bikes_available": n, "num_ebikes_available": 0, "num_bikes_disabled": 0,
+         "num_docks_available": 10, "num_docks_disabled": 0, "is_installed": 1, "is_renting": 1,
+         "is_returning": 1, "last_reported": 1700000000}
+        for sid, n in bikes.items()
+    ]}
+
+
+def _feed(data, ttl, last_updated=None):
+    payload = {"last_updated": int(time.time()) if last_updated is None else last_updated, "ttl": ttl, "data": data}
+    return Asset(json.dumps(payload).encode(), content_type="application/json")
+
+
+def _serve(server, status_ttl, bikes):
+    server.assets["/gbfs/en/station_information.json"] = _feed(INFO, 86400)
+    server.assets["/gbfs/en/system_regions.json"] = _feed(REGIONS, 86400)
+    server.assets["/gbfs/en/station_status.json"] = _feed(_status(bikes), status_ttl)
+
+
+def _client(server):
+    return GbfsClient(base=server.url("/gbfs/en"))
+
+
+def test_station_data_joins_feeds(http_server):
+    _serve(http_server, 60, {"s1": 3, "s2": 7})
+    df = _client(http_server).station_data()
+    got = df.set_index("station_id")
+    assert got.loc["s1", "num_bikes_available"] == 3
+    assert got.loc["s2", "region_name"] == "JC District"
+
+
+def test_within_ttl_returns_previous_frame_without_fetching(http_server):
+    _serve(http_server, 60, {"s1": 3, "s2": 7})
+    client = _client(http_server)
+    first = client.station_data()
+    assert client.station_data() is first
+    assert len(http_server.hits("/gbfs/en/station_status.json")) == 1
+    assert client.changed.empty
+
+
+def test_long_ttl_is_not_reported_stale(http_server):
+    # ttl 比 STALE_MAX_AGE 长：没到期就不会重新下载，不能因此判成 failed
+    ttl = 2 * STALE_MAX_AGE
+    _serve(http_server, ttl, {"s1": 3, "s2": 7})
+    client = _client(http_server)
+    first = client.station_data()
+
+    feed = client.feeds["station_status"]
+    feed.fetched_at -= STALE_MAX_AGE + 60
+    feed.last_updated -= STALE_MAX_AGE + 60
+    df = client.station_data()
+
+    assert client.status == "ok"
+    assert df is first
+    assert len(http_server.hits("/gbfs/en/station_status.json")) == 1
+
+
+def test_failed_refresh_keeps_previous_until_stale(http_server):
+    _serve(http_server, 10, {"s1": 3, "s2": 7})
+    client = _client(http_server)
+    first = client.station_data()
+    del http_server.assets["/gbfs/en/station_status.json"]
+
+    feed = client.feeds["station_status"]
+    feed.fetched_at -= 20
+    feed.last_updated -= 20
+    assert client.station_data() is first
+    assert client.status == "stale"
+    assert "station_status" in client.errors
+
+    feed.fetched_at -= STALE_MAX_AGE
+    feed.last_updated -= STALE_MAX_AGE
+    assert client.station_data().empty
+    assert client.status == "failed"
+
+
+def test_changed_lists_updated_stations(http_server):
+    _serve(http_server, 10, {"s1": 3, "s2": 7})
+    client = _client(http_server)
+    client.station_data()
+    http_server.assets["/gbfs/en/station_status.json"] = _feed(_status({"s1": 3, "s2": 8}), 10)
+    client.feeds["station_status"].last_updated -= 20
+
+    df = client.station_data()
+
+    assert client.changed["station_id"].tolist() == ["s2"]
+    assert df.set_index("station_id").loc["s2", "num_bikes_available"] == 8
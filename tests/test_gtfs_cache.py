@@ -0,0 +1,72 @@
+import scripts.gtfs_cache as gtfs_cache
+from scripts.gtfs_cache import LAST_INGEST, compile_feed, publish_dir
+
+
+def _folder(path, content):
+    path.mkdir()
+    (path / "data.txt").write_text(content)
+    return path
+
+
+def test_publish_dir_moves_tmp_into_place(tmp_path):
+    tmp = _folder(tmp_path / ".k-tmp", "new")
+    publish_dir(tmp, tmp_path / "k")
+    assert (tmp_path / "k" / "data.txt").read_text() == "new"
+    assert not tmp.exists()
+
+
+def test_publish_dir_keeps_existing_target(tmp_path):
+    target = _folder(tmp_path / "k", "first")
+    tmp = _folder(tmp_path / ".k-tmp", "second")
+    publish_dir(tmp, target)
+    assert (target / "data.txt").read_text() == "first"
+    assert not tmp.exists()
+
+
+def test_publish_dir_replace_swaps_target(tmp_path):
+    target = _folder(tmp_path / "k", "old")
+    tmp = _folder(tmp_path / ".k-tmp", "new")
+    publish_dir(tmp, target, replace=True)
+    assert (target / "data.txt").read_text() == "new"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["k"]
+
+
+def test_compile_feed_records_duplicate_ids(tmp_path):
+    feed = tmp_path / "GTFS" / "subway"
+    feed.mkdir(parents=True)
+    (feed / "routes.txt").write_text("route_id,route_long_name,route_color\nA,Alpha,FF0000\nA,Alpha,FF0000\n")
+    (feed / "trips.txt").write_text("route_id,service_id,trip_id\nA,WKD,t1\nA,WKD,t2\nA,SAT,t1\n")
+    (feed / "stops.txt").write_text("stop_id,stop_name,stop_lat,stop_lon\ns1,One,40.7,-74.0\ns2,Two,40.8,-73.9\n")
+    (feed / "stop_times.txt").write_text(
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "t1,01:00:00,01:00:00,s1,1\nt1,01:05:00,01:05:00,s2,2\nt2,02:00:00,02:00:00,s2,1\n"
+    )
+
+    assert compile_feed("subway", gtfs_dir=tmp_path / "GTFS", cache_dir=tmp_path / "cache") is not None
+
+    stats = LAST_INGEST["subway"]
+    assert stats.duplicates == {"routes.txt": 1, "trips.txt": 1}
+    assert "duplicate ids dropped" in str(stats)
+
+
+def test_trip_stats_add_up_across_chunks(tmp_path, monkeypatch):
+    feed = tmp_path / "GTFS" / "bus_bronx"
+    feed.mkdir(parents=True)
+    (feed / "routes.txt").write_text("route_id,route_long_name,route_color\nBx1,One,\n")
+    (feed / "trips.txt").write_text("route_id,service_id,trip_id\nBx1,WKD,a\nBx1,WKD,b\nBx1,WKD,idle\n")
+    (feed / "stops.txt").write_text("stop_id,stop_name,stop_lat,stop_lon\ns1,One,40.8,-73.9\ns2,Two,40.9,-73.9\n")
+    # 行序打乱：同一 trip 分散在不同 chunk 里
+    (feed / "stop_times.txt").write_text(
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "a,08:10:00,08:10:00,s2,2\nb,25:00:00,,s1,1\na,,08:00:00,s1,1\nb,25:30:00,25:31:00,s2,2\n"
+    )
+    monkeypatch.setattr(gtfs_cache, "_MIN_CHUNK_ROWS", 1)
+
+    compile_feed("bus_bronx", gtfs_dir=tmp_path / "GTFS", cache_dir=tmp_path / "cache", memory_limit=1)
+    assert LAST_INGEST["bus_bronx"].chunks == 4
+
+    stats = gtfs_cache.load_trip_stats("bus_bronx", gtfs_dir=tmp_path / "GTFS", cache_dir=tmp_path / "cache")
+    got = stats.set_index(stats["trip_id"].astype(str))
+    assert got.loc["a", ["n_stops", "first_departure", "last_arrival"]].tolist() == [2, 8 * 3600, 8 * 3600 + 600]
+    assert got.loc["b", ["n_stops", "first_departure", "last_arrival"]].tolist() == [2, 25 * 3600, 25 * 3600 + 1800]
+    assert got.loc["idle", "n_stops"] == 0
@@ -0,0 +1,138 @@
+from datetime import date, datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.gtfs_calendar import (
+    DAY_SECONDS,
+    SERVICE_DATE_ENV,
+    ServiceCalendar,
+    infer_days,
+    load_calendar,
+    service_date,
+)
+
+# 2025-03-03 是星期一
+MON, SAT, SUN = date(2025, 3, 3), date(2025, 3, 8), date(2025, 3, 9)
+
+
+def _calendar():
+    return ServiceCalendar(
+        weekly={
+            "WKD": (0b0011111, 20250301, 20250331),
+            "SAT": (0b0100000, 20250301, 20250331),
+            "SUN": (0b1000000, 20250301, 20250331),
+        },
+        added={20250317: {"HOLIDAY"}},
+        removed={20250317: {"WKD"}},
+    )
+
+
+# ---------------------------
+# active
+# ---------------------------
+def test_active_follows_weekly_pattern():
+    cal = _calendar()
+    assert cal.active(MON) == {"WKD"}
+    assert cal.active(SAT) == {"SAT"}
+    assert cal.active(SUN) == {"SUN"}
+
+
+def test_active_applies_exception_dates():
+    assert _calendar().active(date(2025, 3, 17)) == {"HOLIDAY"}
+
+
+def test_active_outside_date_range_is_empty():
+    assert _calendar().active(date(2025, 4, 7)) == frozenset()
+
+
+def test_active_includes_inferred_services():
+    cal = ServiceCalendar(inferred={"B_Weekday": infer_days("B_Weekday"), "OWL": 0b1111111})
+    assert cal.active(MON) == {"B_Weekday", "OWL"}
+    assert cal.active(SAT) == {"OWL"}
+
+
+def test_infer_days_tokens():
+    assert infer_days("ASP25-Weekday-SDon") == 0b0011111
+    assert infer_days("SAT_2025") == 0b0100000
+    assert infer_days("wkend") == 0b1100000
+    assert infer_days("Saturday") == 0b0100000
+    assert infer_days("R20250301") is None
+
+
+# ---------------------------
+# effective_date
+# ---------------------------
+@pytest.mark.parametrize(
+    "day, expected",
+    [
+        (date(2025, 3, 12), date(2025, 3, 12)),  # 覆盖范围内：不动
+        (date(2025, 4, 16), date(2025, 3, 26)),  # 过期的 release：退回范围内的同一星期几
+        (date(2025, 2, 19), date(2025, 3, 5)),  # 还没生效的 release：往后挪
+    ],
+)
+def test_effective_date_moves_by_whole_weeks(day, expected):
+    moved = _calendar().effective_date(day)
+    assert moved == expected
+    assert moved.weekday() == day.weekday()
+
+
+def test_effective_date_without_calendar_is_unchanged():
+    cal = ServiceCalendar(inferred={"X": 0b1111111})
+    assert cal.effective_date(date(2030, 1, 1)) == date(2030, 1, 1)
+
+
+def test_service_day_of_expired_feed_uses_effective_date():
+    day = _calendar().service_day(date(2025, 4, 19))  # 星期六，范围外
+    assert day.date.weekday() == 5 and date(2025, 3, 1) <= day.date <= date(2025, 3, 31)
+    assert day.services == {"SAT"}
+    assert day.carry == {"WKD"}
+
+
+# ---------------------------
+# ServiceDay
+# ---------------------------
+def test_trip_mask_keeps_after_midnight_trips_of_previous_day():
+    day = _calendar().service_day(SAT)
+    service_ids = pd.Series(["SAT", "WKD", "WKD", "SUN"], dtype="category")
+    last_times = np.array([8 * 3600, DAY_SECONDS + 1800, 23 * 3600, 9 * 3600])
+    assert day.trip_mask(service_ids, last_times).tolist() == [True, True, False, False]
+
+
+def test_service_day_key_is_shared_by_equal_service_sets():
+    cal = _calendar()
+    tue, wed = cal.service_day(date(2025, 3, 4)), cal.service_day(date(2025, 3, 5))
+    assert tue.key == wed.key
+    assert tue.key != cal.service_day(MON).key  # 周一 carry 的是周日
+
+
+# ---------------------------
+# load_calendar / service_date
+# ---------------------------
+def test_load_calendar_reads_files_and_infers_the_rest(tmp_path):
+    feed = tmp_path / "GTFS" / "subway"
+    feed.mkdir(parents=True)
+    (feed / "calendar.txt").write_text(
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        "WKD,1,1,1,1,1,0,0,20250301,20250331\n"
+    )
+    (feed / "calendar_dates.txt").write_text("service_id,date,exception_type\nWKD,20250317,2\n")
+    trips = pd.DataFrame({"service_id": ["WKD", "X1", "X2"], "trip_id": ["a", "b-Sunday-1", "c"]})
+
+    cal = load_calendar("subway", trips, gtfs_dir=tmp_path / "GTFS")
+
+    assert cal.weekly == {"WKD": (0b0011111, 20250301, 20250331)}
+    assert cal.removed == {20250317: {"WKD"}}
+    assert cal.inferred == {"X1": 0b1000000, "X2": 0b1111111}
+    assert cal.source == "calendar+inferred"
+
+
+def test_service_date_uses_new_york_and_env_pin(monkeypatch):
+    monkeypatch.delenv(SERVICE_DATE_ENV, raising=False)
+    # UTC 03:00 还是纽约前一天晚上
+    assert service_date(datetime(2025, 3, 4, 3, 0, tzinfo=timezone.utc)) == date(2025, 3, 3)
+    monkeypatch.setenv(SERVICE_DATE_ENV, "20250308")
+    assert service_date() == SAT
+    monkeypatch.setenv(SERVICE_DATE_ENV, "all")
+    assert service_date() is None
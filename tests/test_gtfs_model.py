@@ -0,0 +1,45 @@
+import pandas as pd
+
+from scripts.gtfs_model import build_feed_model
+
+
+def _tables():
+    routes = pd.DataFrame({
+        "route_id": ["A", "B", "A"],
+        "route_long_name": ["Alpha", "Beta", "Alpha again"],
+        "route_color": ["FF0000", "00FF00", "0000FF"],
+    })
+    trips = pd.DataFrame({
+        "route_id": ["A", "B", "B"],
+        "service_id": ["WKD", "WKD", "SAT"],
+        "trip_id": ["t1", "t2", "t1"],
+    })
+    stops = pd.DataFrame({
+        "stop_id": ["s1", "s2", "s1"],
+        "stop_name": ["One", "Two", "One dup"],
+        "stop_lat": [40.7, 40.8, 0.0],
+        "stop_lon": [-74.0, -73.9, 0.0],
+    })
+    stop_times = pd.DataFrame({
+        "trip_id": ["t1", "t1", "t2", "t2"],
+        "arrival_time": [3600, 3700, 7200, 7300],
+        "departure_time": [3600, 3700, 7200, 7300],
+        "stop_id": ["s1", "s2", "s2", "s1"],
+        "stop_sequence": [1, 2, 1, 2],
+    })
+    return routes, stop_times, stops, trips
+
+
+def test_build_feed_model_keeps_first_of_duplicate_ids():
+    model = build_feed_model(_tables())
+
+    assert model.route_ids() == ["A", "B"]
+    assert model.routes.set_index("route_id").loc["A", "color"] == "#FF0000"
+    assert model.stops["stop_id"].tolist() == ["s1", "s2"]
+    assert model.stops.set_index("stop_id").loc["s1", "stop_name"] == "One"
+    assert model.n_trips == 2
+    assert model.trips["trip_id"].astype(str).tolist() == ["t1", "t2"]
+    # t1 的 stop_times 只挂在第一行（route A）上
+    frame = model.route_frame("A")
+    assert frame["trip_id"].astype(str).tolist() == ["t1", "t1"]
+    assert frame["stop_name"].tolist() == ["One", "Two"]
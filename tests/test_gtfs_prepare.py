@@ -0,0 +1,38 @@
+import json
+import subprocess
+from pathlib import Path
+
+from scripts import gtfs_prepare
+from scripts.gtfs_prepare import PreparedFeed, _from_json, _is_entry_process, _mp_context, _run_subprocess, _to_json
+
+
+def test_prepared_feed_json_round_trip():
+    res = PreparedFeed("subway", tables=Path("/c/subway/k"), model=Path("/m"), seconds=1.5, ingest="x")
+    assert _from_json(json.loads(_to_json(res))) == res
+    assert _from_json(json.loads(_to_json(PreparedFeed("LIRR", error="boom")))).error == "boom"
+
+
+def test_pool_outside_the_cli_runs_in_a_child_process(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_run(cmd, **kwargs):
+        calls.append((cmd, kwargs))
+        out = _to_json(PreparedFeed("subway", tables=Path("/t"), seconds=2.0)) + "\nnot json\n"
+        return subprocess.CompletedProcess(cmd, 1, out, "Traceback ...\nMemoryError: bus_queens\n")
+
+    monkeypatch.setattr(gtfs_prepare.subprocess, "run", fake_run)
+    (tmp_path / "GTFS").mkdir()
+    done = _run_subprocess(["subway", "bus_queens"], 2, tmp_path / "GTFS", tmp_path / "cache", force=True)
+
+    (cmd, kwargs), = calls
+    assert cmd[1:4] == ["-m", "scripts.gtfs_prepare", "--json"]
+    assert f"--gtfs={(tmp_path / 'GTFS').resolve()}" in cmd and "--force" in cmd
+    assert cmd[-2:] == ["subway", "bus_queens"]
+    assert kwargs["cwd"] == gtfs_prepare.ROOT
+    assert done["subway"].tables == Path("/t")
+    assert done["bus_queens"].error == "prepare process failed: MemoryError: bus_queens"
+
+
+def test_pool_never_forks():
+    assert _mp_context().get_start_method() == "spawn"
+    assert not _is_entry_process()
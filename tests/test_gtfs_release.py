@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import pytest
+
+from conftest import Asset
+from scripts.gtfs_release import build_manifest, diff_manifests, sync_gtfs_archive, _download_file
+
+BODY_V1 = bytes(range(256)) * 400
+BODY_V2 = b"new release " * 5000
+
+
+def _sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _interrupted(out, body: bytes, done: int, etag: str) -> None:
+    """State left by a download of body (ETag etag) that stopped after done bytes."""
+    part = out.with_name(out.name + ".part")
+    part.write_bytes(body[:done])
+    part.with_name(part.name + ".json").write_text(json.dumps({"etag": etag, "last_modified": "", "size": len(body)}))
+
+
+# ---------------------------
+# _download_file
+# ---------------------------
+def test_download_fresh(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1)
+    out = tmp_path / "a.zip"
+    _download_file(http_server.url("/a.zip"), out, sha256=_sha(BODY_V1))
+    assert out.read_bytes() == BODY_V1
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_resume_sends_if_range_and_appends(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1, etag='"v1"')
+    out = tmp_path / "a.zip"
+    _interrupted(out, BODY_V1, 30000, '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out)
+
+    assert out.read_bytes() == BODY_V1
+    (req,) = http_server.hits("/a.zip")
+    assert req["headers"]["Range"] == "bytes=30000-"
+    assert req["headers"]["If-Range"] == '"v1"'
+    assert req["status"] == 206
+    assert http_server.bytes_sent() == len(BODY_V1) - 30000
+
+
+def test_asset_changed_since_interruption_restarts(http_server, tmp_path):
+    # 中断时是 v1，现在服务器上是 v2：If-Range 不匹配，整份重下，不能拼接
+    http_server.assets["/a.zip"] = Asset(BODY_V2, etag='"v2"')
+    out = tmp_path / "a.zip"
+    _interrupted(out, BODY_V1, 30000, '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out)
+
+    assert out.read_bytes() == BODY_V2
+    assert [r["status"] for r in http_server.hits("/a.zip")] == [200]
+
+
+def test_server_ignoring_range_restarts(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1, honor_range=False)
+    out = tmp_path / "a.zip"
+    _interrupted(out, BODY_V1, 30000, '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out)
+
+    assert out.read_bytes() == BODY_V1
+
+
+def test_part_without_validators_is_discarded(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1)
+    out = tmp_path / "a.zip"
+    out.with_name("a.zip.part").write_bytes(b"junk from an unknown download")
+
+    _download_file(http_server.url("/a.zip"), out)
+
+    assert out.read_bytes() == BODY_V1
+    assert "Range" not in http_server.hits("/a.zip")[0]["headers"]
+
+
+def test_416_with_stale_larger_part_restarts(http_server, tmp_path):
+    # 旧 .part 比新文件还大：416 不能当成“已完成”
+    small = b"tiny asset"
+    http_server.assets["/a.zip"] = Asset(small, etag='"v1"')
+    out = tmp_path / "a.zip"
+    _interrupted(out, BODY_V1, 20000, '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out)
+
+    assert out.read_bytes() == small
+    assert [r["status"] for r in http_server.hits("/a.zip")] == [416, 200]
+
+
+def test_416_on_complete_part_is_accepted(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1, etag='"v1"')
+    out = tmp_path / "a.zip"
+    _interrupted(out, BODY_V1, len(BODY_V1), '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out, sha256=_sha(BODY_V1))
+
+    assert out.read_bytes() == BODY_V1
+    assert http_server.bytes_sent() == 0
+
+
+def test_sha_mismatch_retries_from_zero(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1, etag='"v1"')
+    out = tmp_path / "a.zip"
+    corrupt = b"\0" * 1000 + BODY_V1[1000:30000]
+    _interrupted(out, corrupt + BODY_V1[30000:], 30000, '"v1"')
+
+    _download_file(http_server.url("/a.zip"), out, sha256=_sha(BODY_V1))
+
+    assert out.read_bytes() == BODY_V1
+    statuses = [r["status"] for r in http_server.hits("/a.zip")]
+    assert statuses == [206, 200]
+
+
+def test_sha_mismatch_gives_up_after_retries(http_server, tmp_path):
+    http_server.assets["/a.zip"] = Asset(BODY_V1)
+    out = tmp_path / "a.zip"
+    with pytest.raises(RuntimeError, match="SHA-256 mismatch"):
+        _download_file(http_server.url("/a.zip"), out, sha256=_sha(b"something else"), retries=2)
+    assert not out.exists()
+    assert not list(tmp_path.glob("*.part*"))
+    assert len(http_server.hits("/a.zip")) == 2
+
+
+# ---------------------------
+# manifest diff
+# ---------------------------
+def test_diff_manifests():
+    old = {"files": {
+        "subway/stops.txt": {"sha256": "a"},
+        "subway/trips.txt": {"sha256": "b"},
+        "bus_bronx/stops.txt": {"sha256": "c"},
+        "subway_API_Key.txt": {"sha256": "k"},
+    }}
+    new = {"files": {
+        "subway/stops.txt": {"sha256": "a"},
+        "subway/trips.txt": {"sha256": "B"},
+        "LIRR/stops.txt": {"sha256": "d"},
+        "subway_API_Key.txt": {"sha256": "K"},
+    }}
+    diff = diff_manifests(old, new)
+    assert diff.added == ["LIRR/stops.txt"]
+    assert diff.changed == ["subway/trips.txt", "subway_API_Key.txt"]
+    assert diff.removed == ["bus_bronx/stops.txt"]
+    assert diff.fetch == ["LIRR/stops.txt", "subway/trips.txt", "subway_API_Key.txt"]
+    assert diff.feeds == ["LIRR", "bus_bronx", "subway"]
+    assert not diff.empty
+    assert diff_manifests(new, new).empty
+
+
+def test_diff_manifests_without_old_adds_everything():
+    new = {"files": {"subway/stops.txt": {"sha256": "a"}}}
+    assert diff_manifests(None, new).added == ["subway/stops.txt"]
+
+
+# ---------------------------
+# sync_gtfs_archive：只取变了的成员
+# ---------------------------
+def _release(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    return path.read_bytes()
+
+
+def _publish(server, tmp_path, members, etag):
+    body = _release(tmp_path / f"release-{etag}.zip", members)
+    manifest = build_manifest(tmp_path / f"release-{etag}.zip")
+    server.assets["/GTFS.zip"] = Asset(body, etag=f'"{etag}"')
+    server.assets["/GTFS.manifest.json"] = Asset(json.dumps(manifest).encode(), content_type="application/json")
+    return body
+
+
+def _members(path):
+    with zipfile.ZipFile(path) as z:
+        return {n: z.read(n) for n in z.namelist()}
+
+
+def test_sync_archive_fetches_only_changed_members(http_server, tmp_path):
+    big = os.urandom(3 * 1024 * 1024)
+    v1 = {"GTFS/bus_bronx/stop_times.txt": big, "GTFS/subway/stops.txt": b"stop_id\n1\n", "GTFS/old/x.txt": b"x"}
+    v2 = {"GTFS/bus_bronx/stop_times.txt": big, "GTFS/subway/stops.txt": b"stop_id\n1\n2\n", "GTFS/LIRR/stops.txt": b"s"}
+    cache = tmp_path / "cache" / "GTFS.zip"
+    url = http_server.url("/GTFS.zip")
+
+    full = _publish(http_server, tmp_path, v1, "v1")
+    first = sync_gtfs_archive(url, str(cache))
+    first.archive.close()
+    assert first.downloaded and cache.read_bytes() == full
+
+    v2_body = _publish(http_server, tmp_path, v2, "v2")
+    before = http_server.bytes_sent("/GTFS.zip")
+    second = sync_gtfs_archive(url, str(cache))
+    second.archive.close()
+    fetched = http_server.bytes_sent("/GTFS.zip") - before
+
+    assert second.downloaded
+    assert second.message.startswith("Patched GTFS archive")
+    assert second.diff.changed == ["subway/stops.txt"]
+    assert second.diff.added == ["LIRR/stops.txt"]
+    assert second.diff.removed == ["old/x.txt"]
+    assert _members(cache) == v2
+    assert fetched < len(v2_body) / 2
+
+    # 补丁后的 zip 不是逐字节相同，但下次同步仍然认为是最新
+    third = sync_gtfs_archive(url, str(cache))
+    third.archive.close()
+    assert not third.downloaded
+    assert http_server.bytes_sent("/GTFS.zip") - before == fetched
+
+
+def test_sync_archive_falls_back_without_range(http_server, tmp_path):
+    v1 = {"GTFS/subway/stops.txt": b"stop_id\n1\n", "GTFS/subway/trips.txt": b"trip_id\nA\n"}
+    v2 = {"GTFS/subway/stops.txt": b"stop_id\n1\n2\n", "GTFS/subway/trips.txt": b"trip_id\nA\n"}
+    cache = tmp_path / "cache" / "GTFS.zip"
+    url = http_server.url("/GTFS.zip")
+    _publish(http_server, tmp_path, v1, "v1")
+    sync_gtfs_archive(url, str(cache)).archive.close()
+
+    v2_body = _publish(http_server, tmp_path, v2, "v2")
+    http_server.assets["/GTFS.zip"].honor_range = False
+    result = sync_gtfs_archive(url, str(cache))
+    result.archive.close()
+
+    assert result.message.startswith("Downloaded GTFS archive")
+    assert result.diff.changed == ["subway/stops.txt"]
+    assert cache.read_bytes() == v2_body
+
+
+def test_sync_archive_without_manifest_uses_conditional_get(http_server, tmp_path):
+    cache = tmp_path / "cache" / "GTFS.zip"
+    url = http_server.url("/GTFS.zip")
+    v1 = _release(tmp_path / "v1.zip", {"GTFS/subway/stops.txt": b"stop_id\n1\n"})
+    http_server.assets["/GTFS.zip"] = Asset(v1, etag='"v1"')  # 没有 GTFS.manifest.json
+
+    first = sync_gtfs_archive(url, str(cache))
+    first.archive.close()
+    assert first.downloaded and cache.read_bytes() == v1
+
+    second = sync_gtfs_archive(url, str(cache))
+    second.archive.close()
+    assert not second.downloaded
+    assert second.message == "GTFS archive not modified (no release manifest)."
+    last = http_server.hits("/GTFS.zip")[-1]
+    assert last["headers"]["If-None-Match"] == '"v1"' and last["status"] == 304
+
+    v2 = _release(tmp_path / "v2.zip", {"GTFS/subway/stops.txt": b"stop_id\n1\n2\n"})
+    http_server.assets["/GTFS.zip"] = Asset(v2, etag='"v2"')
+    third = sync_gtfs_archive(url, str(cache))
+    third.archive.close()
+    assert third.downloaded
+    assert third.diff.changed == ["subway/stops.txt"]
+    assert cache.read_bytes() == v2
+
+
+def test_sync_archive_manifest_mismatch_is_not_up_to_date(http_server, tmp_path):
+    # 有 manifest 且 sha 不一致时才会补丁 / 下载；manifest 丢了也不能报“up to date”
+    cache = tmp_path / "cache" / "GTFS.zip"
+    url = http_server.url("/GTFS.zip")
+    _publish(http_server, tmp_path, {"GTFS/subway/stops.txt": b"a"}, "v1")
+    sync_gtfs_archive(url, str(cache)).archive.close()
+
+    del http_server.assets["/GTFS.manifest.json"]
+    v2 = _release(tmp_path / "v2.zip", {"GTFS/subway/stops.txt": b"b"})
+    http_server.assets["/GTFS.zip"] = Asset(v2, etag='"v2"')
+    result = sync_gtfs_archive(url, str(cache))
+    result.archive.close()
+
+    assert result.downloaded
+    assert cache.read_bytes() == v2
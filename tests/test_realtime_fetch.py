@@ -0,0 +1,66 @@
+import time
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+import utils_streamlit
+from conftest import Asset
+from utils_streamlit import FeedEndpoint, fetch_feeds
+
+NAME = "nyct-test"
+PATH = "/feed/nyct-test"
+
+
+def _message() -> bytes:
+    fm = gtfs_realtime_pb2.FeedMessage()
+    fm.header.gtfs_realtime_version = "2.0"
+    fm.header.timestamp = 1_700_000_000
+    return fm.SerializeToString()
+
+
+@pytest.fixture
+def feed(http_server, monkeypatch):
+    """One stand-in GTFS-RT feed, with the module's fetch state reset."""
+    monkeypatch.setattr(utils_streamlit, "ENV_SUBWAY_KEY", "test-key")
+    monkeypatch.setitem(utils_streamlit.FEEDS, NAME, FeedEndpoint(NAME, http_server.url(PATH), "subway"))
+    monkeypatch.setattr(utils_streamlit, "_LAST_GOOD", {})
+    monkeypatch.setattr(utils_streamlit, "_VALIDATORS", {})
+    monkeypatch.setattr(utils_streamlit, "_IN_FLIGHT", {})
+    asset = http_server.assets[PATH] = Asset(_message())
+    return asset
+
+
+def test_fetch_ok(http_server, feed):
+    report = fetch_feeds([NAME])
+    assert report.summary() == {NAME: "ok"}
+    assert report.results[NAME].message.header.timestamp == 1_700_000_000
+
+
+def test_request_timeout_is_bounded_by_deadline(http_server, feed):
+    feed.delay = 1.5
+    t0 = time.monotonic()
+    assert fetch_feeds([NAME], deadline=0.3).summary() == {NAME: "failed"}
+
+    # 请求本身在 deadline 左右超时，不会占着线程等满 TIMEOUT
+    utils_streamlit._IN_FLIGHT[NAME].exception(timeout=1.0)
+    assert time.monotonic() - t0 < 1.3
+
+
+def test_feed_with_fetch_in_flight_is_not_resubmitted(http_server, feed):
+    feed.delay = 1.0
+    utils_streamlit._IN_FLIGHT[NAME] = utils_streamlit._EXECUTOR.submit(
+        utils_streamlit._fetch_one, utils_streamlit.FEEDS[NAME]
+    )
+
+    report = fetch_feeds([NAME], deadline=0.2)
+    assert report.results[NAME].status == "failed"
+    assert report.results[NAME].error == "previous fetch still in flight"
+    assert len(http_server.hits(PATH)) == 1
+
+    # 下一轮等的还是同一个请求
+    assert fetch_feeds([NAME], deadline=3).summary() == {NAME: "ok"}
+    assert len(http_server.hits(PATH)) == 1
+
+    feed.delay = 0
+    assert fetch_feeds([NAME]).summary() == {NAME: "ok"}
+    assert len(http_server.hits(PATH)) == 2
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+from realtime_state import RealtimeState, StateDiff
+
+NOW = 1_700_000_000
+
+
+def _schedule(rows):
+    """rows: (trip_id, stop_id, route, arrival, departure) -> 列式 schedule"""
+    trip, stop, route, arr, dep = zip(*rows) if rows else ((),) * 5
+    return {
+        "trip_id": np.asarray(trip, dtype=object),
+        "stop_id": np.asarray(stop, dtype=object),
+        "route": np.asarray(route, dtype=object),
+        "arrival_time": np.asarray(arr, dtype=np.int64),
+        "departure_time": np.asarray(dep, dtype=np.int64),
+    }
+
+
+def _table(arrivals):
+    return {
+        (r, s): (a, d)
+        for r, s, a, d in zip(arrivals["route"], arrivals["stop_id"], arrivals["arrival_time"], arrivals["departure_time"])
+    }
+
+
+def test_apply_and_next_arrivals_pick_earliest_trip_per_stop():
+    state = RealtimeState()
+    diff = state.apply(_schedule([
+        ("t1", "s1", "A", NOW + 300, NOW + 330),
+        ("t2", "s1", "A", NOW + 120, NOW + 150),
+        ("t2", "s2", "A", 0, NOW + 400),  # 没有到站时间：按离站时间排序
+        ("t3", "s1", "B", NOW + 60, NOW + 60),
+        ("t4", "s3", "B", 0, 0),  # 两个时间都缺失：不进状态
+    ]), now=NOW)
+
+    assert diff == StateDiff(upserted=4)
+    assert len(state) == 4
+    assert _table(state.next_arrivals(now=NOW)) == {
+        ("A", "s1"): (NOW + 120, NOW + 150),
+        ("A", "s2"): (0, NOW + 400),
+        ("B", "s1"): (NOW + 60, NOW + 60),
+    }
+    assert state.next_arrival("A", "s3", now=NOW) is None
+
+
+def test_same_schedule_object_is_a_no_op():
+    state = RealtimeState()
+    schedule = _schedule([("t1", "s1", "A", NOW + 300, NOW + 300)])
+    state.apply(schedule, now=NOW)
+    version = state.version
+    assert state.apply(schedule, now=NOW + 10) == StateDiff()
+    assert state.version == version
+
+
+def test_apply_diff_counts_upserts_removals_and_expiry():
+    state = RealtimeState(expire_grace=60)
+    state.apply(_schedule([
+        ("t1", "s1", "A", NOW + 300, NOW + 300),
+        ("t1", "s2", "A", NOW + 600, NOW + 600),
+        ("t2", "s1", "A", NOW + 900, NOW + 900),
+        ("t3", "s1", "B", NOW + 100, NOW + 100),
+    ]), now=NOW)
+
+    later = NOW + 200
+    diff = state.apply(_schedule([
+        ("t1", "s1", "A", NOW + 360, NOW + 360),  # 晚点：upsert
+        ("t1", "s2", "A", NOW + 600, NOW + 600),  # 没变
+        ("t3", "s1", "B", NOW + 100, NOW + 100),  # 已过 cutoff：expired
+        ("t4", "s1", "B", NOW + 700, NOW + 700),  # 新车次
+    ]), now=later)  # t2 从 feed 消失：removed
+
+    assert diff == StateDiff(upserted=2, removed=1, expired=1)
+    assert diff.changed == 4
+    assert state.next_arrival("A", "s1", now=later) == (NOW + 360, NOW + 360)
+    assert state.next_arrival("B", "s1", now=later) == (NOW + 700, NOW + 700)
+    assert len(state) == 3
+
+
+def test_next_arrival_skips_passed_trips_between_feeds():
+    state = RealtimeState()
+    state.apply(_schedule([
+        ("t1", "s1", "A", NOW + 60, NOW + 60),
+        ("t2", "s1", "A", NOW + 400, NOW + 400),
+    ]), now=NOW)
+    assert state.next_arrival("A", "s1", now=NOW) == (NOW + 60, NOW + 60)
+    assert state.next_arrival("A", "s1", now=NOW + 120) == (NOW + 400, NOW + 400)
+    assert state.next_arrival("A", "s1", now=NOW + 500) is None
+
+
+def test_trip_moving_to_another_route_leaves_the_old_stop():
+    state = RealtimeState()
+    state.apply(_schedule([("t1", "s1", "A", NOW + 60, NOW + 60)]), now=NOW)
+    state.apply(_schedule([("t1", "s1", "A*", NOW + 60, NOW + 60)]), now=NOW)
+    assert state.next_arrival("A", "s1", now=NOW) is None
+    assert state.next_arrival("A*", "s1", now=NOW) == (NOW + 60, NOW + 60)
+
+
+def test_next_arrivals_match_a_full_recompute():
+    rng = np.random.default_rng(11)
+    state = RealtimeState(expire_grace=60)
+    trips = [f"t{i}" for i in range(80)]
+    now = NOW
+    for _ in range(30):
+        now += int(rng.integers(10, 90))
+        rows = []
+        for trip in rng.choice(trips, size=50, replace=False):
+            route = "AB"[int(trip[1:]) % 2]
+            for stop in rng.choice(["s1", "s2", "s3", "s4"], size=2, replace=False):
+                t = now + int(rng.integers(-200, 1800))
+                rows.append((trip, stop, route, t, t + 30))
+        state.apply(_schedule(rows), now=now)
+
+        frame = pd.DataFrame(rows, columns=["trip_id", "stop_id", "route", "arrival", "departure"])
+        frame = frame.drop_duplicates(["trip_id", "stop_id"], keep="last")
+        frame = frame[frame["arrival"] >= now].sort_values("arrival")
+        expected = {
+            (r, s): (a, d)
+            for r, s, a, d in frame.groupby(["route", "stop_id"]).first().reset_index()[
+                ["route", "stop_id", "arrival", "departure"]
+            ].itertuples(index=False)
+        }
+        assert _table(state.next_arrivals(now=now)) == expected
@@ -0,0 +1,106 @@
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from scripts.gtfs_calendar import SERVICE_TZ, ServiceCalendar
+from scripts.gtfs_model import build_feed_model
+from scripts.schedule_index import (
+    MISSING,
+    build_schedule_index,
+    format_seconds,
+    format_seconds_array,
+    seconds_now,
+)
+
+H = 3600
+FRI, SAT = date(2025, 3, 7), date(2025, 3, 8)
+
+
+def _model(trips, stop_times):
+    routes = pd.DataFrame({"route_id": ["A", "B"], "route_long_name": ["A", "B"], "route_color": ["", ""]})
+    stops = pd.DataFrame({"stop_id": ["s1", "s2", "s3"], "stop_name": ["1", "2", "3"],
+                          "stop_lat": [40.7, 40.8, 40.9], "stop_lon": [-74.0, -74.0, -74.0]})
+    trips = pd.DataFrame(trips, columns=["trip_id", "route_id", "service_id"])
+    stop_times = pd.DataFrame(stop_times, columns=["trip_id", "stop_id", "stop_sequence", "departure_time"])
+    stop_times["arrival_time"] = stop_times["departure_time"]
+    return build_feed_model((routes, stop_times, stops, trips))
+
+
+def _calendar():
+    return ServiceCalendar(weekly={
+        "WKD": (0b0011111, 20250301, 20250331),
+        "SAT": (0b0100000, 20250301, 20250331),
+    })
+
+
+def _night_model():
+    # 周五的 WKD 末班车跨过午夜（24:20 / 24:40），周六的 SAT 头班车 05:00
+    return _model(
+        [("fri_late", "A", "WKD"), ("sat_first", "A", "SAT"), ("fri_day", "A", "WKD")],
+        [
+            ("fri_late", "s1", 1, 23 * H + 50 * 60),
+            ("fri_late", "s2", 2, 24 * H + 20 * 60),
+            ("fri_late", "s3", 3, 24 * H + 40 * 60),
+            ("sat_first", "s1", 1, 5 * H),
+            ("sat_first", "s2", 2, 5 * H + 10 * 60),
+            ("fri_day", "s2", 1, 12 * H),
+        ],
+    )
+
+
+def test_next_departures_after_midnight_uses_previous_days_trips():
+    index = build_schedule_index(_night_model(), _calendar().service_day(SAT))
+    # 周六 00:05：周五那班车 24:20 到 s2 = 周六 00:20
+    got = index.next_departures("A", ["s1", "s2", "s3"], 5 * 60)
+    assert got.tolist() == [5 * H, 20 * 60, 40 * 60]
+    # 过了那班车之后只剩周六自己的
+    assert index.next_departures("A", ["s2", "s3"], 45 * 60).tolist() == [5 * H + 10 * 60, MISSING]
+
+
+def test_next_departures_before_midnight_reach_past_24h():
+    index = build_schedule_index(_night_model(), _calendar().service_day(FRI))
+    got = index.next_departures("A", ["s1", "s2", "s3"], 23 * H + 55 * 60)
+    assert got.tolist() == [MISSING, 24 * H + 20 * 60, 24 * H + 40 * 60]
+    assert format_seconds_array(got).tolist() == ["N/A", "00:20", "00:40"]
+    # 周五白天的 WKD 车次当天有效，周六不算
+    assert index.next_departure("A", "s2", 11 * H) == 12 * H
+    assert build_schedule_index(_night_model(), _calendar().service_day(SAT)).next_departure("A", "s2", 11 * H) == MISSING
+
+
+def test_next_departures_match_brute_force():
+    rng = np.random.default_rng(7)
+    trips, stop_times = [], []
+    for t in range(60):
+        trips.append((f"t{t}", "AB"[t % 2], "WKD"))
+        start = int(rng.integers(4 * H, 26 * H))
+        for seq, stop in enumerate(rng.choice(["s1", "s2", "s3"], size=3, replace=False)):
+            stop_times.append((f"t{t}", stop, seq, start + seq * 300))
+    index = build_schedule_index(_model(trips, stop_times))
+
+    table = pd.DataFrame(stop_times, columns=["trip_id", "stop_id", "seq", "dep"])
+    table["route_id"] = table["trip_id"].map({t: r for t, r, _ in trips})
+    for now in rng.integers(0, 27 * H, size=40).tolist():
+        for route in ("A", "B", "C"):
+            got = index.next_departures(route, ["s1", "s2", "s3", "nope"], now)
+            for stop, value in zip(["s1", "s2", "s3", "nope"], got.tolist()):
+                later = table[(table.route_id == route) & (table.stop_id == stop) & (table.dep >= now)]["dep"]
+                assert value == (later.min() if len(later) else MISSING)
+
+
+def test_next_at_stops_lists_every_route_of_the_stop():
+    model = _model(
+        [("a", "A", "WKD"), ("b", "B", "WKD")],
+        [("a", "s1", 1, 8 * H), ("a", "s2", 2, 8 * H + 300), ("b", "s2", 1, 9 * H)],
+    )
+    index = build_schedule_index(model)
+    s2 = index.stop_index.get_loc("s2")
+    got = index.next_at_stops([s2], 8 * H + 600).sort_values("route_id")
+    assert got.to_dict("list") == {"stop_id": ["s2", "s2"], "route_id": ["A", "B"], "next": [MISSING, 9 * H]}
+    assert sorted(index.stop_index[index.served_stops()]) == ["s1", "s2"]
+
+
+def test_seconds_now_and_format():
+    assert seconds_now(datetime(2025, 3, 8, 0, 5, 30, tzinfo=SERVICE_TZ)) == 330
+    assert format_seconds(25 * H + 10 * 60) == "01:10"
+    assert format_seconds(MISSING) == "N/A"
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.spatial_index import StopGrid, Viewport, build_segment_index, cull_lines, distance_m
+
+
+def _points(n=3000, seed=3):
+    rng = np.random.default_rng(seed)
+    # 市区密集 + 远郊稀疏，格子里点数很不均匀
+    lat = np.concatenate([rng.normal(40.75, 0.03, n - 50), rng.uniform(40.4, 41.2, 50)])
+    lon = np.concatenate([rng.normal(-73.98, 0.03, n - 50), rng.uniform(-74.5, -73.4, 50)])
+    return lat, lon
+
+
+def _brute_nearest(lat, lon, q_lat, q_lon, k):
+    dist = distance_m(lat, lon, q_lat, q_lon)
+    order = np.argsort(dist, kind="stable")[:k]
+    return order, dist[order]
+
+
+@pytest.mark.parametrize("k", [1, 5, 40])
+def test_nearest_matches_brute_force(k):
+    lat, lon = _points()
+    grid = StopGrid(lat, lon)
+    rng = np.random.default_rng(k)
+    queries = [(rng.uniform(40.3, 41.3), rng.uniform(-74.6, -73.3)) for _ in range(150)]
+    queries += [(40.75, -73.98), (39.0, -75.0), (42.0, -72.0)]  # 网格中心 / 网格外
+    for q_lat, q_lon in queries:
+        ids, dist = grid.nearest(q_lat, q_lon, k)
+        ref_ids, ref_dist = _brute_nearest(lat, lon, q_lat, q_lon, k)
+        np.testing.assert_allclose(dist, ref_dist)
+        assert set(ids.tolist()) == set(ref_ids.tolist())
+
+
+def test_nearest_returns_given_ids_and_skips_missing_coordinates():
+    lat = np.array([40.70, np.nan, 40.71, 40.90])
+    lon = np.array([-74.00, -74.00, -74.01, -73.90])
+    grid = StopGrid(lat, lon, ids=np.array([10, 11, 12, 13]))
+    assert len(grid) == 3
+    ids, dist = grid.nearest(40.70, -74.00, k=10)
+    assert ids.tolist() == [10, 12, 13]
+    assert dist[0] == 0.0
+    assert grid.nearest(40.7, -74.0, k=0)[0].size == 0
+    assert StopGrid([], []).nearest(40.7, -74.0)[0].size == 0
+
+
+def test_query_bbox_matches_brute_force():
+    lat, lon = _points()
+    grid = StopGrid(lat, lon)
+    for bbox in [(40.72, -74.01, 40.78, -73.95), (40.0, -75.0, 42.0, -73.0), (41.5, -72.0, 41.6, -71.9)]:
+        inside = np.flatnonzero((lat >= bbox[0]) & (lon >= bbox[1]) & (lat <= bbox[2]) & (lon <= bbox[3]))
+        assert grid.query_bbox(bbox).tolist() == inside.tolist()
+
+
+def test_viewport_bbox_is_centered_and_shrinks_with_zoom():
+    wide = Viewport(40.75, -73.98, zoom=10).bbox
+    close = Viewport(40.75, -73.98, zoom=14).bbox
+    assert wide[0] < close[0] < 40.75 < close[2] < wide[2]
+    assert (wide[1] + wide[3]) / 2 == pytest.approx(-73.98)
+    assert (close[3] - close[1]) == pytest.approx((wide[3] - wide[1]) / 16)
+
+
+def test_cull_lines_keeps_intersecting_segments_clipped():
+    seg = pd.DataFrame({"stop_lat": [40.70, 40.72, 40.74, 40.76, 40.78], "stop_lon": [-74.0] * 5})
+    far = pd.DataFrame({"stop_lat": [41.5, 41.6], "stop_lon": [-73.0, -73.0]})
+    lines = {"A": [seg, far], "B": [far]}
+    index = build_segment_index(lines)
+
+    culled = cull_lines(lines, index, (40.735, -74.1, 40.745, -73.9))
+
+    assert list(culled) == ["A"]
+    (clipped,) = culled["A"]
+    assert clipped["stop_lat"].tolist() == [40.72, 40.74, 40.76]
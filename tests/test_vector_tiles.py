@@ -0,0 +1,156 @@
+import numpy as np
+
+from scripts.vector_tiles import (
+    EXTENT,
+    _LayerWriter,
+    _MVT_LINESTRING,
+    _MVT_POINT,
+    _varint,
+    _varints,
+    encode_tile,
+    line_geometry,
+)
+
+
+# ---------------------------
+# 最小的 MVT 解码（只支持瓦片里用到的 varint / length-delimited）
+# ---------------------------
+def _read_varint(buf, i):
+    value = shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        value |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            return value, i
+
+
+def _fields(buf):
+    i, out = 0, []
+    while i < len(buf):
+        key, i = _read_varint(buf, i)
+        if key & 7 == 0:
+            value, i = _read_varint(buf, i)
+        else:
+            assert key & 7 == 2
+            n, i = _read_varint(buf, i)
+            value, i = buf[i: i + n], i + n
+        out.append((key >> 3, value))
+    return out
+
+
+def _packed(buf):
+    i, out = 0, []
+    while i < len(buf):
+        v, i = _read_varint(buf, i)
+        out.append(v)
+    return out
+
+
+def _unzigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+
+def decode_geometry(commands):
+    """MVT command integers -> list of parts, each a list of absolute (x, y)."""
+    parts, x, y, i = [], 0, 0, 0
+    while i < len(commands):
+        cmd, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if cmd == 1:
+            parts.append([])
+        for _ in range(count):
+            x += _unzigzag(commands[i])
+            y += _unzigzag(commands[i + 1])
+            i += 2
+            parts[-1].append((x, y))
+    return parts
+
+
+def decode_tile(data):
+    layers = {}
+    for number, layer in _fields(data):
+        assert number == 3
+        fields = _fields(layer)
+        keys = [v.decode() for n, v in fields if n == 3]
+        values = [_fields(v)[0][1].decode() for n, v in fields if n == 4]
+        features = []
+        for n, feature in fields:
+            if n != 2:
+                continue
+            f = dict(_fields(feature))
+            tags = _packed(f[2])
+            features.append({
+                "type": f[3],
+                "props": {keys[tags[j]]: values[tags[j + 1]] for j in range(0, len(tags), 2)},
+                "parts": decode_geometry(_packed(f[4])),
+            })
+        name = [v.decode() for n, v in fields if n == 1][0]
+        layers[name] = {
+            "version": dict(fields)[15],
+            "extent": dict(fields)[5],
+            "features": features,
+        }
+    return layers
+
+
+# ---------------------------
+# 编码
+# ---------------------------
+def test_varints_match_scalar_encoding():
+    rng = np.random.default_rng(5)
+    values = np.concatenate([
+        np.arange(300), rng.integers(0, 2**14, 200), rng.integers(2**14, 2**40, 200), [2**63 - 1],
+    ]).astype(np.uint64)
+    assert _varints(values) == b"".join(_varint(int(v)) for v in values)
+    assert _packed(_varints(values)) == [int(v) for v in values]
+
+
+def test_line_geometry_round_trip():
+    rng = np.random.default_rng(9)
+    parts = []
+    for n in (2, 5, 200):
+        xy = rng.integers(-64, EXTENT + 64, size=(n, 2))
+        parts.append(np.repeat(xy, rng.integers(1, 3, size=n), axis=0))  # 带重复点
+    parts.append(np.array([[10, 10], [10, 10]]))  # 去重后只剩一个点：跳过
+
+    decoded = decode_geometry([int(c) for c in line_geometry(parts)])
+
+    expected = []
+    for xy in parts:
+        keep = np.ones(len(xy), dtype=bool)
+        keep[1:] = np.any(xy[1:] != xy[:-1], axis=1)
+        if keep.sum() >= 2:
+            expected.append([tuple(p) for p in xy[keep].tolist()])
+    assert decoded == expected
+    assert len(decoded) == 3
+
+
+def test_line_geometry_commands():
+    geometry = line_geometry([np.array([[2, 2], [2, 10], [10, 10]]), np.array([[1, 1], [3, 5]])])
+    # MoveTo(1) 2,2  LineTo(2) 0,8 8,0  MoveTo(1) -9,-9  LineTo(1) 2,4（相对上一段末尾）
+    assert geometry.tolist() == [9, 4, 4, 18, 0, 16, 16, 0, 9, 17, 17, 10, 4, 8]
+    assert line_geometry([np.array([[5, 5]])]).size == 0
+
+
+def test_encode_tile_round_trip():
+    routes = _LayerWriter("routes-2E86DE")
+    routes.add(_MVT_LINESTRING, line_geometry([np.array([[0, 0], [100, 50], [4096, 4096]])]), {"route_id": "M15"})
+    routes.add(_MVT_LINESTRING, line_geometry([np.array([[7, 7], [8, 8]])]), {"route_id": "M15", "feed": "bus"})
+    routes.add(_MVT_LINESTRING, line_geometry([]), {"route_id": "empty"})
+    stops = _LayerWriter("stops")
+    stops.add_point(-30, 4100, {"stop_name": "Times Sq"})
+    unused = _LayerWriter("unused")
+
+    layers = decode_tile(encode_tile([routes, stops, unused]))
+
+    assert list(layers) == ["routes-2E86DE", "stops"]
+    assert layers["stops"]["version"] == 2 and layers["stops"]["extent"] == EXTENT
+    assert layers["stops"]["features"] == [
+        {"type": _MVT_POINT, "props": {"stop_name": "Times Sq"}, "parts": [[(-30, 4100)]]}
+    ]
+    lines = layers["routes-2E86DE"]["features"]
+    assert [f["props"] for f in lines] == [{"route_id": "M15"}, {"route_id": "M15", "feed": "bus"}]
+    assert lines[0]["parts"] == [[(0, 0), (100, 50), (4096, 4096)]]
+    assert all(f["type"] == _MVT_LINESTRING for f in lines)
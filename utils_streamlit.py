@@ -2,11 +2,17 @@
 from __future__ import annotations
 
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
-from datetime import datetime
+from typing import Iterable, List, Dict, Tuple, Optional
 
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from google.transit import gtfs_realtime_pb2
 
 # ---------------------------
@@ -27,7 +33,9 @@ SUBWAY_KEY_PATH = GTFS_DIR / "subway_API_Key.txt"
 BUS_KEY_PATH = GTFS_DIR / "bus_API_Key.txt"
 
 # 网络请求参数
-TIMEOUT = 12  # 秒
+TIMEOUT = 12  # 秒，单个请求
+FETCH_DEADLINE = 15  # 秒，一次并发抓取的总时限
+STALE_MAX_AGE = 300  # 秒，失败时最多沿用多久以前的上一份结果
 
 def _safe_read_key(path: Path) -> str:
     """
@@ -60,29 +68,59 @@ def _build_subway_headers() -> Dict[str, str]:
     api_key = _get_subway_key()
     return {"x-api-key": api_key} if api_key else {}
 
-def _ts_to_str(ts: Optional[int]) -> Optional[str]:
-    """时间戳 → 字符串；字段缺失返回 None。"""
-    try:
-        if ts is None or int(ts) <= 0:
-            return None
-        return datetime.fromtimestamp(int(ts)).strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return None
+# decode_trip_updates 输出的列（每个 stop_time_update 一行）
+SCHEDULE_COLUMNS = ["route", "arrival_time", "departure_time", "stop_id"]
+
 
-def _append_stop_time(rows: List[Dict], route_id: str, stop_update) -> None:
+def decode_trip_updates(messages: Iterable[gtfs_realtime_pb2.FeedMessage]) -> Dict[str, object]:
     """
-    安全抽取 arrival/departure，字段缺失时允许为 None，统一 push。
+    一次遍历 FeedMessage，直接填充列式数组（不再每行建 dict、不做 strftime）：
+      route / trip_id / stop_id : pd.Categorical
+      arrival_time / departure_time : int64 epoch 秒（字段缺失为 0）
+      schedule_relationship : int8
+    时间的格式化只在 hover 等真正展示的少量值上做。
     """
-    arr = stop_update.arrival.time if stop_update.HasField("arrival") else None
-    dep = stop_update.departure.time if stop_update.HasField("departure") else None
-    rows.append(
-        {
-            "route": route_id,
-            "arrival_time": _ts_to_str(arr),
-            "departure_time": _ts_to_str(dep),
-            "stop_id": getattr(stop_update, "stop_id", None),
-        }
-    )
+    trip_routes: List[str] = []
+    trip_ids: List[str] = []
+    trip_counts: List[int] = []
+    stop_ids: List[str] = []
+    arr: List[int] = []
+    dep: List[int] = []
+    rel: List[int] = []
+
+    for fm in messages:
+        for entity in fm.entity:
+            if not entity.HasField("trip_update"):
+                continue
+            tu = entity.trip_update
+            updates = tu.stop_time_update
+            if not updates:
+                continue
+            # 未设置的子消息字段读出来就是默认值（"" / 0），不需要逐个 HasField
+            trip_routes.append(tu.trip.route_id)
+            trip_ids.append(tu.trip.trip_id)
+            trip_counts.append(len(updates))
+            for stu in updates:
+                stop_ids.append(stu.stop_id)
+                arr.append(stu.arrival.time)
+                dep.append(stu.departure.time)
+                rel.append(stu.schedule_relationship)
+
+    counts = np.asarray(trip_counts, dtype=np.int64)
+
+    def _per_trip(values: List[str]) -> pd.Categorical:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        return pd.Categorical.from_codes(np.repeat(codes, counts), categories=uniques)
+
+    return {
+        "route": _per_trip(trip_routes),
+        "trip_id": _per_trip(trip_ids),
+        "stop_id": pd.Categorical(np.asarray(stop_ids, dtype=object)),
+        "arrival_time": np.asarray(arr, dtype=np.int64),
+        "departure_time": np.asarray(dep, dtype=np.int64),
+        "schedule_relationship": np.asarray(rel, dtype=np.int8),
+    }
+
 
 def color_interpolation(
     dark_color: Tuple[int, int, int],
@@ -99,159 +137,592 @@ def color_interpolation(
     return r, g, b, 0.7
 
 
-# ---------------------------
-# Subway（NYCT）
-# ---------------------------
-def get_subway_schedule() -> List[Dict]:
+def color_interpolation_batch(dark_colors, light_colors, n) -> np.ndarray:
     """
-    汇总所有 NYCT 子 feed 的 trip_update → list[dict]
-    dict keys: route, arrival_time, departure_time, stop_id
+    color_interpolation 的批量版：dark_colors / light_colors 为 (k, 3) 数组（或单个颜色），
+    n 为长度 k 的数组。返回 k 个 "rgba(r, g, b, 0.7)"，与 f"rgba{color_interpolation(...)}" 逐个相同；
+    相同的颜色只格式化一次。
     """
-    headers = _build_subway_headers()
-
-    urls = [
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-ace",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-bdfm",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-g",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-jz",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-l",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-nqrw",
-        "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-si",
-    ]
-
-    feed = gtfs_realtime_pb2.FeedMessage()
-    for url in urls:
-        try:
-            resp = requests.get(url, headers=headers, timeout=TIMEOUT)
-            resp.raise_for_status()
-            fm = gtfs_realtime_pb2.FeedMessage()
-            fm.ParseFromString(resp.content)
-            feed.entity.extend(fm.entity)
-        except Exception:
-            continue
+    n = np.clip(np.asarray(n, dtype=np.float64), 0.0, 1.0).reshape(-1, 1)
+    dark = np.asarray(dark_colors, dtype=np.float64)
+    light = np.asarray(light_colors, dtype=np.float64)
+    rgb = np.broadcast_to(dark + (light - dark) * n, (len(n), 3)).astype(np.int64)
+    colors, inverse = np.unique(rgb, axis=0, return_inverse=True)
+    table = np.asarray([f"rgba{(r, g, b, 0.7)}" for r, g, b in colors.tolist()], dtype=object)
+    return table[inverse.reshape(-1)]
+
+
+def citibike_colors(
+    region_names,
+    num_bikes,
+    dark: Dict[str, Tuple[int, int, int]],
+    light: Dict[str, Tuple[int, int, int]],
+    cap: int = 80,
+) -> np.ndarray:
+    """
+    每个站的颜色：所在区域从 dark 到 light 的渐变，位置是 min(车数, cap) / cap。
+    所有区域一次算完（不再逐行 apply）。
+    """
+    codes, names = pd.factorize(np.asarray(region_names, dtype=object))
+    dark_rgb = np.asarray([dark[r] for r in names], dtype=np.int64).reshape(-1, 3)
+    light_rgb = np.asarray([light[r] for r in names], dtype=np.int64).reshape(-1, 3)
+    ratio = np.minimum(np.asarray(num_bikes, dtype=np.float64), cap) / cap
+    return color_interpolation_batch(dark_rgb[codes], light_rgb[codes], ratio)
 
-    rows: List[Dict] = []
-    for entity in feed.entity:
-        if entity.HasField("trip_update"):
-            tu = entity.trip_update
-            route_id = tu.trip.route_id if tu.trip.HasField("route_id") else ""
-            for stu in tu.stop_time_update:
-                _append_stop_time(rows, route_id, stu)
 
-    return rows
+# ---------------------------
+# 实时 feed 注册表 + 并发抓取引擎
+# ---------------------------
+MTA_FEED_BASE = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds"
+OBA_FEED_BASE = "http://gtfsrt.prod.obanyc.com"
+
+
+@dataclass(frozen=True)
+class FeedEndpoint:
+    name: str
+    url: str
+    auth: str  # "subway": x-api-key header；"bus": ?key= query
+
+    def request_args(self) -> Tuple[str, Dict[str, str]]:
+        if self.auth == "bus":
+            key = _get_bus_key()
+            return (f"{self.url}?key={key}" if key else self.url), {}
+        return self.url, _build_subway_headers()
+
+
+FEEDS: Dict[str, FeedEndpoint] = {
+    e.name: e
+    for e in [
+        FeedEndpoint("nyct-123456s", f"{MTA_FEED_BASE}/nyct%2Fgtfs", "subway"),
+        FeedEndpoint("nyct-ace", f"{MTA_FEED_BASE}/nyct%2Fgtfs-ace", "subway"),
+        FeedEndpoint("nyct-bdfm", f"{MTA_FEED_BASE}/nyct%2Fgtfs-bdfm", "subway"),
+        FeedEndpoint("nyct-g", f"{MTA_FEED_BASE}/nyct%2Fgtfs-g", "subway"),
+        FeedEndpoint("nyct-jz", f"{MTA_FEED_BASE}/nyct%2Fgtfs-jz", "subway"),
+        FeedEndpoint("nyct-l", f"{MTA_FEED_BASE}/nyct%2Fgtfs-l", "subway"),
+        FeedEndpoint("nyct-nqrw", f"{MTA_FEED_BASE}/nyct%2Fgtfs-nqrw", "subway"),
+        FeedEndpoint("nyct-si", f"{MTA_FEED_BASE}/nyct%2Fgtfs-si", "subway"),
+        FeedEndpoint("lirr", f"{MTA_FEED_BASE}/lirr%2Fgtfs-lirr", "subway"),
+        FeedEndpoint("mnr", f"{MTA_FEED_BASE}/mnr%2Fgtfs-mnr", "subway"),
+        FeedEndpoint("bus-trip-updates", f"{OBA_FEED_BASE}/tripUpdates", "bus"),
+        FeedEndpoint("bus-vehicle-positions", f"{OBA_FEED_BASE}/vehiclePositions", "bus"),
+    ]
+}
+
+# 每种交通方式对应哪些子 feed
+MODE_FEEDS: Dict[str, List[str]] = {
+    "subway": [n for n in FEEDS if n.startswith("nyct-")],
+    "lirr": ["lirr"],
+    "mnr": ["mnr"],
+    "bus": ["bus-trip-updates"],
+}
+
+
+@dataclass
+class FeedResult:
+    name: str
+    status: str  # "ok" / "stale"（本次失败，沿用上一份）/ "failed"
+    message: Optional[gtfs_realtime_pb2.FeedMessage] = None
+    fetched_at: float = 0.0  # message 对应的抓取时间（epoch 秒）
+    elapsed: float = 0.0
+    error: str = ""
+    unchanged: bool = False  # 304 或 header.timestamp 未前进：message 是上一份对象
+
+
+@dataclass
+class FetchReport:
+    results: Dict[str, FeedResult] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def _names(self, status: str) -> List[str]:
+        return [n for n, r in self.results.items() if r.status == status]
+
+    @property
+    def stale(self) -> List[str]:
+        return self._names("stale")
+
+    @property
+    def failed(self) -> List[str]:
+        return self._names("failed")
+
+    def messages(self, names: Iterable[str]) -> List[gtfs_realtime_pb2.FeedMessage]:
+        out = []
+        for n in names:
+            r = self.results.get(n)
+            if r is not None and r.message is not None:
+                out.append(r.message)
+        return out
+
+    def summary(self) -> Dict[str, str]:
+        """name -> status (plain dict, safe to cache / display)."""
+        return {n: r.status for n, r in self.results.items()}
+
+
+def _make_session() -> requests.Session:
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=len(FEEDS))
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+
+_SESSION = _make_session()
+_EXECUTOR = ThreadPoolExecutor(max_workers=len(FEEDS), thread_name_prefix="gtfs-rt")
+_LAST_GOOD: Dict[str, Tuple[gtfs_realtime_pb2.FeedMessage, float]] = {}
+_LAST_GOOD_LOCK = threading.Lock()
+_LAST_REPORT = FetchReport()
+# name -> 还没结束的请求：上一轮超时的请求仍占着 _EXECUTOR 的线程（cancel 停不下正在跑的请求），
+# 结束前不再重复提交，否则慢接口会把线程池占满，后面几轮的请求都排在它后面
+_IN_FLIGHT: Dict[str, Future] = {}
+_IN_FLIGHT_LOCK = threading.Lock()
 
 
 # ---------------------------
-# Metro-North Railroad（MNR）
+# 条件请求：ETag / Last-Modified + FeedHeader.timestamp
 # ---------------------------
-def get_MNR_schedule() -> List[Dict]:
-    headers = _build_subway_headers()
-    url = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/mnr%2Fgtfs-mnr"
-
-    feed = gtfs_realtime_pb2.FeedMessage()
+@dataclass
+class _Validators:
+    etag: str = ""
+    last_modified: str = ""
+    header_ts: int = 0
+    hits: int = 0  # 没变：304 或 header.timestamp 没前进
+    misses: int = 0  # 变了：完整解析
+
+
+_VALIDATORS: Dict[str, _Validators] = {}
+
+
+def _conditional_headers(name: str) -> Dict[str, str]:
+    with _LAST_GOOD_LOCK:
+        v = _VALIDATORS.get(name)
+        if v is None or name not in _LAST_GOOD:
+            return {}
+        out = {}
+        if v.etag:
+            out["If-None-Match"] = v.etag
+        if v.last_modified:
+            out["If-Modified-Since"] = v.last_modified
+        return out
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def peek_header_timestamp(content: bytes) -> int:
+    """
+    只解析 FeedMessage 的 header（字段 1），不碰后面的 entity。
+    header 缺失 / 不在最前面时返回 0（调用方按“已变化”处理）。
+    """
     try:
-        resp = requests.get(url, headers=headers, timeout=TIMEOUT)
+        if not content or content[0] != 0x0A:  # field 1, length-delimited
+            return 0
+        size, pos = _read_varint(content, 1)
+        header = gtfs_realtime_pb2.FeedHeader()
+        header.ParseFromString(content[pos:pos + size])
+        return int(header.timestamp)
+    except Exception:
+        return 0
+
+
+def _fetch_one(endpoint: FeedEndpoint, until: Optional[float] = None) -> FeedResult:
+    """until: 本轮的截止时间（time.monotonic()），请求超时不超过剩下的时间。"""
+    t0 = time.monotonic()
+    timeout = TIMEOUT if until is None else min(TIMEOUT, until - t0)
+    if timeout <= 0:
+        raise TimeoutError("deadline exceeded before the request started")
+    url, headers = endpoint.request_args()
+    headers = {**headers, **_conditional_headers(endpoint.name)}
+    resp = _SESSION.get(url, headers=headers, timeout=timeout)
+
+    now = time.time()
+    with _LAST_GOOD_LOCK:
+        v = _VALIDATORS.setdefault(endpoint.name, _Validators())
+        prev = _LAST_GOOD.get(endpoint.name)
+
+    header_ts = 0
+    if resp.status_code == 304 and prev is None:
+        raise RuntimeError("304 Not Modified without a cached copy")
+    if resp.status_code != 304:
         resp.raise_for_status()
+        header_ts = peek_header_timestamp(resp.content)
+    unchanged = prev is not None and (
+        resp.status_code == 304 or (header_ts > 0 and header_ts == v.header_ts)
+    )
+
+    if unchanged:
+        fm = prev[0]
+    else:
         fm = gtfs_realtime_pb2.FeedMessage()
         fm.ParseFromString(resp.content)
-        feed.entity.extend(fm.entity)
-    except Exception:
-        return []
+        header_ts = header_ts or int(fm.header.timestamp)
+
+    with _LAST_GOOD_LOCK:
+        _LAST_GOOD[endpoint.name] = (fm, now)
+        if unchanged:
+            v.hits += 1
+        else:
+            v.misses += 1
+            v.header_ts = header_ts
+        if resp.status_code != 304:
+            v.etag = resp.headers.get("ETag", "")
+            v.last_modified = resp.headers.get("Last-Modified", "")
+    return FeedResult(endpoint.name, "ok", fm, now, time.monotonic() - t0, unchanged=unchanged)
+
+
+def feed_cache_stats() -> Dict[str, Dict[str, float]]:
+    """
+    每个子 feed 的条件请求命中情况：
+    {name: {"hits", "misses", "hit_ratio"}}，hit = 没有重新解析（304 / header 未变）。
+    """
+    with _LAST_GOOD_LOCK:
+        return {
+            name: {
+                "hits": v.hits,
+                "misses": v.misses,
+                "hit_ratio": v.hits / (v.hits + v.misses) if (v.hits + v.misses) else 0.0,
+            }
+            for name, v in _VALIDATORS.items()
+        }
+
+
+def _fallback(name: str, error: str) -> FeedResult:
+    with _LAST_GOOD_LOCK:
+        prev = _LAST_GOOD.get(name)
+    if prev is not None and time.time() - prev[1] <= STALE_MAX_AGE:
+        return FeedResult(name, "stale", prev[0], prev[1], error=error)
+    return FeedResult(name, "failed", error=error)
+
+
+def fetch_feeds(names: Iterable[str], deadline: float = FETCH_DEADLINE) -> FetchReport:
+    """
+    并发抓取多个 GTFS-RT 子 feed（共享连接池），总时限 deadline 秒，
+    每个请求的超时也不超过剩下的时间。
+    超时 / 失败的 feed 沿用上一份成功结果（status="stale"），没有则 "failed"；
+    其余 feed 的结果照常返回，不会被单个慢接口拖住。
+    上一轮的请求还没结束的 feed 不重新提交，只等这个请求（到时仍没结束同样按超时处理）。
+    """
+    global _LAST_REPORT
+    t0 = time.monotonic()
+    until = t0 + deadline
+    names = [n for n in dict.fromkeys(names) if n in FEEDS]
+    futures: Dict[str, Future] = {}
+    pending = set()  # 沿用上一轮还没结束的请求
+    with _IN_FLIGHT_LOCK:
+        for n in names:
+            fut = _IN_FLIGHT.get(n)
+            if fut is not None and not fut.done():
+                pending.add(n)
+            else:
+                fut = _IN_FLIGHT[n] = _EXECUTOR.submit(_fetch_one, FEEDS[n], until)
+            futures[n] = fut
+    wait(futures.values(), timeout=deadline)
+
+    report = FetchReport()
+    for name, fut in futures.items():
+        if not fut.done():
+            fut.cancel()
+            error = "previous fetch still in flight" if name in pending else f"deadline {deadline}s exceeded"
+            report.results[name] = _fallback(name, error)
+            continue
+        try:
+            report.results[name] = fut.result()
+        except Exception as e:
+            report.results[name] = _fallback(name, str(e) or type(e).__name__)
+    report.elapsed = time.monotonic() - t0
+    _LAST_REPORT = report
+    return report
+
+
+def last_fetch_report() -> FetchReport:
+    """最近一次 fetch_feeds 的结果（用于展示哪些 feed 过期 / 失败）。"""
+    return _LAST_REPORT
 
-    rows: List[Dict] = []
-    for entity in feed.entity:
-        if entity.HasField("trip_update"):
-            tu = entity.trip_update
-            route_id = tu.trip.route_id if tu.trip.HasField("route_id") else ""
-            for stu in tu.stop_time_update:
-                _append_stop_time(rows, route_id, stu)
-    return rows
+
+def get_all_schedules(modes: Iterable[str] = ("subway", "lirr", "mnr", "bus")) -> Tuple[Dict[str, Dict[str, object]], FetchReport]:
+    """
+    一次刷新并发抓取所有交通方式的子 feed → ({mode: 列式 schedule}, report)
+    """
+    modes = list(modes)
+    report = fetch_feeds(n for m in modes for n in MODE_FEEDS[m])
+    return {m: _decode_cached(m, report.messages(MODE_FEEDS[m])) for m in modes}, report
+
+
+# mode -> (解码时用的 FeedMessage 对象, 解码结果)
+_DECODED: Dict[str, Tuple[Tuple[gtfs_realtime_pb2.FeedMessage, ...], Dict[str, object]]] = {}
+
+
+def _decode_cached(mode: str, messages: List[gtfs_realtime_pb2.FeedMessage]) -> Dict[str, object]:
+    """子 feed 全都没变（还是同一批 message 对象）时直接复用上一份解码结果。"""
+    prev = _DECODED.get(mode)
+    if prev is not None and len(prev[0]) == len(messages) and all(
+        a is b for a, b in zip(prev[0], messages)
+    ):
+        return prev[1]
+    decoded = decode_trip_updates(messages)
+    _DECODED[mode] = (tuple(messages), decoded)
+    return decoded
 
 
 # ---------------------------
-# Long Island Rail Road（LIRR）
+# Subway（NYCT）
 # ---------------------------
-def get_LIRR_schedule() -> List[Dict]:
-    headers = _build_subway_headers()
-    url = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/lirr%2Fgtfs-lirr"
+def get_subway_schedule() -> Dict[str, object]:
+    """
+    汇总所有 NYCT 子 feed 的 trip_update → 列式 schedule（见 decode_trip_updates）
+    """
+    return _decode_cached("subway", fetch_feeds(MODE_FEEDS["subway"]).messages(MODE_FEEDS["subway"]))
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    try:
-        resp = requests.get(url, headers=headers, timeout=TIMEOUT)
-        resp.raise_for_status()
-        fm = gtfs_realtime_pb2.FeedMessage()
-        fm.ParseFromString(resp.content)
-        feed.entity.extend(fm.entity)
-    except Exception:
-        return []
 
-    rows: List[Dict] = []
-    for entity in feed.entity:
-        if entity.HasField("trip_update"):
-            tu = entity.trip_update
-            route_id = tu.trip.route_id if tu.trip.HasField("route_id") else ""
-            for stu in tu.stop_time_update:
-                _append_stop_time(rows, route_id, stu)
-    return rows
+# ---------------------------
+# Metro-North Railroad（MNR）
+# ---------------------------
+def get_MNR_schedule() -> Dict[str, object]:
+    return _decode_cached("mnr", fetch_feeds(MODE_FEEDS["mnr"]).messages(MODE_FEEDS["mnr"]))
+
+
+# ---------------------------
+# Long Island Rail Road（LIRR）
+# ---------------------------
+def get_LIRR_schedule() -> Dict[str, object]:
+    return _decode_cached("lirr", fetch_feeds(MODE_FEEDS["lirr"]).messages(MODE_FEEDS["lirr"]))
 
 
 # ---------------------------
 # NYC Bus（OBANYC）
 # ---------------------------
-def get_bus_schedule() -> List[Dict]:
+def get_bus_schedule() -> Dict[str, object]:
     """
-    OBANYC tripUpdates → list[dict]
+    OBANYC tripUpdates → 列式 schedule（见 decode_trip_updates）
     """
-    key = _get_bus_key()
-    base_url = "http://gtfsrt.prod.obanyc.com/tripUpdates"
-    request_url = f"{base_url}?key={key}" if key else base_url
+    return _decode_cached("bus", fetch_feeds(MODE_FEEDS["bus"]).messages(MODE_FEEDS["bus"]))
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    try:
-        resp = requests.get(request_url, timeout=TIMEOUT)
-        resp.raise_for_status()
-        feed.ParseFromString(resp.content)
-    except Exception:
-        return []
 
+def get_bus_location() -> List[Dict]:
+    """
+    OBANYC vehiclePositions → list[dict]
+    """
     rows: List[Dict] = []
-    for entity in feed.entity:
-        if entity.HasField("trip_update"):
-            tu = entity.trip_update
-            route_id = tu.trip.route_id if tu.trip.HasField("route_id") else ""
-            for stu in tu.stop_time_update:
-                _append_stop_time(rows, route_id, stu)
+    for feed in fetch_feeds(["bus-vehicle-positions"]).messages(["bus-vehicle-positions"]):
+        for entity in feed.entity:
+            if entity.HasField("vehicle"):
+                v = entity.vehicle
+                rows.append(
+                    {
+                        "Vehicle ID": getattr(v.vehicle, "id", None),
+                        "Route ID": v.trip.route_id if v.trip.HasField("route_id") else "",
+                        "Direction ID": v.trip.direction_id if v.trip.HasField("direction_id") else None,
+                        "Latitude": getattr(v.position, "latitude", None),
+                        "Longitude": getattr(v.position, "longitude", None),
+                    }
+                )
     return rows
 
 
-def get_bus_location() -> List[Dict]:
+# ---------------------------
+# Citibike（GBFS）
+# ---------------------------
+GBFS_BASE = "https://gbfs.citibikenyc.com/gbfs/en"
+
+CITIBIKE_COLUMNS = [
+    "name",
+    "lat",
+    "lon",
+    "capacity",
+    "region_id",
+    "region_name",
+    "num_docks_available",
+    "num_ebikes_available",
+    "num_bikes_available",
+    "last_reported",
+]
+
+
+# station_status 里保留的列
+GBFS_STATUS_COLUMNS = [
+    "num_docks_available",
+    "num_bikes_disabled",
+    "num_ebikes_available",
+    "num_bikes_available",
+    "num_docks_disabled",
+    "is_renting",
+    "is_returning",
+    "last_reported",
+    "is_installed",
+]
+GBFS_STATIC_FEEDS = ("station_information", "system_regions")
+GBFS_STATUS_FEED = "station_status"
+# 站点信息 / 区域几乎不变：即使 feed 声明的 ttl 很短，也至少隔这么久才重新下载
+GBFS_STATIC_MIN_AGE = 6 * 3600  # 秒
+
+
+@dataclass
+class GbfsFeed:
+    """一个 GBFS feed 最近一次下载的内容；有效期是 feed 自己声明的 last_updated + ttl。"""
+    payload: dict
+    last_updated: int
+    ttl: int
+    fetched_at: float
+
+    def due(self, now: float, min_age: float = 0.0) -> bool:
+        return now >= max(self.last_updated + self.ttl, self.fetched_at + min_age)
+
+
+class GbfsClient:
     """
-    OBANYC vehiclePositions → list[dict]
+    Citibike GBFS 客户端：
+    - 只下载到期的 feed（按各 feed 的 ttl / last_updated），到期的几个并发下载；
+    - station_information + system_regions 长期缓存，变化时才重建静态站点表和
+      station_id -> 行号的索引；
+    - 每轮通常只有 station_status 到期，它按索引直接落到静态站点表上；
+    - changed 是最近一次刷新里 status 有变化（或新出现）的站。
+    只由 poller 的 citibike 线程调用。
     """
-    key = _get_bus_key()
-    base_url = "http://gtfsrt.prod.obanyc.com/vehiclePositions"
-    request_url = f"{base_url}?key={key}" if key else base_url
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    try:
-        resp = requests.get(request_url, timeout=TIMEOUT)
+    def __init__(
+        self,
+        base: str = GBFS_BASE,
+        session: Optional[requests.Session] = None,
+        static_min_age: float = GBFS_STATIC_MIN_AGE,
+    ) -> None:
+        self.base = base.rstrip("/")
+        self.session = session or _SESSION
+        self.static_min_age = static_min_age
+        self.feeds: Dict[str, GbfsFeed] = {}
+        self.errors: Dict[str, str] = {}  # 最近一次刷新失败的 feed
+        self.status = "failed"  # 最近一次刷新："ok" / "stale"（有 feed 失败，沿用上一份）/ "failed"
+        self.changed = pd.DataFrame(columns=CITIBIKE_COLUMNS)
+        self._stations: Optional[pd.DataFrame] = None  # 静态站点表，行序同 _station_index
+        self._station_index = pd.Index([], dtype=object)
+        self._status: Optional[pd.DataFrame] = None  # 上一份 status，station_id 为索引
+        self._frame = pd.DataFrame(columns=CITIBIKE_COLUMNS)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="gbfs")
+
+    # ---------- 下载 ----------
+    def _fetch_one(self, name: str) -> GbfsFeed:
+        resp = self.session.get(f"{self.base}/{name}.json", timeout=TIMEOUT)
         resp.raise_for_status()
-        feed.ParseFromString(resp.content)
-    except Exception:
-        return []
-
-    rows: List[Dict] = []
-    for entity in feed.entity:
-        if entity.HasField("vehicle"):
-            v = entity.vehicle
-            rows.append(
-                {
-                    "Vehicle ID": getattr(v.vehicle, "id", None),
-                    "Route ID": v.trip.route_id if v.trip.HasField("route_id") else "",
-                    "Direction ID": v.trip.direction_id if v.trip.HasField("direction_id") else None,
-                    "Latitude": getattr(v.position, "latitude", None),
-                    "Longitude": getattr(v.position, "longitude", None),
-                }
-            )
-    return rows
+        payload = resp.json()
+        return GbfsFeed(payload, int(payload.get("last_updated") or 0), int(payload.get("ttl") or 0), time.time())
+
+    def _fetch(self, names: List[str], deadline: float) -> Dict[str, GbfsFeed]:
+        futures = {n: self._executor.submit(self._fetch_one, n) for n in names}
+        wait(futures.values(), timeout=deadline)
+        out: Dict[str, GbfsFeed] = {}
+        for name, fut in futures.items():
+            if not fut.done():
+                fut.cancel()
+                self.errors[name] = f"deadline {deadline}s exceeded"
+                continue
+            try:
+                out[name] = fut.result()
+            except Exception as e:
+                self.errors[name] = str(e) or type(e).__name__
+        return out
+
+    def _due_feeds(self, now: float) -> List[str]:
+        due = [
+            n for n in GBFS_STATIC_FEEDS
+            if n not in self.feeds or self.feeds[n].due(now, self.static_min_age)
+        ]
+        if GBFS_STATUS_FEED not in self.feeds or self.feeds[GBFS_STATUS_FEED].due(now):
+            due.append(GBFS_STATUS_FEED)
+        return due
+
+    # ---------- 组表 ----------
+    def _build_stations(self) -> None:
+        info = pd.DataFrame(self.feeds["station_information"].payload["data"]["stations"])
+        regions = pd.DataFrame(self.feeds["system_regions"].payload["data"]["regions"]).rename(
+            columns={"name": "region_name"}
+        )
+        stations = info[["station_id", "name", "lat", "lon", "capacity", "region_id"]].merge(
+            regions[["region_id", "region_name"]], on="region_id"
+        )
+        stations["station_id"] = stations["station_id"].astype(str)
+        stations = stations.drop_duplicates("station_id").reset_index(drop=True)
+        self._station_index = pd.Index(stations["station_id"])
+        self._stations = stations
+
+    def _apply_status(self) -> None:
+        raw = pd.DataFrame(self.feeds[GBFS_STATUS_FEED].payload["data"]["stations"])
+        status = raw.reindex(columns=GBFS_STATUS_COLUMNS)
+        status.index = pd.Index(raw["station_id"].astype(str) if len(raw) else [], dtype=object)
+        status = status[~status.index.duplicated(keep="last")]
+
+        # 和上一份比：任一 status 列变化（或新站）就算 changed
+        if self._status is None:
+            changed = np.ones(len(status), dtype=bool)
+        else:
+            old = self._status.reindex(status.index)
+            changed = ((status != old) & ~(status.isna() & old.isna())).any(axis=1).to_numpy()
+        self._status = status
+
+        pos = self._station_index.get_indexer(status.index)
+        hit = pos >= 0
+        self._frame = pd.concat(
+            [self._stations.iloc[pos[hit]].reset_index(drop=True), status[hit].reset_index(drop=True)],
+            axis=1,
+        )
+        self.changed = self._frame[changed[hit]].reset_index(drop=True)
+
+    # ---------- 对外 ----------
+    def station_data(self, deadline: float = FETCH_DEADLINE) -> pd.DataFrame:
+        """
+        所有站点，每站一行（station_id、CITIBIKE_COLUMNS 及 status 列）。没有到期 / 没有更新的
+        feed 时直接返回上一份（同一个对象）；失败时沿用上一份，station_status 过期
+        （ttl）后超过 STALE_MAX_AGE 秒仍没下载成功则返回空表。
+        """
+        with self._lock:
+            now = time.time()
+            self.errors = {}
+            prev = {n: f.last_updated for n, f in self.feeds.items()}
+            fetched = self._fetch(self._due_feeds(now), deadline)
+            self.feeds.update(fetched)
+            updated = {n for n, f in fetched.items() if prev.get(n) != f.last_updated}
+
+            status_feed = self.feeds.get(GBFS_STATUS_FEED)
+            # 数据在 ttl 内本来就有效（没到期不会重新下载）；过期后下载失败再容忍 STALE_MAX_AGE 秒
+            if (
+                not all(n in self.feeds for n in GBFS_STATIC_FEEDS)
+                or status_feed is None
+                or now - status_feed.fetched_at > status_feed.ttl + STALE_MAX_AGE
+            ):
+                self.status = "failed"
+                self.changed = pd.DataFrame(columns=CITIBIKE_COLUMNS)
+                return pd.DataFrame(columns=CITIBIKE_COLUMNS)
+
+            try:
+                if self._stations is None or updated & set(GBFS_STATIC_FEEDS):
+                    self._build_stations()
+                    updated.add(GBFS_STATUS_FEED)
+                if GBFS_STATUS_FEED in updated:
+                    self._apply_status()
+                else:
+                    self.changed = self._frame.iloc[:0]
+            except (KeyError, TypeError) as e:
+                # feed 结构不对：丢掉这份，下一轮重新下载
+                for n in fetched:
+                    self.feeds.pop(n, None)
+                self.errors["parse"] = str(e) or type(e).__name__
+                self.status = "failed" if self._frame.empty else "stale"
+                return self._frame
+            self.status = "stale" if self.errors else "ok"
+            return self._frame
+
+
+CITIBIKE = GbfsClient()
+
+
+def get_citibike_station_data() -> pd.DataFrame:
+    """
+    station_information + station_status + system_regions → 每站一行（见 GbfsClient）。
+    失败时返回带列名的空 DataFrame。
+    """
+    return CITIBIKE.station_data()